@@ -29,7 +29,24 @@ SAAS_BILLING_AUTH = {
 }
 
 SAAS_BILLING_SETTINGS = {
-    'NO_MULTIPLE_SUBSCRIPTION': True
+    'NO_MULTIPLE_SUBSCRIPTION': True,
+    'PROCESS_BATCH_SIZE': 500,
+    'PROCESS_LEASE_SECONDS': 600,
+    'WEBHOOK_BATCH_SIZE': 100,
+    'WEBHOOK_MAX_ATTEMPTS': 5,
+    'WEBHOOK_COALESCE_SECONDS': 0,
+    'PAYPAL_WEBHOOK_VERIFICATION': 'local',
+    'PAYPAL_TOKEN_CACHE': 'default',
+    'PAYPAL_POOL_SIZE': 10,
+    'PAYPAL_CONNECT_TIMEOUT': 5,
+    'PAYPAL_READ_TIMEOUT': 30,
+    'PAYPAL_MAX_RETRIES': 3,
+    'CIRCUIT_WINDOW': 20,
+    'CIRCUIT_MIN_CALLS': 10,
+    'CIRCUIT_FAILURE_RATE': 0.5,
+    'CIRCUIT_SLOW_SECONDS': 10,
+    'CIRCUIT_OPEN_SECONDS': 30,
+    'GATEWAY_INDEX_CACHE': 'default',
 }
 
 def compile_settings():
@@ -45,7 +62,7 @@ def compile_settings():
     saas_billing_auth = getattr(
         settings, 'SAAS_BILLING_AUTH', SAAS_BILLING_AUTH
     )
-    saas_settings = getattr(settings, 'SAAS_BILLING_SETTINGS', SAAS_BILLING_SETTINGS)
+    saas_settings = dict(SAAS_BILLING_SETTINGS, **getattr(settings, 'SAAS_BILLING_SETTINGS', {}))
     return {
         'billing_models': saas_billing_models,
         'billing_auths': saas_billing_auth,
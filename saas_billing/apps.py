@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class SaasBillingConfig(AppConfig):
+    name = 'saas_billing'
+
+    def ready(self):
+        from saas_billing import catalog
+        catalog.connect_signals()
@@ -0,0 +1,10 @@
+from django.urls import path
+from saas_billing import async_views
+
+
+# Use instead of saas_billing.webhook_urls when served by ASGI
+urlpatterns = [
+    path('billing/stripe/webhook/', async_views.stripe_webhook),
+    path('billing/paypal/webhook/', async_views.paypal_webhook),
+    path('billing/plan-costs/<pk>/init_gateway_subscription/', async_views.init_gateway_subscription),
+]
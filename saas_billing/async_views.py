@@ -0,0 +1,141 @@
+"""Async versions of the webhook and checkout views for ASGI deployments.
+
+Django ORM calls run through sync_to_async on the request's sync thread. Gateway calls do not hold that thread:
+the PayPal checkout uses AsyncPayPalClient when httpx is installed, other gateway calls run in the
+default executor with thread_sensitive=False.
+"""
+import stripe
+from asgiref.sync import sync_to_async
+from django.http import Http404, JsonResponse
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from subscriptions_api.models import PlanCost
+from saas_billing.models import StripeCustomer, get_paypal_client
+from saas_billing.provider import AsyncPayPalClient, httpx
+from saas_billing.webhooks import store_webhook_event
+from saas_billing.circuit import GatewayUnavailable, guarded_call
+from saas_billing import catalog
+from saas_billing.app_settings import SETTINGS
+
+auth = SETTINGS['billing_auths']
+
+
+def call_gateway(func, *args, **kwargs):
+    """Run a blocking gateway call without holding the sync thread of the request"""
+    return sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
+
+
+def get_async_paypal_client():
+    if httpx is None:
+        return None
+    return AsyncPayPalClient(auth['paypal']['CLIENT_ID'], auth['paypal']['CLIENT_SECRET'], token=auth['paypal']['TOKEN'],
+                             env=auth['paypal']['ENV'])
+
+
+async def store_webhook(gateway, request):
+    if request.method != 'POST':
+        return JsonResponse({'detail': 'Method "{}" not allowed.'.format(request.method)}, status=405)
+    try:
+        await sync_to_async(store_webhook_event)(gateway, request)
+    except ValueError:
+        return JsonResponse({}, status=400)
+    return JsonResponse({})
+
+
+async def stripe_webhook(request):
+    return await store_webhook('stripe', request)
+
+
+async def paypal_webhook(request):
+    return await store_webhook('paypal', request)
+
+
+# csrf_exempt would wrap the views in a sync function
+stripe_webhook.csrf_exempt = True
+paypal_webhook.csrf_exempt = True
+
+
+def authenticate(request):
+    """Authenticate request with the DRF authentication classes, returns the user and the parsed data"""
+    drf_request = Request(request, parsers=[parser_class() for parser_class in api_settings.DEFAULT_PARSER_CLASSES],
+                          authenticators=[auth_class() for auth_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    return drf_request.user, drf_request.data
+
+
+def get_external_cost(pk, gateway):
+    try:
+        cost = PlanCost.objects.select_related('plan').get(pk=pk)
+    except (PlanCost.DoesNotExist, ValueError):
+        raise Http404
+    return cost, catalog.get_external_cost(gateway, cost)
+
+
+def get_stripe_customer_id(user):
+    return StripeCustomer.objects.filter(user=user).values_list('customer_id', flat=True).first()
+
+
+async def setup_stripe_subscription(external_cost, user, quantity):
+    """Same as StripeSubscriptionPlanCost.setup_subscription"""
+    customer_id = await sync_to_async(get_stripe_customer_id)(user)
+    if customer_id is None:
+        customer = await call_gateway(guarded_call, 'stripe', 'customer.create', stripe.Customer.create,
+                                      name=user.first_name + ' ' + user.last_name, email=user.email)
+        customer_id = customer.id
+        await sync_to_async(StripeCustomer.objects.create)(customer_id=customer_id, user=user)
+    session = await call_gateway(guarded_call, 'stripe', 'checkout.session.create', stripe.checkout.Session.create,
+                                 **external_cost.get_checkout_session_params(customer_id, quantity))
+    return {'session_id': session.id, 'cost_id': external_cost.cost_ref}
+
+
+def create_paypal_subscription(paypal, cost_ref, user):
+    return paypal.create_subscription(cost_ref, user.email, user.first_name, user.last_name,
+                                      return_url=auth['paypal']['SUCCESS_URL'],
+                                      cancel_url=auth['paypal']['CANCEL_URL'])
+
+
+async def setup_paypal_subscription(external_cost, user, quantity):
+    """Same as PaypalSubscriptionPlanCost.setup_subscription"""
+    paypal = get_async_paypal_client()
+    if paypal is None:
+        res = await call_gateway(lambda: create_paypal_subscription(get_paypal_client(), external_cost.cost_ref, user))
+    else:
+        res = await create_paypal_subscription(paypal, external_cost.cost_ref, user)
+    return await sync_to_async(external_cost.record_subscription)(user, quantity, res)
+
+
+GATEWAY_SETUPS = {
+    'stripe': setup_stripe_subscription,
+    'paypal': setup_paypal_subscription,
+}
+
+
+async def init_gateway_subscription(request, pk):
+    """Async PlanCostCryptoUserSubscriptionView.init_gateway_subscription"""
+    if request.method != 'POST':
+        return JsonResponse({'detail': 'Method "{}" not allowed.'.format(request.method)}, status=405)
+    try:
+        user, data = await sync_to_async(authenticate)(request)
+    except APIException as e:
+        return JsonResponse({'detail': str(e.detail)}, status=e.status_code)
+    if not user.is_authenticated:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=403)
+    gateway = data.get('gateway')
+    if gateway not in GATEWAY_SETUPS:
+        return JsonResponse({'detail': 'Unknown gateway {}'.format(gateway)}, status=400)
+    cost, external_cost = await sync_to_async(get_external_cost)(pk, gateway)
+    try:
+        qty = int(data.get('quantity', 1))
+    except (TypeError, ValueError):
+        return JsonResponse({'detail': 'Quantity must be an integer'}, status=400)
+    if qty < cost.min_subscription_quantity:
+        return JsonResponse({'detail': 'Quantity must not be less than {} to subscribe to this plan'.format(cost.min_subscription_quantity)},
+                            status=400)
+    try:
+        data = await GATEWAY_SETUPS[gateway](external_cost, user, qty)
+    except GatewayUnavailable as e:
+        return JsonResponse({'detail': str(e.detail)}, status=e.status_code)
+    return JsonResponse(data)
+
+
+init_gateway_subscription.csrf_exempt = True
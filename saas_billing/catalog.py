@@ -0,0 +1,166 @@
+"""In-memory index of the plan catalog and its gateway references.
+
+Plan costs, plans and the gateway cost_ref and plan_ref of every configured gateway are loaded with a few queries
+the first time they are looked up and kept per process. Saving or deleting any catalog row clears the index of
+this process and, once committed, bumps a version key in the GATEWAY_INDEX_CACHE django cache so other processes
+reload theirs. Lookups return new model instances, callers may change them freely.
+
+Rows written without signals, e.g. with bulk_create or update, are only seen after the next catalog change, lookups
+missing the index fall back to a query.
+"""
+import threading
+from uuid import uuid4
+from django.apps import apps
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from subscriptions_api.models import SubscriptionPlan, PlanCost
+from saas_billing.app_settings import SETTINGS
+
+billing_models = SETTINGS['billing_models']
+saas_billing_settings = SETTINGS['saas_billing_settings']
+
+VERSION_KEY = 'saas_billing:catalog:version'
+
+# Labels of the models the index is loaded from, a change to any of their rows invalidates it
+CATALOG_MODELS = {'subscriptions_api.subscriptionplan', 'subscriptions_api.plancost'} | {
+    gateway_models[model_type].lower() for gateway_models in billing_models.values() for model_type in ('plan', 'cost')
+    if model_type in gateway_models}
+
+_index = None
+_lock = threading.Lock()
+
+
+class ModelRows():
+    """Field values of the rows of a model by primary key, turned back into instances on lookup"""
+
+    def __init__(self, queryset, key=None):
+        self.model = queryset.model
+        self.db = queryset.db
+        self.fields = [field.attname for field in self.model._meta.concrete_fields]
+        position = self.fields.index(key or self.model._meta.pk.attname)
+        self.rows = {row[position]: row for row in queryset.values_list(*self.fields)}
+
+    def get(self, key):
+        row = self.rows.get(key)
+        if row is not None:
+            return self.model.from_db(self.db, self.fields, row)
+
+    def values(self, field):
+        position = self.fields.index(field)
+        return {key: row[position] for key, row in self.rows.items()}
+
+
+class GatewayIndex():
+
+    def __init__(self, version=None):
+        self.version = version
+        self.plans = ModelRows(SubscriptionPlan.objects.all())
+        self.costs = ModelRows(PlanCost.objects.all())
+        self.external_costs = {}
+        # Both directions for each gateway, plan cost id <-> cost_ref and plan id <-> plan_ref
+        self.cost_refs, self.cost_ids, self.plan_refs, self.plan_ids = {}, {}, {}, {}
+        for gateway, gateway_models in billing_models.items():
+            if 'cost' in gateway_models:
+                external_costs = ModelRows(apps.get_model(gateway_models['cost']).objects.all(), 'cost_id')
+                self.external_costs[gateway] = external_costs
+                self.cost_refs[gateway] = {key: ref for key, ref in external_costs.values('cost_ref').items() if ref}
+                self.cost_ids[gateway] = {ref: key for key, ref in self.cost_refs[gateway].items()}
+            if 'plan' in gateway_models:
+                plans = apps.get_model(gateway_models['plan']).objects.exclude(plan_ref=None).exclude(plan_ref='')
+                self.plan_refs[gateway] = dict(plans.values_list('plan_id', 'plan_ref'))
+                self.plan_ids[gateway] = {ref: key for key, ref in self.plan_refs[gateway].items()}
+
+    def get_cost(self, cost_id):
+        """Plan cost with its plan, None when not indexed"""
+        cost = self.costs.get(cost_id)
+        if cost is not None:
+            cost.plan = self.plans.get(cost.plan_id)
+        return cost
+
+    def get_external_cost(self, gateway, cost_id):
+        """Gateway cost of the plan cost, None when not indexed"""
+        external_costs = self.external_costs.get(gateway)
+        return external_costs and external_costs.get(cost_id)
+
+
+def get_index_cache():
+    """Django cache holding the index version shared by processes, None when the index is only kept per process"""
+    alias = saas_billing_settings['GATEWAY_INDEX_CACHE']
+    return caches[alias] if alias else None
+
+
+def get_version():
+    cache = get_index_cache()
+    if cache is None:
+        return None
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def get_index():
+    """Index of the current catalog, loaded on first use and after every catalog change"""
+    global _index
+    version = get_version()
+    index = _index
+    if index is None or index.version != version:
+        with _lock:
+            index = _index
+            if index is None or index.version != version:
+                # Holding the lock while loading makes a concurrent clear wait and drop what was loaded
+                index = _index = GatewayIndex(version)
+    return index
+
+
+def get_external_cost(gateway, cost):
+    """Same as Model.objects.get(cost=cost) for the cost model of gateway, cost is a PlanCost or its pk"""
+    Model = apps.get_model(billing_models[gateway]['cost'])
+    cost_id = getattr(cost, 'pk', cost)
+    index = get_index()
+    external_cost = index.get_external_cost(gateway, cost_id)
+    if external_cost is None:
+        return Model.objects.get(cost=cost)
+    external_cost.cost = cost if isinstance(cost, PlanCost) else index.get_cost(cost_id)
+    return external_cost
+
+
+def get_cost(gateway, cost_ref):
+    """Same as Model.objects.get(cost_ref=cost_ref).cost for the cost model of gateway"""
+    index = get_index()
+    cost_id = index.cost_ids.get(gateway, {}).get(cost_ref)
+    cost = index.get_cost(cost_id) if cost_id is not None else None
+    if cost is None:
+        Model = apps.get_model(billing_models[gateway]['cost'])
+        return Model.objects.select_related('cost__plan').get(cost_ref=cost_ref).cost
+    return cost
+
+
+def clear():
+    """Drop the index of this process"""
+    global _index
+    with _lock:
+        _index = None
+
+
+def invalidate():
+    """Drop the index of every process"""
+    clear()
+    cache = get_index_cache()
+    if cache is not None:
+        cache.set(VERSION_KEY, uuid4().hex, None)
+
+
+def catalog_changed(sender, using=None, **kwargs):
+    clear()
+    transaction.on_commit(invalidate, using=using)
+
+
+def connect_signals():
+    """Invalidate the index on saves and deletes of the catalog models, called once the app registry is ready"""
+    for label in CATALOG_MODELS:
+        Model = apps.get_model(label)
+        post_save.connect(catalog_changed, sender=Model, dispatch_uid='saas_billing_catalog_saved.' + label)
+        post_delete.connect(catalog_changed, sender=Model, dispatch_uid='saas_billing_catalog_deleted.' + label)
@@ -0,0 +1,161 @@
+"""Circuit breakers for payment gateway calls.
+
+There is one breaker per gateway and operation, e.g. ('paypal', 'create_subscription'). A breaker opens when at
+least CIRCUIT_FAILURE_RATE of its last CIRCUIT_WINDOW calls failed or took longer than CIRCUIT_SLOW_SECONDS, calls
+then fail fast with GatewayUnavailable. After CIRCUIT_OPEN_SECONDS one probe call is let through, its outcome
+closes or opens the breaker again.
+
+Breaker states are published as instrumentation states named circuit.<gateway>.<operation>.
+"""
+import time
+import threading
+import functools
+from collections import deque
+import stripe
+import requests
+from rest_framework.exceptions import APIException
+from saas_billing import instrumentation
+from saas_billing.app_settings import SETTINGS
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+saas_billing_settings = SETTINGS['saas_billing_settings']
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+# Errors meaning the gateway is unreachable or failing, other errors are answers of a working gateway.
+# Of the errors carrying an http response only 5xx and 429 answers are failures.
+GATEWAY_ERRORS = {
+    'paypal': (requests.RequestException,) + ((httpx.HTTPError,) if httpx else ()),
+    'stripe': (stripe.error.APIConnectionError, stripe.error.APIError, stripe.error.RateLimitError),
+}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class GatewayUnavailable(APIException):
+    status_code = 503
+    default_detail = 'Payment gateway is temporarily unavailable, try again later.'
+    default_code = 'gateway_unavailable'
+
+
+class CircuitBreaker():
+
+    def __init__(self, gateway, operation):
+        self.gateway = gateway
+        self.operation = operation
+        self.name = 'circuit.{}.{}'.format(gateway, operation)
+        self.errors = GATEWAY_ERRORS.get(gateway, ())
+        self.window = deque(maxlen=saas_billing_settings['CIRCUIT_WINDOW'])
+        self.state = STATE_CLOSED
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+        instrumentation.set_state(self.name, self.state)
+
+    def set_state(self, state):
+        self.state = state
+        self.window.clear()
+        self.probing = False
+        if state == STATE_OPEN:
+            self.opened_at = time.monotonic()
+        instrumentation.set_state(self.name, state)
+
+    def before_call(self):
+        """Raise GatewayUnavailable unless the call may go to the gateway"""
+        with self.lock:
+            if self.state == STATE_OPEN:
+                if time.monotonic() - self.opened_at < saas_billing_settings['CIRCUIT_OPEN_SECONDS']:
+                    instrumentation.increment(self.name + '.rejected')
+                    raise GatewayUnavailable()
+                self.set_state(STATE_HALF_OPEN)
+            if self.state == STATE_HALF_OPEN:
+                if self.probing:
+                    instrumentation.increment(self.name + '.rejected')
+                    raise GatewayUnavailable()
+                self.probing = True
+
+    def after_call(self, failed, seconds):
+        instrumentation.record_timing('gateway.{}.{}'.format(self.gateway, self.operation), seconds)
+        failed = failed or seconds > saas_billing_settings['CIRCUIT_SLOW_SECONDS']
+        with self.lock:
+            if self.state == STATE_HALF_OPEN:
+                self.set_state(STATE_OPEN if failed else STATE_CLOSED)
+                return
+            if self.state == STATE_OPEN:
+                return
+            self.window.append(failed)
+            enough_calls = len(self.window) >= saas_billing_settings['CIRCUIT_MIN_CALLS']
+            if enough_calls and sum(self.window) >= saas_billing_settings['CIRCUIT_FAILURE_RATE'] * len(self.window):
+                self.set_state(STATE_OPEN)
+
+    def is_failure(self, error):
+        if not isinstance(error, self.errors):
+            return False
+        response = getattr(error, 'response', None)
+        return response is None or response.status_code >= 500 or response.status_code == 429
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        start = time.monotonic()
+        failed = True
+        try:
+            res = func(*args, **kwargs)
+            failed = False
+            return res
+        except Exception as e:
+            failed = self.is_failure(e)
+            raise
+        finally:
+            self.after_call(failed, time.monotonic() - start)
+
+    async def acall(self, func, *args, **kwargs):
+        """Same as call for a coroutine function"""
+        self.before_call()
+        start = time.monotonic()
+        failed = True
+        try:
+            res = await func(*args, **kwargs)
+            failed = False
+            return res
+        except Exception as e:
+            failed = self.is_failure(e)
+            raise
+        finally:
+            self.after_call(failed, time.monotonic() - start)
+
+
+def get_breaker(gateway, operation):
+    breaker = _breakers.get((gateway, operation))
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault((gateway, operation), CircuitBreaker(gateway, operation))
+    return breaker
+
+
+def guarded_call(gateway, operation, func, *args, **kwargs):
+    """Call func through the breaker of gateway and operation"""
+    return get_breaker(gateway, operation).call(func, *args, **kwargs)
+
+
+def guarded(gateway, operation=None):
+    """Decorator calling the function through a breaker, operation defaults to the function name"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return guarded_call(gateway, operation or func.__name__, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def reset():
+    """Close all breakers"""
+    with _breakers_lock:
+        _breakers.clear()
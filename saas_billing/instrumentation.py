@@ -0,0 +1,62 @@
+"""Process local counters and timings of billing operations.
+
+Values are kept per process, read them with get_stats, e.g. from a management command or a health view,
+or connect to the metric_recorded signal to forward them to a metrics backend.
+"""
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from django.dispatch import Signal
+
+# Sent with name, kind ('counter', 'timing' or 'state') and value
+metric_recorded = Signal()
+
+_lock = threading.Lock()
+_counters = Counter()
+_timings = {}
+_states = {}
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+    metric_recorded.send(sender=None, name=name, kind='counter', value=value)
+
+
+def record_timing(name, seconds):
+    with _lock:
+        timing = _timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+    metric_recorded.send(sender=None, name=name, kind='timing', value=seconds)
+
+
+def set_state(name, value):
+    with _lock:
+        _states[name] = value
+    metric_recorded.send(sender=None, name=name, kind='state', value=value)
+
+
+@contextmanager
+def timed(name):
+    """Record the wall time of the block under name, also when it raises"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_timing(name, time.monotonic() - start)
+
+
+def get_stats():
+    with _lock:
+        return {'counters': dict(_counters), 'timings': {name: dict(timing) for name, timing in _timings.items()},
+                'states': dict(_states)}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+        _states.clear()
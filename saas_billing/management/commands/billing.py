@@ -1,8 +1,35 @@
-from django.core.management.base import BaseCommand
+import time
+import threading
+from functools import partial
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
 from django.apps import apps
+from django.db import connection
 from saas_billing.app_settings import SETTINGS
 from subscriptions_api.models import SubscriptionPlan, PlanCost
 
+RESULTS = ['created', 'updated', 'skipped', 'failed']
+
+
+class RateLimiter():
+    """Space calls of all threads at least 1 / rate seconds apart, no limit when rate is 0"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
 
 class Command(BaseCommand):
     help = 'Create and update subscription plans and cost on stripe and paypal'
@@ -16,22 +43,11 @@ class Command(BaseCommand):
         parser.add_argument('gateway', choices=self.gateways)
         parser.add_argument('--model', choices=self.model)
         parser.add_argument('--action', choices=self.action)
-
-    def create_external_obj(self, model_class, action=None, data=None):
-        obj, created = model_class.objects.get_or_create(**data)
-        if action == 'activate':
-            obj.activate()
-        elif action == 'deactivate':
-            obj.deactivate()
-        else:
-            obj.create_or_update()
-            obj.save()
-
-        self.stdout.write(self.style.SUCCESS('Successfully created %s' % obj))
-
-    def run_create(self, model_type_obj, external_model, action, data_type):
-        for obj in model_type_obj.objects.all():
-            self.create_external_obj(external_model, action=action, data={data_type: obj})
+        parser.add_argument('--workers', type=int, default=4, help='Number of threads calling the gateways')
+        parser.add_argument('--rate', type=float, default=10,
+                            help='Maximum calls per second to one gateway, 0 for no limit')
+        parser.add_argument('--force', action='store_true',
+                            help='Also push objects whose data did not change since the last sync')
 
     def get_model_type_obj(self, model_type):
         if model_type == 'cost':
@@ -41,28 +57,92 @@ class Command(BaseCommand):
         else:
             return
 
-    def generate_gateway_model(self, gate_model_str, model_type, action):
-        model_type_obj = self.get_model_type_obj(model_type)
-        if model_type_obj is None:
-            return
-        gateway_model_obj = apps.get_model(gate_model_str)
-        self.run_create(model_type_obj, gateway_model_obj, action, model_type)
+    def get_related(self, gateway_models, model_type):
+        """Relations create_or_update reads, so worker threads do not query them one by one"""
+        if model_type == 'plan':
+            return ['plan']
+        related = ['cost__plan']
+        if 'plan' in gateway_models:
+            plan_model = apps.get_model(gateway_models['plan'])
+            related.append('cost__plan__' + plan_model._meta.get_field('plan').related_query_name())
+        return related
+
+    def get_external_objs(self, model_class, model_type, related):
+        """Return the gateway objects of all plans or costs, the missing ones are created in bulk"""
+        field = model_class._meta.get_field(model_type)
+        existing = model_class.objects.values_list(field.attname, flat=True)
+        missing = self.get_model_type_obj(model_type).objects.exclude(pk__in=existing)
+        model_class.objects.bulk_create([model_class(**{model_type: obj}) for obj in missing], ignore_conflicts=True)
+        return list(model_class.objects.select_related(*related).order_by('pk'))
 
-    def get_model_type(self, model_type, gateway_model, action):
-        if model_type:
-            model_str = gateway_model[model_type.lower()]
-            self.generate_gateway_model(model_str, model_type, action)
+    def sync_obj(self, obj, model_type, action, force, limiter):
+        """Push obj to its gateway, returns one of RESULTS"""
+        if action is None and not force and hasattr(obj, 'needs_sync') and not obj.needs_sync():
+            return 'skipped'
+        ref_field = 'cost_ref' if model_type == 'cost' else 'plan_ref'
+        had_ref = bool(getattr(obj, ref_field, None))
+        limiter.wait()
+        try:
+            if action == 'activate':
+                obj.activate()
+            elif action == 'deactivate':
+                obj.deactivate()
+            else:
+                if obj.create_or_update() is None:
+                    # Nothing was pushed, keep the old hash so the change is synced once possible
+                    reason = obj.get_skip_reason() if hasattr(obj, 'get_skip_reason') else None
+                    self.stdout.write('Skipped %s: %s' % (obj, reason or 'nothing pushed to the gateway'))
+                    return 'skipped'
+                if hasattr(obj, 'mark_synced'):
+                    obj.mark_synced()
+        except Exception as e:
+            self.stderr.write('Failed to sync %s: %r' % (obj, e))
+            return 'failed'
+        result = 'updated' if had_ref or not getattr(obj, ref_field, None) else 'created'
+        self.stdout.write(self.style.SUCCESS('Successfully %s %s' % (result, obj)))
+        return result
+
+    def sync_objs(self, objs, model_type, action, force, limiter, close_connection=False):
+        counts = Counter()
+        try:
+            for obj in objs:
+                counts[self.sync_obj(obj, model_type, action, force, limiter)] += 1
+        finally:
+            if close_connection:
+                # Worker threads open their own connection
+                connection.close()
+        return counts
+
+    def run_create(self, gateway, gateway_models, model_type, options):
+        start = time.monotonic()
+        model_class = apps.get_model(gateway_models[model_type])
+        objs = self.get_external_objs(model_class, model_type, self.get_related(gateway_models, model_type))
+        sync = partial(self.sync_objs, model_type=model_type, action=options['action'], force=options['force'],
+                       limiter=RateLimiter(options['rate']))
+        workers = min(options['workers'], len(objs))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(partial(sync, close_connection=True), [objs[i::workers] for i in range(workers)])
+                counts = sum(results, Counter())
         else:
-            for model_type, gateway_model in gateway_model.items():
-                self.generate_gateway_model(gateway_model, model_type, action)
+            counts = sync(objs)
+        self.stdout.write('%s %s %s in %.2fs' % (gateway, model_type, ' '.join(
+            '%s=%s' % (result, counts[result]) for result in RESULTS), time.monotonic() - start))
+        return counts
 
     def handle(self, *args, **options):
         gateway = options['gateway']
-        model_type = options.get('model')
-        action = options.get('action')
-        if gateway == 'all':
-            for billing_model, gateway_model in self.billing_models.items():
-                self.get_model_type(model_type, gateway_model, action)
-        else:
-            gateway_model = self.billing_models[gateway]
-            self.get_model_type(model_type, gateway_model, action)
+        gateways = self.billing_models.keys() if gateway == 'all' else [gateway]
+        model_types = [options['model']] if options['model'] else self.model
+        totals = Counter()
+        start = time.monotonic()
+        for gateway in gateways:
+            gateway_models = self.billing_models[gateway]
+            # Plans first, costs are created under the plan of their gateway
+            for model_type in model_types:
+                if model_type in gateway_models:
+                    totals += self.run_create(gateway, gateway_models, model_type, options)
+        self.stdout.write(self.style.SUCCESS('Synced gateways %s in %.2fs' % (
+            ' '.join('%s=%s' % (result, totals[result]) for result in RESULTS), time.monotonic() - start)))
+        if totals['failed']:
+            raise CommandError('%s objects failed to sync' % totals['failed'])
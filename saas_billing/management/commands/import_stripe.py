@@ -0,0 +1,220 @@
+import time
+import stripe
+from collections import Counter
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import Lower
+from django.utils import timezone
+from saas_billing.app_settings import SETTINGS
+from saas_billing.circuit import guarded_call
+from saas_billing import catalog
+from saas_billing.models import StripeCustomer, StripeSubscription, UserSubscription
+from saas_billing.reconcile import from_timestamp, get_stripe_state
+from saas_billing.management.commands.reconcile_stripe import STRIPE_STATUSES, iter_pages
+
+saas_billing_settings = SETTINGS['saas_billing_settings']
+
+
+def get_price_id(data):
+    items = (data.get('items') or {}).get('data') or [{}]
+    price = items[0].get('price') or data.get('plan') or {}
+    return price.get('id')
+
+
+def get_created(data):
+    return data.get('created') or data.get('start_date') or 0
+
+
+class Command(BaseCommand):
+    help = 'Create the local billing rows of the customers and subscriptions of an existing stripe account'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--status', choices=STRIPE_STATUSES, default='all',
+                            help='Only import stripe subscriptions with this status')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of stripe objects matched and inserted per page')
+
+    def load_customers(self):
+        """Local user id of every linked stripe customer id"""
+        return dict(StripeCustomer.objects.exclude(customer_id=None).values_list('customer_id', 'user_id'))
+
+    def load_costs(self):
+        """Plan cost of every stripe price id"""
+        index = catalog.get_index()
+        return {cost_ref: index.get_cost(cost_id) for cost_ref, cost_id in index.cost_ids.get('stripe', {}).items()}
+
+    def import_customers(self, page, customers):
+        """Link the stripe customers of page to the local users with the same email"""
+        page = [customer.to_dict() for customer in page]
+        counts = Counter({'fetched': len(page)})
+        counts['existing'] += sum(1 for customer in page if customer['id'] in customers)
+        emails = {customer['id']: customer['email'].lower() for customer in page
+                  if customer['id'] not in customers and customer.get('email')}
+        users = {}
+        # Of several users with one email the oldest gets the stripe customer
+        for pk, email in get_user_model().objects.annotate(email_lower=Lower('email')).filter(
+                email_lower__in=set(emails.values())).order_by('-pk').values_list('pk', 'email_lower'):
+            users[email] = pk
+        linked = set(StripeCustomer.objects.filter(user_id__in=users.values()).values_list('user_id', flat=True))
+        new = []
+        for customer_id, email in emails.items():
+            user_id = users.get(email)
+            if user_id is None or user_id in linked:
+                continue
+            linked.add(user_id)
+            new.append(StripeCustomer(user_id=user_id, customer_id=customer_id))
+        StripeCustomer.objects.bulk_create(new, ignore_conflicts=True)
+        # Rows another process inserted first are ignored, read back what was stored
+        created = dict(StripeCustomer.objects.filter(customer_id__in=emails).values_list('customer_id', 'user_id'))
+        customers.update(created)
+        counts['created'] += len(created)
+        counts['unmatched'] += len(page) - counts['existing'] - len(created)
+        return counts
+
+    def get_reusable_subscriptions(self, new):
+        """Local subscriptions without stripe subscription of the (user id, plan cost) of new, by both.
+
+        Same as setup_user_subscription(resuse=True) in StripeCustomer.get_or_create_subscription.
+        """
+        reusable = {}
+        subscriptions = UserSubscription.objects.filter(
+            user_id__in={user_id for data, user_id, cost in new}, plan_cost__in={cost for data, user_id, cost in new},
+            stripe_subscription=None)
+        for subscription in subscriptions:
+            reusable.setdefault((subscription.user_id, subscription.plan_cost_id), subscription)
+        return reusable
+
+    def keep_newest_active(self, activated, kept):
+        """Split activated, pairs of (subscription, stripe creation time), into the subscriptions left active and the
+        ones replaced by a newer active subscription of their user.
+
+        With NO_MULTIPLE_SUBSCRIPTION only the newest active stripe subscription of a user stays active. kept holds
+        the creation time of the subscription left active for each user by the pages imported before.
+        """
+        if not saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION']:
+            return [subscription for subscription, created in activated], []
+        newest = {}
+        for subscription, created in activated:
+            if subscription.user_id not in newest or created > newest[subscription.user_id][1]:
+                newest[subscription.user_id] = (subscription, created)
+        active = []
+        for user_id, (subscription, created) in newest.items():
+            if user_id in kept and kept[user_id] >= created:
+                continue
+            kept[user_id] = created
+            active.append(subscription)
+        kept_ids = {id(subscription) for subscription in active}
+        return active, [subscription for subscription, created in activated if id(subscription) not in kept_ids]
+
+    def get_previous_subscriptions(self, activated, imported):
+        """Active subscriptions of the users of activated that these replace, as in UserSubscription.activate"""
+        if not saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION'] or not activated:
+            return []
+        return list(UserSubscription.objects.filter(
+            active=True, user__in={subscription.user_id for subscription in activated}
+        ).exclude(pk__in=[subscription.pk for subscription in imported]).select_related('plan_cost__plan__group'))
+
+    @transaction.atomic
+    def import_subscriptions(self, page, customers, costs, kept):
+        """Create and link the local subscriptions of page in one transaction.
+
+        Stripe subscriptions linked by another process since the check for existing links make the whole page fail
+        instead of leaving local subscriptions without link.
+        """
+        counts = Counter({'fetched': len(page)})
+        data = {sub['id']: sub.to_dict() for sub in page}
+        existing = set(StripeSubscription.objects.filter(subscription_ref__in=data).values_list(
+            'subscription_ref', flat=True))
+        counts['existing'] += len(existing)
+        new = []
+        for subscription_ref, sub in data.items():
+            if subscription_ref in existing:
+                continue
+            user_id = customers.get(sub['customer'])
+            cost = costs.get(get_price_id(sub))
+            if user_id is None:
+                counts['unknown_customer'] += 1
+            elif cost is None:
+                counts['unknown_price'] += 1
+            else:
+                new.append((sub, user_id, cost))
+        reusable = self.get_reusable_subscriptions(new)
+        created, reused, activated, links = [], [], [], []
+        for sub, user_id, cost in new:
+            subscription = reusable.pop((user_id, cost.pk), None)
+            if subscription is None:
+                subscription = UserSubscription(user_id=user_id, plan_cost=cost, active=False, cancelled=False)
+                created.append(subscription)
+            else:
+                subscription.plan_cost = cost
+                reused.append(subscription)
+            subscription.reference = 'stripe'
+            subscription.date_billing_start = from_timestamp(sub.get('start_date'))
+            for field, value in get_stripe_state(sub).items():
+                setattr(subscription, field, value)
+            if subscription.active and subscription.date_billing_next:
+                subscription.date_billing_end = subscription.date_billing_next + timedelta(days=cost.plan.grace_period)
+            if subscription.active:
+                activated.append((subscription, get_created(sub)))
+            links.append(StripeSubscription(subscription=subscription, subscription_ref=sub['id']))
+        activated, duplicates = self.keep_newest_active(activated, kept)
+        previous = self.get_previous_subscriptions(activated, created + reused)
+        date = timezone.now()
+        for subscription in duplicates:
+            subscription.active = False
+            subscription.cancelled = True
+            subscription.due = False
+            subscription.date_billing_last = date
+        for subscription in previous:
+            subscription.active = False
+            subscription.cancelled = True
+            subscription.due = False
+            subscription.date_billing_last = date
+            subscription._remove_user_from_group()
+        memberships = [Group.user_set.through(group_id=subscription.plan_cost.plan.group_id, user_id=subscription.user_id)
+                       for subscription in activated if subscription.plan_cost.plan.group_id]
+        UserSubscription.objects.bulk_create(created)
+        UserSubscription.objects.bulk_update(reused, ['reference', 'date_billing_start', 'active', 'cancelled', 'due',
+                                                      'quantity', 'date_billing_next', 'date_billing_end',
+                                                      'date_billing_last'])
+        UserSubscription.objects.bulk_update(previous, ['active', 'cancelled', 'due', 'date_billing_last'])
+        StripeSubscription.objects.bulk_create(links)
+        Group.user_set.through.objects.bulk_create(memberships, ignore_conflicts=True)
+        counts['created'] += len(links)
+        counts['activated'] += len(activated)
+        counts['replaced'] += len(previous) + len(duplicates)
+        return counts
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        batch_size = options['batch_size']
+        customers = self.load_customers()
+        costs = self.load_costs()
+        customer_counts = Counter()
+        for page in iter_pages(guarded_call('stripe', 'customer.list', stripe.Customer.list,
+                                            limit=min(batch_size, 100)).auto_paging_iter(), batch_size):
+            customer_counts += self.import_customers(page, customers)
+            self.stdout.write('Imported %s stripe customers' % customer_counts['fetched'])
+        subscription_counts = Counter()
+        kept = {}
+        subscriptions = guarded_call('stripe', 'subscription.list', stripe.Subscription.list, status=options['status'],
+                                     limit=min(batch_size, 100))
+        for page in iter_pages(subscriptions.auto_paging_iter(), batch_size):
+            subscription_counts += self.import_subscriptions(page, customers, costs, kept)
+            self.stdout.write('Imported %s stripe subscriptions' % subscription_counts['fetched'])
+        elapsed = time.monotonic() - start
+        fetched = customer_counts['fetched'] + subscription_counts['fetched']
+        self.stdout.write('Customers fetched=%s created=%s existing=%s unmatched=%s' % (
+            customer_counts['fetched'], customer_counts['created'], customer_counts['existing'],
+            customer_counts['unmatched']))
+        self.stdout.write('Subscriptions fetched=%s created=%s existing=%s activated=%s replaced=%s '
+                          'unknown_customer=%s unknown_price=%s' % (
+                              subscription_counts['fetched'], subscription_counts['created'],
+                              subscription_counts['existing'], subscription_counts['activated'],
+                              subscription_counts['replaced'], subscription_counts['unknown_customer'],
+                              subscription_counts['unknown_price']))
+        self.stdout.write(self.style.SUCCESS('Imported stripe account in %.2fs (%.1f objects/s)' % (
+            elapsed, fetched / elapsed if elapsed else 0)))
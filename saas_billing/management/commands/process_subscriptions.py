@@ -1,77 +1,577 @@
 """Utility/helper functions for Django Flexible Subscriptions."""
+import os
+import json
+import time
+import socket
 import logging
-from django.db.models import Q
+import django
+from argparse import ArgumentTypeError
+from uuid import uuid4
+from decimal import Decimal
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Coalesce, Mod
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from datetime import timedelta
-from saas_billing.models import UserSubscription
-from saas_billing.models import auto_activate_subscription
+from saas_billing.models import UserSubscription, SubscriptionLease, BillingRun, SubscriptionCrypto, SubscriptionFailure
+from saas_billing.models import CreditBalance, auto_activate_subscription, to_amount
 from saas_billing.app_settings import SETTINGS
+from subscriptions_api.models import PlanCost
 
 billing_models = SETTINGS['billing_models']
 saas_billing_settings = SETTINGS['saas_billing_settings']
 payment_references = [key for key in billing_models.keys()]
+COMMAND_NAME = 'process_subscriptions'
+# Subscriptions are billed this long before their next billing date
+DUE_DAYS = timedelta(days=7)
 
 _logger = logging.getLogger(__name__)
 
+
+class QueryCounter():
+    """Database execute wrapper counting the queries run on a connection"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
 class Manager():
     """Manager object to help manage subscriptions & billing."""
 
-    def process_expired_subscriptions(self, date):
+    def __init__(self, batch_size=None, shard=None, lock=False, run=None, since=None):
+        """
+        :param batch_size: Number of subscriptions loaded per query
+        :param shard: Optional (index, count) tuple, only subscriptions of users whose id modulo count is index are processed
+        :param lock: Claim each batch before processing it so several runners can sweep at the same time
+        :param run: Optional BillingRun progress is checkpointed to, an unfinished run is continued from its checkpoint
+        :param since: Optional watermark, subscriptions whose billing dates were already handled at that date are skipped
+        """
+        self.batch_size = batch_size or saas_billing_settings['PROCESS_BATCH_SIZE']
+        self.shard = shard
+        self.lock = lock
+        self.run = run
+        self.since = since
+        self.runner_id = '{}:{}:{}'.format(socket.gethostname()[:40], os.getpid(), uuid4().hex)
+        self.stats = Counter(json.loads(run.counts)) if run else Counter()
+        self.timings = {}
+        self.queries = {}
+        self.phase = None
+
+    def filter_shard(self, queryset):
+        """Restrict queryset to this manager's shard, all subscriptions of a user always land in the same shard."""
+        if not self.shard:
+            return queryset
+        index, count = self.shard
+        return queryset.annotate(shard=Mod(Coalesce('user_id', Value(0)), count)).filter(shard=index)
+
+    def iter_batches(self, queryset):
+        """Yield lists of subscriptions from queryset paginated on the primary key.
+
+        Each page is a fresh query starting after the last key of the previous page, so memory stays
+        bounded by batch_size and rows that stop matching the filter while being processed are not skipped.
+        The last key is checkpointed to the run under the current phase after every batch.
+        """
+        queryset = self.filter_shard(queryset).select_related('user', 'plan_cost__plan__group').order_by('pk')
+        last_pk = None
+        if self.run:
+            if self.run.phase == self.phase:
+                last_pk = self.run.last_key
+            else:
+                self.run.checkpoint(self.phase, None, self.stats)
+        while True:
+            page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            with self.claim_batch(page) as (batch, last_key):
+                if last_key is None:
+                    return
+                if batch:
+                    yield batch
+            last_pk = last_key
+            if self.run:
+                self.run.checkpoint(self.phase, last_pk, self.stats)
+
+    @contextmanager
+    def claim_batch(self, page):
+        """Load the next batch of page and hold it while the caller processes it.
+
+        The batch is processed in one transaction. Without lock the batch is simply read. With lock, rows are locked with SELECT ... FOR UPDATE SKIP LOCKED
+        until the batch transaction commits, rows locked by another runner are left to that runner. Databases without
+        SKIP LOCKED use SubscriptionLease rows instead, a lease left by a crashed runner is taken over once it expires.
+        Yields the claimed subscriptions and the last key scanned, None when page is exhausted.
+        """
+        if not self.lock:
+            with transaction.atomic():
+                batch = list(page[:self.batch_size])
+                yield batch, batch[-1].pk if batch else None
+        elif connection.features.has_select_for_update_skip_locked:
+            of = ('self',) if connection.features.has_select_for_update_of else ()
+            with transaction.atomic():
+                batch = list(page.select_for_update(skip_locked=True, of=of)[:self.batch_size])
+                yield batch, batch[-1].pk if batch else None
+        else:
+            # Leases are committed before the batch transaction starts so other runners can see them
+            keys = list(page.values_list('pk', flat=True)[:self.batch_size])
+            batch = self.acquire_leases(page, keys) if keys else []
+            with transaction.atomic():
+                yield batch, keys[-1] if keys else None
+            SubscriptionLease.objects.filter(owner=self.runner_id, subscription__in=batch).delete()
+
+    def acquire_leases(self, page, keys):
+        now = timezone.now()
+        expires_at = now + timedelta(seconds=saas_billing_settings['PROCESS_LEASE_SECONDS'])
+        SubscriptionLease.objects.filter(subscription__in=keys, expires_at__lte=now).delete()
+        SubscriptionLease.objects.bulk_create([
+            SubscriptionLease(subscription_id=key, owner=self.runner_id, expires_at=expires_at) for key in keys
+        ], ignore_conflicts=True)
+        leased = SubscriptionLease.objects.filter(subscription__in=keys, owner=self.runner_id).values('subscription_id')
+        # Filter again, another runner may have processed the row before its lease was released
+        return list(page.filter(pk__in=leased))
+
+    @contextmanager
+    def isolate(self, subscription, phase):
+        """Process subscription in its own savepoint, a failure is rolled back and recorded for retry
+        instead of aborting the batch."""
+        try:
+            with transaction.atomic():
+                yield
+        except Exception as e:
+            _logger.exception("Failed to process %s subscription %s", phase, subscription.pk)
+            failure, created = SubscriptionFailure.objects.get_or_create(subscription=subscription, phase=phase,
+                                                                         defaults={'error': repr(e)})
+            if not created:
+                SubscriptionFailure.objects.filter(pk=failure.pk).update(
+                    error=repr(e), attempts=F('attempts') + 1, updated_at=timezone.now())
+            self.stats['failed'] += 1
+
+    def filter_since(self, queryset, phase, date_field, offset=timedelta()):
+        """Restrict queryset to rows whose date_field is past the watermark plus offset and rows that failed
+        in phase on an earlier run"""
+        if not self.since:
+            return queryset
+        failed = SubscriptionFailure.objects.filter(phase=phase).values('subscription_id')
+        return queryset.filter(Q(**{date_field + '__gt': self.since + offset}) | Q(pk__in=failed))
+
+    def get_due_offset(self, date):
+        """Watermark offset of the due phase, 7 days or the shortest billing period when plans renew faster.
+
+        A subscription activated after the watermark is next billed one period later, with daily plans that is
+        before the watermark plus 7 days and it would never be scanned again.
+        """
+        periods = [next_date - date for next_date in (cost.next_billing_datetime(date) for cost in PlanCost.objects.all())
+                   if next_date is not None]
+        return min(periods + [DUE_DAYS])
+
+    def clear_failures(self, subscriptions, phase):
+        if subscriptions:
+            SubscriptionFailure.objects.filter(subscription__in=subscriptions, phase=phase).delete()
+
+    def deactivate(self, subscription, date):
+        """Same as UserSubscription.deactivate but leaves writing the row to a bulk update, activate the default
+        subscription with activate_defaults once it is written."""
+        subscription.active = False
+        subscription.cancelled = True
+        subscription.due = False
+        subscription.date_billing_last = date
+        subscription._remove_user_from_group()
+
+    def activate_defaults(self, subscriptions):
+        """Put the users of the deactivated subscriptions back on the default plan.
+
+        Runs after the bulk update, the default subscription can be the row that was just deactivated. Failures are
+        recorded in the default phase, which retries them on the next runs. Returns the subscriptions whose users
+        got the default plan.
+        """
+        activated = []
+        for subscription in subscriptions:
+            with self.isolate(subscription, 'default'):
+                subscription.plan_cost.activate_default_user_subscription(subscription.user)
+                activated.append(subscription)
+        self.clear_failures(activated, 'default')
+        return activated
+
+    def get_expired_subscriptions(self, date):
         expired_subscriptions = UserSubscription.objects.filter(
             Q(active=True) & Q(cancelled=False)
             & Q(date_billing_end__lte=date)
         ).exclude(reference__in=payment_references)
-        _logger.info("Gotten %s expired_subscriptions ", expired_subscriptions.count())
-        for subscription in expired_subscriptions.all():
-            subscription.deactivate(activate_default=True)
-            _logger.info("Deactivating expired subscription %s for user %s ", subscription, subscription.user)
-            subscription.notify_expired()
+        expired_subscriptions = self.filter_since(expired_subscriptions, 'expired', 'date_billing_end')
+        return expired_subscriptions
 
-    def process_one_week_due_subscriptions(self, date):
-        date = date + timedelta(days=7)
+    def get_due_subscriptions(self, date):
+        """Subscriptions billed in the due phase, those whose next billing date is at most DUE_DAYS after date"""
+        date = date + DUE_DAYS
         due_subscriptions = UserSubscription.objects.filter(
             Q(active=True) & Q(due=False)
             & Q(date_billing_next__lte=date)
-        ).exclude(reference__in=payment_references)
-        _logger.info("Gotten %s 1 week due subscription ", due_subscriptions.count())
-        for subscription in due_subscriptions.all():
-
-            transaction = auto_activate_subscription(subscription, amount=subscription.plan_cost.cost,
-                                                     transaction_date=subscription.date_billing_next)
-            if transaction.amount <= 0:
-                subscription.activate(subscription_date=subscription.date_billing_next, no_multiple_subscription=saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION'])
-                subscription.notify_activate(auto=True)
-                _logger.info("Auto activating subscription %s for user %s for date %s",subscription, subscription.user, subscription.date_billing_next )
-            else:
-                crypto = self.get_previous_transaction_crypto(subscription, )
-                transaction.create_payment(crypto or "BITCOIN")
-                subscription.due = True
-                subscription.notify_overdue()
-                _logger.info("Generating crypto payment for due subscription %s for user %s", subscription, subscription.user)
-            subscription.save()
+        ).exclude(reference__in=payment_references).select_related('last_crypto')
+        due_subscriptions = self.filter_since(due_subscriptions, 'due', 'date_billing_next', self.get_due_offset(date))
+        return due_subscriptions
 
-    def process_new_subscriptions(self, date):
-        UserSubscription.objects.filter(
+    def get_new_subscriptions(self, date):
+        new_subscriptions = UserSubscription.objects.filter(
             Q(active=False) & Q(cancelled=False)
             & Q(date_billing_start__lte=date
                 )
         ).exclude(reference__in=payment_references)
+        new_subscriptions = self.filter_since(new_subscriptions, 'new', 'date_billing_start')
+        return new_subscriptions
+
+    def process_expired_subscriptions(self, date):
+        expired_subscriptions = self.get_expired_subscriptions(date)
+        for batch in self.iter_batches(expired_subscriptions):
+            expired = []
+            for subscription in batch:
+                with self.isolate(subscription, 'expired'):
+                    self.deactivate(subscription, date)
+                    _logger.info("Deactivating expired subscription %s for user %s ", subscription, subscription.user)
+                    subscription.notify_expired()
+                    expired.append(subscription)
+            UserSubscription.objects.bulk_update(expired, ['active', 'cancelled', 'due', 'date_billing_last'])
+            self.clear_failures(expired, 'expired')
+            self.activate_defaults(expired)
+            self.stats['expired'] += len(expired)
+        _logger.info("Processed %s expired_subscriptions ", self.stats['expired'])
+
+    def get_default_candidates(self):
+        """Deactivated subscriptions whose users could not be put back on the default plan"""
+        failed = SubscriptionFailure.objects.filter(phase='default').values('subscription_id')
+        return UserSubscription.objects.filter(pk__in=failed, active=False)
+
+    def process_default_subscriptions(self, date):
+        """Retry the default plan activations that failed after a deactivation, whatever the watermark.
+
+        Users that got another active subscription meanwhile are left on it.
+        """
+        for batch in self.iter_batches(self.get_default_candidates()):
+            active_users = set(UserSubscription.objects.filter(
+                active=True, user__in={subscription.user_id for subscription in batch}).values_list('user_id', flat=True))
+            self.clear_failures([subscription for subscription in batch if subscription.user_id in active_users],
+                                'default')
+            activated = self.activate_defaults([subscription for subscription in batch
+                                                if subscription.user_id not in active_users])
+            self.stats['default'] += len(activated)
+        _logger.info("Processed %s default subscriptions ", self.stats['default'])
+
+    def process_one_week_due_subscriptions(self, date):
+        due_subscriptions = self.get_due_subscriptions(date)
+        for batch in self.iter_batches(due_subscriptions):
+            activated_subscriptions = []
+            overdue_subscriptions = []
+            for subscription in batch:
+                with self.isolate(subscription, 'due'):
+                    transaction = auto_activate_subscription(subscription, amount=subscription.plan_cost.cost,
+                                                             transaction_date=subscription.date_billing_next)
+                    if transaction.amount <= 0:
+                        subscription.activate(subscription_date=subscription.date_billing_next, no_multiple_subscription=saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION'])
+                        subscription.notify_activate(auto=True)
+                        activated_subscriptions.append(subscription)
+                        _logger.info("Auto activating subscription %s for user %s for date %s",subscription, subscription.user, subscription.date_billing_next )
+                    else:
+                        crypto = self.get_previous_transaction_crypto(subscription, )
+                        transaction.create_payment(crypto or "BITCOIN")
+                        subscription.due = True
+                        subscription.notify_overdue()
+                        overdue_subscriptions.append(subscription)
+                        _logger.info("Generating crypto payment for due subscription %s for user %s", subscription, subscription.user)
+            UserSubscription.objects.bulk_update(overdue_subscriptions, ['due'])
+            self.clear_failures(activated_subscriptions + overdue_subscriptions, 'due')
+            self.stats['activated'] += len(activated_subscriptions)
+            self.stats['overdue'] += len(overdue_subscriptions)
+        _logger.info("Processed %s 1 week due subscription ", self.stats['activated'] + self.stats['overdue'])
+
+    def process_new_subscriptions(self, date):
+        new_subscriptions = self.get_new_subscriptions(date)
+        for batch in self.iter_batches(new_subscriptions):
+            previous_subscriptions = self.get_previous_subscriptions(batch)
+            replaced_subscriptions = self.get_replaced_subscriptions(batch)
+            replaced = {subscription.pk for subscriptions in replaced_subscriptions.values() for subscription in subscriptions}
+            activated_subscriptions = []
+            deactivated_subscriptions = []
+            for subscription in batch:
+                if subscription.pk in replaced:
+                    continue
+                with self.isolate(subscription, 'new'):
+                    previous = previous_subscriptions.get(subscription.user_id, [])
+                    previous = previous + replaced_subscriptions.get(subscription.user_id, [])
+                    for previous_subscription in previous:
+                        self.deactivate(previous_subscription, date)
+                    self.activate(subscription)
+                    subscription.notify_activate()
+                    _logger.info("Activating new subscription %s for user %s for date %s", subscription,
+                                 subscription.user, subscription.date_billing_start)
+                    deactivated_subscriptions.extend(previous)
+                    activated_subscriptions.append(subscription)
+            UserSubscription.objects.bulk_update(deactivated_subscriptions, ['active', 'cancelled', 'due', 'date_billing_last'])
+            UserSubscription.objects.bulk_update(activated_subscriptions, ['active', 'cancelled', 'due', 'date_billing_end', 'date_billing_next'])
+            self.clear_failures(activated_subscriptions + deactivated_subscriptions, 'new')
+            self.stats['new'] += len(activated_subscriptions)
+        _logger.info("Processed %s new subscriptions ", self.stats['new'])
+
+    def get_previous_subscriptions(self, batch):
+        """Active subscriptions of the batch users that activating the batch replaces, by user id"""
+        previous_subscriptions = {}
+        if not saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION']:
+            return previous_subscriptions
+        subscriptions = UserSubscription.objects.filter(
+            active=True, user__in=[subscription.user_id for subscription in batch if subscription.user_id]
+        ).exclude(pk__in=[subscription.pk for subscription in batch]).select_related('plan_cost__plan__group')
+        for subscription in subscriptions:
+            previous_subscriptions.setdefault(subscription.user_id, []).append(subscription)
+        return previous_subscriptions
+
+    def get_replaced_subscriptions(self, batch):
+        """Pending subscriptions of the batch replaced by a newer pending subscription of their user, by user id.
 
-    def process_subscriptions(self):
-        """Calls all required subscription processing functions."""
-        current = timezone.now()
+        Of several subscriptions of one user starting in the same batch only the one with the newest
+        date_billing_start is activated, the others are deactivated like previous subscriptions.
+        """
+        replaced_subscriptions = {}
+        if not saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION']:
+            return replaced_subscriptions
+        newest = {}
+        for subscription in batch:
+            current = newest.get(subscription.user_id)
+            if subscription.user_id and (current is None or subscription.date_billing_start > current.date_billing_start):
+                newest[subscription.user_id] = subscription
+        for subscription in batch:
+            if subscription.user_id and newest[subscription.user_id] is not subscription:
+                replaced_subscriptions.setdefault(subscription.user_id, []).append(subscription)
+        return replaced_subscriptions
 
-        # Handle expired subscriptions
+    def activate(self, subscription):
+        """Same as UserSubscription.activate from the scheduled start date, without marking transactions paid,
+        leaves writing the row to a bulk update."""
+        next_billing_date = subscription.plan_cost.next_billing_datetime(subscription.date_billing_start)
+        subscription.active = True
+        subscription.cancelled = False
+        subscription.due = False
+        subscription.date_billing_end = next_billing_date + timedelta(days=subscription.plan_cost.plan.grace_period)
+        subscription.date_billing_next = next_billing_date
+        subscription._add_user_to_group()
 
-        self.process_expired_subscriptions(current)
-        self.process_one_week_due_subscriptions(current)
-        # self.process_new_subscriptions(current)
-        # Handle new subscriptions
+    def process_subscriptions(self, dates=None):
+        """Calls all required subscription processing functions.
 
-        # Handle subscriptions with billing due
+        :param dates: Optional ascending list of dates to replay the sweep at one day after another,
+            used to catch up after downtime. Defaults to the run date.
+        """
+        dates = dates or [self.run.run_date if self.run else timezone.now()]
+        phases = []
+        for date in dates:
+            prefix = '{}:'.format(date.date().isoformat()) if len(dates) > 1 else ''
+            phases += [
+                # Handle expired subscriptions
+                (prefix + 'expired', self.process_expired_subscriptions, date),
+                # Retry putting users of deactivated subscriptions back on the default plan
+                (prefix + 'default', self.process_default_subscriptions, date),
+                # Handle subscriptions with billing due
+                (prefix + 'due', self.process_one_week_due_subscriptions, date),
+                # Handle new subscriptions
+                (prefix + 'new', self.process_new_subscriptions, date),
+            ]
+        names = [name for name, process, date in phases]
+        resume_from = names.index(self.run.phase) if self.run and self.run.phase in names else 0
+        for name, process, date in phases[resume_from:]:
+            self.phase = name
+            start = time.monotonic()
+            queries = QueryCounter()
+            with connection.execute_wrapper(queries):
+                process(date)
+            self.timings[name] = time.monotonic() - start
+            self.queries[name] = queries.count
+        if self.run:
+            self.run.finish(self.stats, self.timings)
+        return self.stats
 
     def get_previous_transaction_crypto(self, subscription):
-        for transaction in subscription.transactions.all():
-            # transaction = SubscriptionTransaction.objects.get(pk=transaction.pk)
-            for payment in transaction.cryptocurrency_payments.all():
-                return payment.crypto
+        try:
+            return subscription.last_crypto.crypto
+        except SubscriptionCrypto.DoesNotExist:
+            return None
+
+
+class DryRunManager(Manager):
+    """Manager that projects what a sweep would do without writing anything or calling gateways.
+
+    Candidates are selected with the same queries as a real run. Credit use is simulated in memory from the users'
+    CreditBalance so several renewals of one user are projected in order. Subscriptions projected to expire are
+    skipped in the later phases of the sweep, dates moved forward by renewals are not replayed.
+    """
+
+    def __init__(self, batch_size=None, shard=None, since=None):
+        super().__init__(batch_size=batch_size, shard=shard, since=since)
+        self.report = {}
+        self.credits = {}
+        self.expired_keys = set()
+
+    def add_report(self, **counts):
+        self.report.setdefault(self.phase, Counter()).update(counts)
+
+    def load_credits(self, batch):
+        users = {subscription.user_id for subscription in batch if subscription.user_id not in self.credits}
+        self.credits.update(dict.fromkeys(users, Decimal(0)))
+        self.credits.update(CreditBalance.objects.filter(user__in=users, balance__gt=0).values_list('user_id', 'balance'))
+
+    def use_credit(self, user_id, amount):
+        """Same as CreditBalance.use_credit against the in memory balances"""
+        amount = to_amount(amount)
+        if amount <= 0:
+            return Decimal(0)
+        used = min(max(self.credits.get(user_id, Decimal(0)), Decimal(0)), amount)
+        if used:
+            self.credits[user_id] -= used
+            self.add_report(credit=used)
+        return amount - used
+
+    def process_expired_subscriptions(self, date):
+        expired_subscriptions = self.get_expired_subscriptions(date)
+        for batch in self.iter_batches(expired_subscriptions):
+            self.expired_keys.update(subscription.pk for subscription in batch)
+            self.add_report(candidates=len(batch))
+            self.stats['expired'] += len(batch)
+
+    def process_default_subscriptions(self, date):
+        for batch in self.iter_batches(self.get_default_candidates()):
+            self.add_report(candidates=len(batch))
+            self.stats['default'] += len(batch)
+
+    def process_one_week_due_subscriptions(self, date):
+        due_subscriptions = self.get_due_subscriptions(date)
+        for batch in self.iter_batches(due_subscriptions):
+            batch = [subscription for subscription in batch if subscription.pk not in self.expired_keys]
+            self.load_credits(batch)
+            self.add_report(candidates=len(batch), transactions=len(batch))
+            for subscription in batch:
+                amount = self.use_credit(subscription.user_id, subscription.plan_cost.cost)
+                if amount <= 0:
+                    self.stats['activated'] += 1
+                else:
+                    crypto = self.get_previous_transaction_crypto(subscription) or "BITCOIN"
+                    self.add_report(amount=amount, **{'invoices_' + crypto.lower(): 1})
+                    self.stats['overdue'] += 1
+
+    def process_new_subscriptions(self, date):
+        new_subscriptions = self.get_new_subscriptions(date)
+        for batch in self.iter_batches(new_subscriptions):
+            self.add_report(candidates=len(batch))
+            replaced = sum(len(subscriptions) for subscriptions in self.get_replaced_subscriptions(batch).values())
+            self.stats['new'] += len(batch) - replaced
+
+
+def run_manager(shard=None, resume=False, incremental=False, dates=None, **manager_options):
+    """Run a recorded subscription sweep, continuing the last unfinished run when resume is set."""
+    shard_name = '{}/{}'.format(*shard) if shard else ''
+    run_date = dates[-1] if dates else timezone.now()
+    run = BillingRun.start(COMMAND_NAME, run_date, shard=shard_name, resume=resume)
+    since = BillingRun.get_watermark(COMMAND_NAME, shard=shard_name) if incremental else None
+    return Manager(shard=shard, run=run, since=since, **manager_options).process_subscriptions(dates)
+
+
+def dry_run_manager(incremental=False, dates=None, **manager_options):
+    """Project a sweep at dates without recording a run, returns the DryRunManager holding the report."""
+    since = BillingRun.get_watermark(COMMAND_NAME) if incremental else None
+    manager = DryRunManager(since=since, **manager_options)
+    manager.process_subscriptions(dates)
+    return manager
+
+
+def get_replay_dates(date_from, date_to=None):
+    """Daily datetimes from date_from to date_to (default today) at the current time of day"""
+    now = timezone.now()
+    date_to = date_to or now.date()
+    dates = []
+    day = date_from
+    while day <= date_to:
+        dates.append(now.replace(year=day.year, month=day.month, day=day.day))
+        day += timedelta(days=1)
+    return dates
+
+
+def process_shard(shard, manager_options):
+    """Process pool entry point, runs a full subscription sweep for one shard on its own db connection."""
+    django.setup()
+    start = time.monotonic()
+    stats = run_manager(shard=shard, **manager_options)
+    connections.close_all()
+    return shard, stats, time.monotonic() - start
+
+
+def date_argument(value):
+    date = parse_date(value)
+    if date is None:
+        raise ArgumentTypeError('Enter a date as YYYY-MM-DD')
+    return date
+
+
+class Command(BaseCommand):
+    help = 'Deactivate expired subscriptions, renew or bill subscriptions due in one week and activate scheduled ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=saas_billing_settings['PROCESS_BATCH_SIZE'],
+                            help='Number of subscriptions loaded and written per query')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes, subscriptions are sharded by user id across them')
+        parser.add_argument('--lock', action='store_true',
+                            help='Claim batches with row locks or leases so runners on several hosts do not overlap')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue the last interrupted run from its checkpoint')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only scan subscriptions whose billing dates passed since the last completed run')
+        parser.add_argument('--from', dest='date_from', type=date_argument,
+                            help='Catch up by replaying every day from this date (YYYY-MM-DD) in order')
+        parser.add_argument('--to', dest='date_to', type=date_argument,
+                            help='Last day replayed with --from, defaults to today')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what the run would do per phase and how long it takes without writing anything')
+
+    def format_stats(self, stats):
+        return 'expired=%s activated=%s overdue=%s new=%s default=%s failed=%s' % (
+            stats['expired'], stats['activated'], stats['overdue'], stats['new'], stats['default'], stats['failed'])
+
+    def write_report(self, manager):
+        for name in manager.timings:
+            report = manager.report.get(name, Counter())
+            line = 'Phase %s: candidates=%s queries=%s time=%.2fs' % (
+                name, report['candidates'], manager.queries[name], manager.timings[name])
+            extra = sorted(key for key in report if key != 'candidates')
+            self.stdout.write(' '.join([line] + ['%s=%s' % (key, report[key]) for key in extra]))
+
+    def run_workers(self, workers, manager_options):
+        # Children must open their own connections instead of sharing the parent's sockets
+        connections.close_all()
+        total = Counter()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(process_shard, (index, workers), manager_options) for index in range(workers)]
+            for future in futures:
+                (index, count), stats, elapsed = future.result()
+                total.update(stats)
+                self.stdout.write('Shard %s/%s %s in %.2fs' % (index + 1, count, self.format_stats(stats), elapsed))
+        return total
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if options['dry_run']:
+            if workers > 1 or options['resume']:
+                raise CommandError('--dry-run cannot be combined with --workers or --resume')
+            dates = get_replay_dates(options['date_from'], options['date_to']) if options['date_from'] else None
+            manager = dry_run_manager(incremental=options['incremental'], dates=dates, batch_size=options['batch_size'])
+            self.write_report(manager)
+            self.stdout.write(self.style.SUCCESS('Dry run, nothing written, projected %s' % self.format_stats(manager.stats)))
+            return
+        manager_options = {'batch_size': options['batch_size'], 'lock': options['lock'],
+                           'resume': options['resume'], 'incremental': options['incremental']}
+        if options['date_from']:
+            manager_options['dates'] = get_replay_dates(options['date_from'], options['date_to'])
+        if workers > 1:
+            stats = self.run_workers(workers, manager_options)
+        else:
+            stats = run_manager(**manager_options)
+        self.stdout.write(self.style.SUCCESS('Processed subscriptions %s' % self.format_stats(stats)))
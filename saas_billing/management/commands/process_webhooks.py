@@ -0,0 +1,37 @@
+import time
+from django.core.management.base import BaseCommand
+from saas_billing import instrumentation
+from saas_billing.app_settings import SETTINGS
+from saas_billing.webhooks import process_webhook_events
+
+saas_billing_settings = SETTINGS['saas_billing_settings']
+
+
+class Command(BaseCommand):
+    help = 'Handle stored stripe and paypal webhook events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=saas_billing_settings['WEBHOOK_BATCH_SIZE'],
+                            help='Number of events claimed per transaction')
+        parser.add_argument('--poll', type=float, default=0,
+                            help='Keep draining, sleeping this many seconds whenever no event was processed')
+
+    def write_timings(self):
+        for name, timing in sorted(instrumentation.get_stats()['timings'].items()):
+            if name.startswith('webhook.'):
+                self.stdout.write('%s count=%s total=%.3fs max=%.3fs' % (
+                    name, timing['count'], timing['total'], timing['max']))
+
+    def handle(self, *args, **options):
+        while True:
+            counts = process_webhook_events(batch_size=options['batch_size'])
+            if any(counts.values()) or not options['poll']:
+                self.stdout.write(self.style.SUCCESS('Processed webhook events processed=%s failed=%s skipped=%s' % (
+                    counts['processed'], counts['failed'], counts['skipped'])))
+            if not options['poll']:
+                if options['verbosity'] > 1:
+                    self.write_timings()
+                return
+            if not counts['processed']:
+                # Nothing left or only failing events, give them time before retrying
+                time.sleep(options['poll'])
@@ -0,0 +1,85 @@
+import json
+import time
+from functools import partial
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from saas_billing.models import PaypalSubscription, BillingRun, get_paypal_client
+from saas_billing.reconcile import get_paypal_state, reconcile_subscriptions
+
+COMMAND_NAME = 'reconcile_paypal'
+PHASE = 'reconcile'
+
+
+def fetch_subscription(paypal, subscription_ref):
+    """Return subscription_ref with its paypal details or the error fetching them, runs in worker threads"""
+    try:
+        return subscription_ref, paypal.get_subscription(subscription_ref), None
+    except Exception as e:
+        return subscription_ref, None, e
+
+
+class Command(BaseCommand):
+    help = 'Fix local paypal subscriptions that drifted from paypal, e.g. after webhooks were lost'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Number of subscriptions fetched from paypal at once, keep it at most PAYPAL_POOL_SIZE')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of local subscriptions compared and updated per page')
+        parser.add_argument('--resume', action='store_true', help='Continue the last interrupted run from its checkpoint')
+        parser.add_argument('--dry-run', action='store_true', help='Report the drift without fixing it')
+
+    def reconcile_page(self, page, executor, paypal, dry_run):
+        counts = Counter()
+        details = {}
+        # Only the gateway calls run in the workers, the page is compared and written by this thread
+        for subscription_ref, data, error in executor.map(partial(fetch_subscription, paypal),
+                                                          [obj.subscription_ref for obj in page]):
+            if error is not None:
+                self.stderr.write('Failed to fetch paypal subscription %s: %r' % (subscription_ref, error))
+                counts['failed'] += 1
+            elif data is None:
+                counts['unknown'] += 1
+            else:
+                details[subscription_ref] = data
+        pairs = [(obj.subscription, get_paypal_state(details[obj.subscription_ref])) for obj in page
+                 if obj.subscription_ref in details]
+        counts += reconcile_subscriptions(pairs, dry_run=dry_run, stdout=self.stdout if self.verbosity > 1 else None)
+        counts['fetched'] += len(page)
+        return counts
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        start = time.monotonic()
+        run = None if options['dry_run'] else BillingRun.start(COMMAND_NAME, timezone.now(), resume=options['resume'])
+        last_pk = None
+        counts = Counter()
+        if run and run.phase == PHASE and run.last_key:
+            last_pk = int(run.last_key)
+            counts.update(json.loads(run.counts))
+            self.stdout.write('Resuming after paypal subscription %s' % last_pk)
+        queryset = PaypalSubscription.objects.select_related(
+            'subscription__user', 'subscription__plan_cost__plan__group').order_by('pk')
+        paypal = get_paypal_client()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                page = list((queryset if last_pk is None else queryset.filter(pk__gt=last_pk))[:options['batch_size']])
+                if not page:
+                    break
+                counts += self.reconcile_page(page, executor, paypal, options['dry_run'])
+                last_pk = page[-1].pk
+                if run:
+                    run.checkpoint(PHASE, last_pk, counts)
+        elapsed = time.monotonic() - start
+        if run:
+            run.finish(counts, {PHASE: elapsed})
+        for name, count in sorted(counts.items()):
+            if name.startswith('field.'):
+                self.stdout.write('%s mismatches=%s' % (name[len('field.'):], count))
+        label = 'Dry run, nothing fixed,' if options['dry_run'] else 'Reconciled paypal subscriptions'
+        self.stdout.write(self.style.SUCCESS(
+            '%s fetched=%s checked=%s updated=%s unknown=%s failed=%s replaced=%s in %.2fs (%.1f/s)' % (
+                label, counts['fetched'], counts['checked'], counts['updated'], counts['unknown'], counts['failed'],
+                counts['replaced'], elapsed, counts['fetched'] / elapsed if elapsed else 0)))
@@ -0,0 +1,59 @@
+import time
+import stripe
+from itertools import islice
+from collections import Counter
+from django.core.management.base import BaseCommand
+from saas_billing.circuit import guarded_call
+from saas_billing.models import StripeSubscription
+from saas_billing.reconcile import get_stripe_state, reconcile_subscriptions
+
+STRIPE_STATUSES = ['all', 'active', 'past_due', 'unpaid', 'canceled', 'incomplete', 'incomplete_expired', 'trialing',
+                   'ended']
+
+
+def iter_pages(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        page = list(islice(iterator, size))
+        if not page:
+            return
+        yield page
+
+
+class Command(BaseCommand):
+    help = 'Fix local stripe subscriptions that drifted from stripe, e.g. after webhooks were lost'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--status', choices=STRIPE_STATUSES, default='all',
+                            help='Only reconcile stripe subscriptions with this status')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of stripe subscriptions fetched and compared per page, at most 100')
+        parser.add_argument('--dry-run', action='store_true', help='Report the drift without fixing it')
+
+    def reconcile_page(self, page, dry_run):
+        """Compare a page of stripe subscriptions with their local rows, loaded in one query"""
+        data = {sub['id']: sub.to_dict() for sub in page}
+        local = StripeSubscription.objects.filter(subscription_ref__in=data).select_related(
+            'subscription__user', 'subscription__plan_cost__plan__group')
+        pairs = [(obj.subscription, get_stripe_state(data[obj.subscription_ref])) for obj in local]
+        counts = reconcile_subscriptions(pairs, dry_run=dry_run, stdout=self.stdout if self.verbosity > 1 else None)
+        counts['fetched'] += len(data)
+        counts['unknown'] += len(data) - len(pairs)
+        return counts
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        start = time.monotonic()
+        subscriptions = guarded_call('stripe', 'subscription.list', stripe.Subscription.list,
+                                     status=options['status'], limit=min(options['batch_size'], 100))
+        counts = Counter()
+        for page in iter_pages(subscriptions.auto_paging_iter(), options['batch_size']):
+            counts += self.reconcile_page(page, options['dry_run'])
+        elapsed = time.monotonic() - start
+        for name, count in sorted(counts.items()):
+            if name.startswith('field.'):
+                self.stdout.write('%s mismatches=%s' % (name[len('field.'):], count))
+        label = 'Dry run, nothing fixed,' if options['dry_run'] else 'Reconciled stripe subscriptions'
+        self.stdout.write(self.style.SUCCESS('%s fetched=%s checked=%s updated=%s unknown=%s replaced=%s in %.2fs (%.1f/s)' % (
+            label, counts['fetched'], counts['checked'], counts['updated'], counts['unknown'], counts['replaced'],
+            elapsed, counts['fetched'] / elapsed if elapsed else 0)))
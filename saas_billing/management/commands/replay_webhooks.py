@@ -0,0 +1,77 @@
+import time
+from datetime import datetime, time as datetime_time
+from argparse import ArgumentTypeError
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from saas_billing import instrumentation
+from saas_billing.app_settings import SETTINGS
+from saas_billing.models import WebhookEvent
+from saas_billing.webhooks import replay_webhook_events
+
+saas_billing_settings = SETTINGS['saas_billing_settings']
+
+
+def datetime_argument(value):
+    date_time = parse_datetime(value)
+    if date_time is None:
+        date = parse_date(value)
+        if date is None:
+            raise ArgumentTypeError('Enter a date as YYYY-MM-DD or a date and time as YYYY-MM-DD HH:MM')
+        date_time = datetime.combine(date, datetime_time())
+    if settings.USE_TZ and timezone.is_naive(date_time):
+        date_time = timezone.make_aware(date_time)
+    return date_time
+
+
+class Command(BaseCommand):
+    help = 'Handle stored webhook events again, e.g. after a deploy broke webhook handling'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=datetime_argument, required=True,
+                            help='Replay events received from this date or date and time')
+        parser.add_argument('--until', type=datetime_argument,
+                            help='Replay events received before this date or date and time, defaults to now')
+        parser.add_argument('--gateway', choices=['stripe', 'paypal'], help='Only replay events of this gateway')
+        parser.add_argument('--type', dest='event_types', action='append',
+                            help='Only replay events of this type, can be repeated')
+        parser.add_argument('--status', dest='statuses', action='append',
+                            choices=[status for status, name in WebhookEvent.STATUS_CHOICES],
+                            help='Only replay events with this status, can be repeated, defaults to processed and failed')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of threads, the events of one subscription are always handled by one thread')
+        parser.add_argument('--batch-size', type=int, default=saas_billing_settings['WEBHOOK_BATCH_SIZE'],
+                            help='Number of events loaded per query')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be replayed without handling it')
+
+    def get_queryset(self, options):
+        statuses = options['statuses'] or [WebhookEvent.STATUS_PROCESSED, WebhookEvent.STATUS_FAILED]
+        queryset = WebhookEvent.objects.filter(received_at__gte=options['since'], status__in=statuses)
+        if options['until']:
+            queryset = queryset.filter(received_at__lt=options['until'])
+        if options['gateway']:
+            queryset = queryset.filter(gateway=options['gateway'])
+        if options['event_types']:
+            queryset = queryset.filter(event_type__in=options['event_types'])
+        return queryset
+
+    def handle(self, *args, **options):
+        instrumentation.reset()
+        start = time.monotonic()
+        counts = replay_webhook_events(self.get_queryset(options), workers=options['workers'],
+                                       batch_size=options['batch_size'], dry_run=options['dry_run'])
+        elapsed = time.monotonic() - start
+        timings = instrumentation.get_stats()['timings']
+        for event_type, count in sorted(counts['types'].items()):
+            timing = timings.get('webhook.' + event_type)
+            line = '%s count=%s' % (event_type, count)
+            if timing:
+                line += ' total=%.3fs max=%.3fs' % (timing['total'], timing['max'])
+            self.stdout.write(line)
+        total = counts['replayed'] + counts['failed']
+        label = 'Dry run, nothing handled,' if options['dry_run'] else 'Replayed webhook events'
+        summary = '%s replayed=%s failed=%s superseded=%s stale=%s in %.2fs (%.1f events/s)' % (
+            label, counts['replayed'], counts['failed'], counts['superseded'], counts['stale'], elapsed,
+            total / elapsed if elapsed else 0)
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.SUBSCRIPTIONS_API_USERSUBSCRIPTION_MODEL),
+        ('saas_billing', '0004_auto_20200915_1507'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owner', models.CharField(max_length=100)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('subscription', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='lease', to=settings.SUBSCRIPTIONS_API_USERSUBSCRIPTION_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:40
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas_billing', '0005_subscriptionlease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillingRun',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command', models.CharField(max_length=100)),
+                ('shard', models.CharField(blank=True, default='', max_length=20)),
+                ('run_date', models.DateTimeField(help_text='the date subscriptions are evaluated at')),
+                ('phase', models.CharField(blank=True, max_length=50, null=True)),
+                ('last_key', models.CharField(blank=True, help_text='last primary key processed in the current phase', max_length=100, null=True)),
+                ('counts', models.TextField(default='{}', help_text='json dict of processed counts')),
+                ('timings', models.TextField(default='{}', help_text='json dict of seconds spent per phase')),
+                ('completed', models.BooleanField(default=False)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:05
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def backfill_credit_balances(apps, schema_editor):
+    # Credit used to be consumed by reducing negative transactions in place,
+    # so what is left of them is the unused credit of each user
+    SubscriptionTransaction = apps.get_model('saas_billing', 'SubscriptionTransaction')
+    CreditBalance = apps.get_model('saas_billing', 'CreditBalance')
+    credits = SubscriptionTransaction.objects.filter(amount__lt=0, user__isnull=False).values('user').annotate(
+        total=Sum('amount')).order_by()
+    CreditBalance.objects.bulk_create([CreditBalance(user_id=row['user'], balance=-row['total']) for row in credits],
+                                      batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('saas_billing', '0006_billingrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CreditBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=19)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='credit_balance', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(backfill_credit_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_subscription_crypto(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    CryptoCurrencyPayment = apps.get_model('cryptocurrency_payment', 'CryptoCurrencyPayment')
+    SubscriptionTransaction = apps.get_model('saas_billing', 'SubscriptionTransaction')
+    SubscriptionCrypto = apps.get_model('saas_billing', 'SubscriptionCrypto')
+    content_type = ContentType.objects.filter(app_label='saas_billing', model='subscriptiontransaction').first()
+    if content_type is None:
+        return
+    # Crypto of the most recent transaction that has a payment, like the renewal sweep used to look it up
+    transaction_crypto = dict(CryptoCurrencyPayment.objects.filter(content_type=content_type).order_by(
+        'created_at').values_list('object_id', 'crypto'))
+    subscription_crypto = {}
+    transactions = SubscriptionTransaction.objects.filter(subscription__isnull=False).order_by(
+        'date_transaction').values_list('pk', 'subscription_id')
+    for pk, subscription_id in transactions.iterator():
+        crypto = transaction_crypto.get(str(pk))
+        if crypto:
+            subscription_crypto[subscription_id] = crypto
+    SubscriptionCrypto.objects.bulk_create([
+        SubscriptionCrypto(subscription_id=subscription_id, crypto=crypto)
+        for subscription_id, crypto in subscription_crypto.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.SUBSCRIPTIONS_API_USERSUBSCRIPTION_MODEL),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('cryptocurrency_payment', '0001_initial'),
+        ('saas_billing', '0007_creditbalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionCrypto',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('crypto', models.CharField(max_length=50)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('subscription', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='last_crypto', to=settings.SUBSCRIPTIONS_API_USERSUBSCRIPTION_MODEL)),
+            ],
+        ),
+        migrations.RunPython(backfill_subscription_crypto, migrations.RunPython.noop),
+    ]
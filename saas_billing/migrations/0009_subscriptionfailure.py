@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:55
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.SUBSCRIPTIONS_API_USERSUBSCRIPTION_MODEL),
+        ('saas_billing', '0008_subscriptioncrypto'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionFailure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phase', models.CharField(max_length=50)),
+                ('error', models.TextField()),
+                ('attempts', models.PositiveIntegerField(default=1)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='process_failures', to=settings.SUBSCRIPTIONS_API_USERSUBSCRIPTION_MODEL)),
+            ],
+            options={
+                'unique_together': {('subscription', 'phase')},
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas_billing', '0010_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookevent',
+            name='event_id',
+            field=models.CharField(blank=True, help_text='stripe event id or paypal event id, deliveries are deduplicated on it', max_length=255, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='webhookevent',
+            unique_together={('gateway', 'event_id')},
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas_billing', '0011_webhookevent_event_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookevent',
+            name='object_ref',
+            field=models.CharField(blank=True, help_text='gateway reference of the subscription the event is about', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='webhookevent',
+            name='occurred_at',
+            field=models.DateTimeField(blank=True, help_text='when the event happened at the gateway', null=True),
+        ),
+        migrations.AlterField(
+            model_name='webhookevent',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processed', 'Processed'), ('failed', 'Failed'), ('skipped', 'Skipped')], default='pending', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='webhookevent',
+            index=models.Index(fields=['gateway', 'object_ref', 'status'], name='saas_billin_gateway_b8e9d4_idx'),
+        ),
+    ]
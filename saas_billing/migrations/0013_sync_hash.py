@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas_billing', '0012_webhookevent_object_ref'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paypalsubscriptionplan',
+            name='sync_hash',
+            field=models.CharField(blank=True, help_text='hash of the data last pushed to the gateway', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='paypalsubscriptionplancost',
+            name='sync_hash',
+            field=models.CharField(blank=True, help_text='hash of the data last pushed to the gateway', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='stripesubscriptionplan',
+            name='sync_hash',
+            field=models.CharField(blank=True, help_text='hash of the data last pushed to the gateway', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='stripesubscriptionplancost',
+            name='sync_hash',
+            field=models.CharField(blank=True, help_text='hash of the data last pushed to the gateway', max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas_billing', '0013_sync_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptiontransaction',
+            name='webhook_event',
+            field=models.ForeignKey(blank=True, help_text='gateway event that recorded this transaction', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transactions', to='saas_billing.webhookevent'),
+        ),
+    ]
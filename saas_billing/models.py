@@ -1,6 +1,11 @@
+import json
 import stripe
+import hashlib
 import logging
-from django.db import models
+from uuid import uuid4
+from decimal import Decimal
+from django.db import models, transaction as db_transaction
+from django.db.models import F
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.fields import GenericRelation
 from subscriptions_api.base_models import BaseSubscriptionTransaction
@@ -8,8 +13,11 @@ from subscriptions_api.models import SubscriptionPlan, PlanCost, UserSubscriptio
 from cryptocurrency_payment.models import CryptoCurrencyPayment
 from cryptocurrency_payment.models import create_new_payment
 from saas_billing.provider import PayPalClient
+from saas_billing.circuit import guarded_call
+from saas_billing import catalog
 from saas_billing.app_settings import SETTINGS
 from django.apps import apps
+from django.utils import timezone
 _logger = logging.getLogger(__name__)
 
 auth = SETTINGS['billing_auths']
@@ -23,24 +31,42 @@ def get_paypal_client():
     return paypal
 
 
+def to_amount(value):
+    """Convert a float or Decimal money value to a Decimal rounded to cents"""
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+
 def auto_activate_subscription(subscription, amount, transaction_date=None):
     if amount > 0:
-        # Search if old transaction can pay for new subscription
-        for prev_transaction in subscription.user.subscription_transactions.filter(amount__lt=0).all():
-            amount = float(amount) + float(prev_transaction.amount)
-            if amount < 0 or amount == 0:
-                prev_transaction.amount = amount
-                prev_transaction.save()
-                amount = 0
-            else:
-                prev_transaction.amount = 0
-                prev_transaction.save()
+        # Use unused credit from old transactions to pay for new subscription
+        amount = CreditBalance.use_credit(subscription.user, amount)
     else:
         amount = 0
     transaction = subscription.record_transaction(amount=amount, transaction_date=transaction_date)
     return transaction
 
 
+class GatewaySyncMixin(models.Model):
+    """Gateway catalog object remembering a hash of the data last pushed to the gateway"""
+    sync_hash = models.CharField(max_length=64, null=True, blank=True,
+                                 help_text='hash of the data last pushed to the gateway')
+
+    class Meta:
+        abstract = True
+
+    def get_sync_data(self):
+        raise NotImplementedError
+
+    def get_sync_hash(self):
+        data = json.dumps(self.get_sync_data(), sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def needs_sync(self):
+        return self.sync_hash != self.get_sync_hash()
+
+    def mark_synced(self):
+        self.sync_hash = self.get_sync_hash()
+        self.save(update_fields=['sync_hash', 'updated_at'])
 
 
 class BillingUserSubscription(UserSubscription):
@@ -67,15 +93,12 @@ class BillingPlanCost(PlanCost):
         proxy = True
 
     def setup_subscription(self, user, gateway, quantity=1):
-        cost_model_str = SETTINGS['billing_models'][gateway]['cost']
-        Model = apps.get_model(cost_model_str)
-        external_cost = Model.objects.get(cost=self)
+        external_cost = catalog.get_external_cost(gateway, self)
         data = external_cost.setup_subscription(user, quantity=quantity)
         return data
 
 
-
-class StripeSubscriptionPlan(models.Model):
+class StripeSubscriptionPlan(GatewaySyncMixin):
     plan = models.OneToOneField(SubscriptionPlan, on_delete=models.CASCADE, unique=True,
                                 related_name='stripe_subscription_plan')
     plan_ref = models.CharField(max_length=250, null=True, blank=True)
@@ -84,17 +107,20 @@ class StripeSubscriptionPlan(models.Model):
 
     def create_or_update(self):
         if not self.plan_ref:
-            res = stripe.Product.create(name=self.plan.plan_name, description=self.plan.plan_description,
-                                        type='service')
+            res = guarded_call('stripe', 'product.create', stripe.Product.create, name=self.plan.plan_name,
+                               description=self.plan.plan_description, type='service')
             self.plan_ref = res.id
             self.save()
         else:
-            res = stripe.Product.modify(
-                self.plan_ref,
+            res = guarded_call(
+                'stripe', 'product.modify', stripe.Product.modify, self.plan_ref,
                 name=self.plan.plan_name, description=self.plan.plan_description,
             )
         return res
 
+    def get_sync_data(self):
+        return {'ref': self.plan_ref, 'name': self.plan.plan_name, 'description': self.plan.plan_description}
+
     def __str__(self):
         return '{}|{}'.format(self.plan.plan_name, self.plan_ref)
 
@@ -110,7 +136,7 @@ class StripeCustomer(models.Model):
             return StripeSubscription.objects.get(subscription_ref=stripe_sub_obj.id).subscription
         except StripeSubscription.DoesNotExist:
             cost_ref =  stripe_sub_obj['plan']['id']
-            cost = StripeSubscriptionPlanCost.objects.get(cost_ref=cost_ref).cost
+            cost = catalog.get_cost('stripe', cost_ref)
             subscription = cost.setup_user_subscription(self.user, active=False, no_multiple_subscription=saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION'],
                                                         resuse=True)
             subscription.reference = 'stripe'
@@ -122,25 +148,42 @@ class StripeCustomer(models.Model):
     def __str__(self):
         return '{} {} {}'.format(self.id, self.user, self.customer_id)
 
-class StripeSubscriptionPlanCost(models.Model):
+
+class StripeSubscriptionPlanCost(GatewaySyncMixin):
     cost = models.OneToOneField(PlanCost, on_delete=models.CASCADE, unique=True, related_name='stripe_plan_cost')
     cost_ref = models.CharField(max_length=250, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    def get_skip_reason(self):
+        """Why create_or_update pushes nothing to stripe, None when it calls stripe"""
+        if self.cost.cost <= 0:
+            return 'free plan cost'
+        if self.cost_ref:
+            return 'stripe prices cannot be changed, create a new plan cost'
+        product = getattr(self.cost.plan, 'stripe_subscription_plan', None)
+        if not (product and product.plan_ref):
+            return 'plan has no stripe product yet'
+
     def create_or_update(self):
         if self.cost.cost <= 0:
             #Dont create plan with 0 cost they are free plan
             return
         if not self.cost_ref and self.cost.plan.stripe_subscription_plan.plan_ref:
-            res = stripe.Price.create(unit_amount_decimal=self.cost.cost * 100, currency="usd", nickname=str(self.cost),
-                                      recurring={"interval": self.cost.get_recurrence_unit_display(),
-                                                 'interval_count': self.cost.recurrence_period},
-                                      product=self.cost.plan.stripe_subscription_plan.plan_ref)
+            res = guarded_call('stripe', 'price.create', stripe.Price.create,
+                               unit_amount_decimal=self.cost.cost * 100, currency="usd", nickname=str(self.cost),
+                               recurring={"interval": self.cost.get_recurrence_unit_display(),
+                                          'interval_count': self.cost.recurrence_period},
+                               product=self.cost.plan.stripe_subscription_plan.plan_ref)
             self.cost_ref = res.id
             self.save()
             return res
 
+    def get_sync_data(self):
+        product = getattr(self.cost.plan, 'stripe_subscription_plan', None)
+        return {'ref': self.cost_ref, 'cost': self.cost.cost, 'recurrence_unit': self.cost.recurrence_unit,
+                'recurrence_period': self.cost.recurrence_period, 'product': product and product.plan_ref}
+
     def __str__(self):
         return '{}|{}|{}|{}'.format(self.cost.plan.plan_name, self.cost.get_recurrence_unit_display(),
                                     self.cost.recurrence_period,
@@ -150,7 +193,8 @@ class StripeSubscriptionPlanCost(models.Model):
         try:
             customer_id = StripeCustomer.objects.get(user=user).customer_id
         except StripeCustomer.DoesNotExist:
-            customer_id = stripe.Customer.create(
+            customer_id = guarded_call(
+                'stripe', 'customer.create', stripe.Customer.create,
                 name=user.first_name + ' ' + user.last_name,
                 email=user.email
             ).id
@@ -158,10 +202,9 @@ class StripeSubscriptionPlanCost(models.Model):
             sc.save()
         return customer_id
 
-    def pre_process_subscription(self, user, quantity=1):
+    def get_checkout_session_params(self, customer, quantity=1):
         auth = SETTINGS['billing_auths']['stripe']
-        customer = self.get_or_create_stripe_customer_id(user)
-        session = stripe.checkout.Session.create(
+        return dict(
             cancel_url=auth['CANCEL_URL'],
             mode='subscription',
             customer=customer,
@@ -173,6 +216,11 @@ class StripeSubscriptionPlanCost(models.Model):
             allow_promotion_codes=True,
             payment_method_types=["card"]
         )
+
+    def pre_process_subscription(self, user, quantity=1):
+        customer = self.get_or_create_stripe_customer_id(user)
+        session = guarded_call('stripe', 'checkout.session.create', stripe.checkout.Session.create,
+                               **self.get_checkout_session_params(customer, quantity))
         return {'session_id': session.id, 'cost_id': self.cost_ref}
 
     def setup_subscription(self, user, quantity=1):
@@ -187,7 +235,8 @@ class StripeSubscription(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     def deactivate(self):
-        res = stripe.Subscription.delete(self.subscription_ref, invoice_now=True, prorate=True)
+        res = guarded_call('stripe', 'subscription.delete', stripe.Subscription.delete, self.subscription_ref,
+                           invoice_now=True, prorate=True)
         if res.status == 'canceled':
             return True
 
@@ -198,8 +247,7 @@ class StripeSubscription(models.Model):
         return '{}|{}|{}'.format(self.id, self.subscription, self.subscription_ref)
 
 
-
-class PaypalSubscriptionPlan(models.Model):
+class PaypalSubscriptionPlan(GatewaySyncMixin):
     plan = models.OneToOneField(SubscriptionPlan, on_delete=models.CASCADE, unique=True,
                                 related_name='paypal_subscription_plan')
     plan_ref = models.CharField(max_length=250)
@@ -217,16 +265,24 @@ class PaypalSubscriptionPlan(models.Model):
                                                   description=self.plan.plan_description)
         return res
 
+    def get_sync_data(self):
+        return {'ref': self.plan_ref, 'name': self.plan.plan_name, 'description': self.plan.plan_description}
+
     def __str__(self):
         return '{}|{}'.format(self.plan.plan_name, self.plan_ref)
 
 
-class PaypalSubscriptionPlanCost(models.Model):
+class PaypalSubscriptionPlanCost(GatewaySyncMixin):
     cost = models.OneToOneField(PlanCost, on_delete=models.CASCADE, unique=True, related_name='paypal_plan_cost')
     cost_ref = models.CharField(max_length=250, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    def get_skip_reason(self):
+        """Why create_or_update pushes nothing to paypal, None when it calls paypal"""
+        if self.cost.cost <= 0:
+            return 'free plan cost'
+
     def create_or_update(self):
         if self.cost.cost <= 0:
             #Dont create plan with 0 cost they are free plan
@@ -262,6 +318,12 @@ class PaypalSubscriptionPlanCost(models.Model):
             res = paypal.update_plan_pricing(self.cost_ref, amount=self.cost.cost, currency="usd")
         return res
 
+    def get_sync_data(self):
+        product = getattr(self.cost.plan, 'paypal_subscription_plan', None)
+        return {'ref': self.cost_ref, 'cost': self.cost.cost, 'recurrence_unit': self.cost.recurrence_unit,
+                'recurrence_period': self.cost.recurrence_period, 'trial_period': self.cost.plan.trial_period,
+                'product': product and product.plan_ref}
+
     def activate(self):
         paypal = get_paypal_client()
         if self.cost_ref:
@@ -277,6 +339,10 @@ class PaypalSubscriptionPlanCost(models.Model):
         res = paypal.create_subscription(self.cost_ref, user.email, user.first_name, user.last_name,
                                          return_url=auth['paypal']['SUCCESS_URL'],
                                          cancel_url=auth['paypal']['CANCEL_URL'])
+        return self.record_subscription(user, quantity, res)
+
+    def record_subscription(self, user, quantity, res):
+        """Set up the local subscription of user for the paypal subscription res just created"""
         subscription_link = None
         for link in res['links']:
             if link['rel'].lower() == 'approve':
@@ -315,6 +381,16 @@ class PaypalSubscription(models.Model):
 
 class SubscriptionTransaction(BaseSubscriptionTransaction):
     cryptocurrency_payments = GenericRelation(CryptoCurrencyPayment)
+    webhook_event = models.ForeignKey('WebhookEvent', null=True, blank=True, on_delete=models.SET_NULL,
+                                      related_name='transactions',
+                                      help_text='gateway event that recorded this transaction')
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding and self.user_id and self.amount is not None and self.amount < 0:
+            # A negative transaction is money owed to the user
+            CreditBalance.add_credit(self.user_id, -to_amount(self.amount))
 
     def create_payment(self, crypto_payment):
         plan_cost = self.subscription.plan_cost
@@ -324,4 +400,164 @@ class SubscriptionTransaction(BaseSubscriptionTransaction):
                                      payment_title=payment_title,
                                      payment_description=plan_cost.plan.plan_description,
                                      related_object=self, user=self.user)
+        if self.subscription_id:
+            SubscriptionCrypto.objects.update_or_create(subscription_id=self.subscription_id,
+                                                        defaults={'crypto': crypto_payment})
         return payment
+
+
+class SubscriptionCrypto(models.Model):
+    """Cryptocurrency last used to pay for a subscription, renewal payments are created with it"""
+    subscription = models.OneToOneField(UserSubscription, on_delete=models.CASCADE, unique=True,
+                                        related_name='last_crypto')
+    crypto = models.CharField(max_length=50)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{}|{}'.format(self.subscription_id, self.crypto)
+
+
+class CreditBalance(models.Model):
+    """Unused credit of a user from negative transactions, consumed before new transactions are billed"""
+    user = models.OneToOneField(get_user_model(), on_delete=models.CASCADE, unique=True, related_name='credit_balance')
+    balance = models.DecimalField(max_digits=19, decimal_places=2, default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def add_credit(cls, user, amount):
+        obj, created = cls.objects.get_or_create(user_id=getattr(user, 'pk', user))
+        cls.objects.filter(pk=obj.pk).update(balance=F('balance') + to_amount(amount), updated_at=timezone.now())
+
+    @classmethod
+    def use_credit(cls, user, amount):
+        """Pay as much of amount as possible from user credit, returns the amount left to pay"""
+        amount = to_amount(amount)
+        with db_transaction.atomic():
+            obj = cls.objects.select_for_update().filter(user=user, balance__gt=0).first()
+            if obj is None:
+                return amount
+            used = min(obj.balance, amount)
+            cls.objects.filter(pk=obj.pk).update(balance=F('balance') - used, updated_at=timezone.now())
+        return amount - used
+
+    def __str__(self):
+        return '{}|{}'.format(self.user, self.balance)
+
+
+class SubscriptionLease(models.Model):
+    """Claim on a subscription held by a process_subscriptions runner on databases without SKIP LOCKED"""
+    subscription = models.OneToOneField(UserSubscription, on_delete=models.CASCADE, related_name='lease')
+    owner = models.CharField(max_length=100)
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{}|{}|{}'.format(self.subscription_id, self.owner, self.expires_at)
+
+
+class BillingRun(models.Model):
+    """Progress of a billing command run, used to resume an interrupted run and as watermark for the next one"""
+    id = models.UUIDField(default=uuid4, editable=False, primary_key=True, verbose_name='ID')
+    command = models.CharField(max_length=100)
+    shard = models.CharField(max_length=20, blank=True, default='')
+    run_date = models.DateTimeField(help_text='the date subscriptions are evaluated at')
+    phase = models.CharField(max_length=50, null=True, blank=True)
+    last_key = models.CharField(max_length=100, null=True, blank=True,
+                                help_text='last primary key processed in the current phase')
+    counts = models.TextField(default='{}', help_text='json dict of processed counts')
+    timings = models.TextField(default='{}', help_text='json dict of seconds spent per phase')
+    completed = models.BooleanField(default=False)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def start(cls, command, run_date, shard='', resume=False):
+        """Return the last unfinished run of command when resuming, or a new run"""
+        if resume:
+            run = cls.objects.filter(command=command, shard=shard, completed=False).order_by('-started_at').first()
+            if run:
+                return run
+        return cls.objects.create(command=command, shard=shard, run_date=run_date)
+
+    @classmethod
+    def get_watermark(cls, command, shard=''):
+        """Date of the last completed run of command, rows handled by it need not be scanned again"""
+        run = cls.objects.filter(command=command, shard=shard, completed=True).order_by('-run_date').first()
+        return run.run_date if run else None
+
+    def checkpoint(self, phase, last_key, counts):
+        self.phase = phase
+        self.last_key = None if last_key is None else str(last_key)
+        self.counts = json.dumps(counts)
+        self.save(update_fields=['phase', 'last_key', 'counts', 'updated_at'])
+
+    def finish(self, counts, timings):
+        self.counts = json.dumps(counts)
+        self.timings = json.dumps(timings)
+        self.completed = True
+        self.finished_at = timezone.now()
+        self.save()
+
+    def __str__(self):
+        return '{}|{}|{}|{}|{}'.format(self.id, self.command, self.shard, self.phase, self.completed)
+
+
+class SubscriptionFailure(models.Model):
+    """Subscription a process_subscriptions phase failed on, kept for retry by the next runs"""
+    subscription = models.ForeignKey(UserSubscription, on_delete=models.CASCADE, related_name='process_failures')
+    phase = models.CharField(max_length=50)
+    error = models.TextField()
+    attempts = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('subscription', 'phase')
+
+    def __str__(self):
+        return '{}|{}|{}'.format(self.subscription_id, self.phase, self.attempts)
+
+
+class WebhookEvent(models.Model):
+    """Webhook request received from a gateway, stored as is and handled later by the process_webhooks command"""
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSED = 'processed'
+    STATUS_FAILED = 'failed'
+    STATUS_SKIPPED = 'skipped'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSED, 'Processed'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_SKIPPED, 'Skipped'),
+    )
+    gateway = models.CharField(max_length=20)
+    event_id = models.CharField(max_length=255, null=True, blank=True,
+                                help_text='stripe event id or paypal event id, deliveries are deduplicated on it')
+    event_type = models.CharField(max_length=100, blank=True, default='')
+    object_ref = models.CharField(max_length=255, null=True, blank=True,
+                                  help_text='gateway reference of the subscription the event is about')
+    occurred_at = models.DateTimeField(null=True, blank=True, help_text='when the event happened at the gateway')
+    body = models.TextField(help_text='raw request body')
+    headers = models.TextField(default='{}', help_text='json dict of the gateway request headers')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('gateway', 'event_id')
+        indexes = [models.Index(fields=['status', 'id']),
+                   models.Index(fields=['gateway', 'object_ref', 'status'])]
+
+    @property
+    def payload(self):
+        return json.loads(self.body)
+
+    def get_headers(self):
+        return json.loads(self.headers)
+
+    def __str__(self):
+        return '{}|{}|{}|{}'.format(self.id, self.gateway, self.event_type, self.status)
@@ -1,7 +1,189 @@
+import time
+import random
+import asyncio
+import hashlib
 import logging
+import weakref
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.core.cache import caches
+from saas_billing.app_settings import SETTINGS
+from saas_billing.circuit import guarded, get_breaker
+
+try:
+    import httpx
+except ImportError:
+    # AsyncPayPalClient is not available, async views call PayPalClient in a thread
+    httpx = None
 
 logger = logging.getLogger(__name__)
-import requests
+
+saas_billing_settings = SETTINGS['saas_billing_settings']
+
+# Refresh tokens this many seconds before paypal expires them
+TOKEN_REFRESH_MARGIN = 300
+
+_tokens = {}
+_tokens_lock = threading.Lock()
+
+_adapter = None
+_adapter_lock = threading.Lock()
+_token_session = None
+# httpx clients of AsyncPayPalClient by event loop and transport, an httpx client cannot be used across loops
+_async_clients = weakref.WeakKeyDictionary()
+
+
+class JitterRetry(Retry):
+    """Full jitter on the exponential backoff so clients do not retry in lockstep, Retry-After still wins"""
+
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+
+class PayPalAdapter(HTTPAdapter):
+    """Keep-alive connection pool with a default timeout"""
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+def get_timeout():
+    return saas_billing_settings['PAYPAL_CONNECT_TIMEOUT'], saas_billing_settings['PAYPAL_READ_TIMEOUT']
+
+
+def get_http_adapter():
+    """Transport shared by all PayPalClient sessions so connections are reused across clients.
+
+    Idempotent requests are retried on connection errors, 429 and 5xx answers with exponential backoff.
+    """
+    global _adapter
+    if _adapter is None:
+        with _adapter_lock:
+            if _adapter is None:
+                retry = JitterRetry(total=saas_billing_settings['PAYPAL_MAX_RETRIES'], backoff_factor=0.5,
+                                    status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+                pool_size = saas_billing_settings['PAYPAL_POOL_SIZE']
+                _adapter = PayPalAdapter(timeout=get_timeout(), pool_connections=pool_size, pool_maxsize=pool_size,
+                                         max_retries=retry)
+    return _adapter
+
+
+def get_token_key(base_url, key):
+    return 'saas_billing:paypal_token:%s' % hashlib.sha256('{}|{}'.format(base_url, key).encode()).hexdigest()
+
+
+def get_token_cache():
+    """Django cache sharing tokens between processes, None when tokens are only kept per process"""
+    alias = saas_billing_settings['PAYPAL_TOKEN_CACHE']
+    return caches[alias] if alias else None
+
+
+def is_usable(token, stale_token=None):
+    return token is not None and token['access_token'] != stale_token and token['refresh_at'] > time.time()
+
+
+def get_cached_token(token_key, stale_token=None):
+    """Return the cached access token unless it is due for refresh or is stale_token.
+
+    The django cache is read whenever the token of this process is not usable, another process may have stored a
+    fresh one.
+    """
+    token = _tokens.get(token_key)
+    if not is_usable(token, stale_token):
+        cache = get_token_cache()
+        token = cache.get(token_key) if cache else None
+        if not is_usable(token, stale_token):
+            return None
+        _tokens[token_key] = token
+    return token['access_token']
+
+
+def set_cached_token(token_key, access_token, expires_in):
+    expires_in = int(expires_in or 0)
+    refresh_in = expires_in - min(TOKEN_REFRESH_MARGIN, expires_in // 2)
+    token = {'access_token': access_token, 'refresh_at': time.time() + refresh_in}
+    _tokens[token_key] = token
+    cache = get_token_cache()
+    if cache and refresh_in > 0:
+        cache.set(token_key, token, refresh_in)
+    return access_token
+
+
+def request_token(base_url, key, secret):
+    """Request a new access token over the shared transport, called holding _tokens_lock"""
+    global _token_session
+    if _token_session is None:
+        _token_session = requests.Session()
+        _token_session.mount('https://', get_http_adapter())
+        _token_session.hooks['response'].append(raise_for_gateway_error)
+    res = _token_session.post(base_url + '/oauth2/token', auth=(key, secret), data={'grant_type': 'client_credentials'})
+    return res.json()
+
+
+def get_access_token(base_url, key, secret, stale_token=None):
+    """Return an access token for key shared by all threads and, through the django cache, by all processes.
+
+    Only one thread of a process requests a new token when the cached one is due for refresh. Pass the
+    token paypal rejected as stale_token to get a new one.
+    """
+    token_key = get_token_key(base_url, key)
+    access_token = get_cached_token(token_key, stale_token)
+    if access_token is not None:
+        return access_token
+    with _tokens_lock:
+        # Another thread or process may have stored a new token meanwhile
+        access_token = get_cached_token(token_key, stale_token)
+        if access_token is None:
+            data = request_token(base_url, key, secret)
+            access_token = set_cached_token(token_key, data['access_token'], data.get('expires_in'))
+    return access_token
+
+
+def reset_tokens():
+    """Forget the tokens cached by this process"""
+    with _tokens_lock:
+        _tokens.clear()
+
+
+class PayPalAuth(requests.auth.AuthBase):
+    """Authenticate requests with the shared access token, retry once with a new token when paypal answers 401"""
+
+    def __init__(self, base_url, key, secret):
+        self.base_url = base_url
+        self.key = key
+        self.secret = secret
+
+    def __call__(self, r):
+        r.headers['Authorization'] = 'Bearer %s' % get_access_token(self.base_url, self.key, self.secret)
+        r.register_hook('response', self.handle_401)
+        return r
+
+    def handle_401(self, r, **kwargs):
+        if r.status_code != 401:
+            return r
+        stale_token = r.request.headers['Authorization'][len('Bearer '):]
+        prep = r.request.copy()
+        prep.headers['Authorization'] = 'Bearer %s' % get_access_token(self.base_url, self.key, self.secret,
+                                                                       stale_token=stale_token)
+        # Release the connection before sending again
+        r.content
+        r.close()
+        retry = r.connection.send(prep, **kwargs)
+        retry.history.append(r)
+        retry.request = prep
+        return retry
+
+
+def raise_for_gateway_error(r, **kwargs):
+    """Response hook turning answers of a failing gateway into requests.HTTPError"""
+    if r.status_code >= 500 or r.status_code == 429:
+        r.raise_for_status()
 
 
 class PayPalClient():
@@ -13,17 +195,15 @@ class PayPalClient():
             self.base_url = 'https://api.paypal.com/v1'
 
         self.s = requests.Session()
+        self.s.mount('https://', get_http_adapter())
+        self.s.hooks['response'].append(raise_for_gateway_error)
         self.brand_name = brand_name
         if token:
             self.s.headers.update({'Authorization': 'Bearer %s' % token})
         else:
-            res = self.s.post(self.base_url + '/oauth2/token', auth=(key, secret),
-                              data={'grant_type': 'client_credentials'})
-
-            token = res.json()['access_token']
-            self.s.headers.update({'Authorization': 'Bearer %s' % token})
-            # print(self.s.headers)
+            self.s.auth = PayPalAuth(self.base_url, key, secret)
 
+    @guarded('paypal')
     def create_or_update_product(self, product_id=None, name='', description='', sub_type="SERVICE",
                                  category="SOFTWARE"):
         url = '{}/catalogs/products'.format(self.base_url)
@@ -41,6 +221,7 @@ class PayPalClient():
             res = self.s.post(url, json=data)
         return res.json()
 
+    @guarded('paypal')
     def create_or_update_product_plan(self, product_id, plan_id=None, name='', description=None, interval_unit='MONTH',
                                       interval_count=1, amount=0, currency='USD', include_trial=False,
                                       trial_interval_unit="WEEK", trial_interval_count=1):
@@ -117,10 +298,9 @@ class PayPalClient():
             res = self.s.post(url, json=data)
         return res.json()
 
-    def create_subscription(self, plan_id, email, first_name='', last_name='', return_url=None, cancel_url=None,
-                            start_time=None):
-        url = '{}/billing/subscriptions'.format(self.base_url)
-        data = {
+    def get_subscription_data(self, plan_id, email, first_name='', last_name='', return_url=None, cancel_url=None,
+                              start_time=None):
+        return {
             "plan_id": plan_id,
             "start_time": start_time,
             "subscriber": {
@@ -143,28 +323,47 @@ class PayPalClient():
                 "cancel_url": cancel_url
             }
         }
+
+    @guarded('paypal')
+    def create_subscription(self, plan_id, email, first_name='', last_name='', return_url=None, cancel_url=None,
+                            start_time=None):
+        url = '{}/billing/subscriptions'.format(self.base_url)
+        data = self.get_subscription_data(plan_id, email, first_name, last_name, return_url, cancel_url, start_time)
         res = self.s.post(url, json=data)
         return res.json()
 
+    @guarded('paypal')
+    def get_subscription(self, subscription_id):
+        """Subscription details, None when paypal does not know subscription_id"""
+        url = '{}/billing/subscriptions/{}'.format(self.base_url, subscription_id)
+        res = self.s.get(url)
+        if res.status_code == 404:
+            return None
+        return res.json()
+
+    @guarded('paypal')
     def activate(self, plan_id):
         url = '{}/billing/plans/{}/activate'.format(self.base_url, plan_id)
         res = self.s.post(url)
         if res.status_code != 204:
-            raise requests.ConnectionError(res.content)
+            raise requests.HTTPError(res.content, response=res)
 
+    @guarded('paypal')
     def deactivate(self, plan_id):
         url = '{}/billing/plans/{}/deactivate'.format(self.base_url, plan_id)
         res = self.s.post(url)
         if res.status_code != 204:
-            raise requests.ConnectionError(res.content)
+            raise requests.HTTPError(res.content, response=res)
 
+    @guarded('paypal')
     def cancel_subscription(self, subscription_id):
         url = '{}/billing/subscriptions/{}/cancel'.format(self.base_url, subscription_id)
         res = self.s.post(url, json={})
         if res.status_code != 204:
-            raise requests.ConnectionError(res.content)
+            raise requests.HTTPError(res.content, response=res)
         return True
 
+    @guarded('paypal')
     def update_plan_pricing(self, plan_id, amount, currency='USD'):
         url = '{}/billing/plans/{}/update-pricing-schemes'.format(self.base_url, plan_id)
 
@@ -182,11 +381,80 @@ class PayPalClient():
         }
         res = self.s.post(url, json=data)
         if res.status_code != 204:
-            logger.exception(res.content)
+            raise requests.HTTPError(res.content, response=res)
+        return True
 
+    @guarded('paypal')
     def verify_webhook(self, data):
         url = '{}/notifications/verify-webhook-signature'.format(self.base_url)
         r = self.s.post(url, json=data)
         if r.status_code == 200 and r.json()["verification_status"] == "SUCCESS":
             return True
         return False
+
+
+def get_async_http_client(transport=None):
+    """httpx client shared by all AsyncPayPalClient of the running event loop, so keep-alive connections are reused
+    across checkouts. Same pool size, timeouts and connection retries as the requests adapter."""
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(transport)
+    if client is None:
+        pool_size = saas_billing_settings['PAYPAL_POOL_SIZE']
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        connect_timeout, read_timeout = get_timeout()
+        client = clients[transport] = httpx.AsyncClient(
+            transport=transport or httpx.AsyncHTTPTransport(retries=saas_billing_settings['PAYPAL_MAX_RETRIES'],
+                                                            limits=limits),
+            limits=limits, timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+    return client
+
+
+class AsyncPayPalClient():
+    """Non blocking PayPal client for async views, covers the calls made while a user checks out. Needs httpx."""
+
+    def __init__(self, key, secret, token=None, env='development', brand_name='Paypal', transport=None):
+        if env != 'live':
+            self.base_url = 'https://api.sandbox.paypal.com/v1'
+        else:
+            self.base_url = 'https://api.paypal.com/v1'
+        self.key = key
+        self.secret = secret
+        self.token = token
+        self.brand_name = brand_name
+        self.transport = transport
+
+    get_subscription_data = PayPalClient.get_subscription_data
+
+    async def get_token(self, client, stale_token=None):
+        """Same as get_access_token, shares the tokens of PayPalClient"""
+        if self.token:
+            return self.token
+        token_key = get_token_key(self.base_url, self.key)
+        access_token = get_cached_token(token_key, stale_token)
+        if access_token is None:
+            res = await get_breaker('paypal', 'get_token').acall(
+                client.post, self.base_url + '/oauth2/token', auth=(self.key, self.secret),
+                data={'grant_type': 'client_credentials'})
+            if res.status_code >= 500 or res.status_code == 429:
+                res.raise_for_status()
+            data = res.json()
+            access_token = set_cached_token(token_key, data['access_token'], data.get('expires_in'))
+        return access_token
+
+    async def post(self, client, url, **kwargs):
+        token = await self.get_token(client)
+        res = await client.post(url, headers={'Authorization': 'Bearer %s' % token}, **kwargs)
+        if res.status_code == 401 and not self.token:
+            token = await self.get_token(client, stale_token=token)
+            res = await client.post(url, headers={'Authorization': 'Bearer %s' % token}, **kwargs)
+        if res.status_code >= 500 or res.status_code == 429:
+            res.raise_for_status()
+        return res
+
+    async def create_subscription(self, plan_id, email, first_name='', last_name='', return_url=None, cancel_url=None,
+                                  start_time=None):
+        url = '{}/billing/subscriptions'.format(self.base_url)
+        data = self.get_subscription_data(plan_id, email, first_name, last_name, return_url, cancel_url, start_time)
+        client = get_async_http_client(self.transport)
+        res = await get_breaker('paypal', 'create_subscription').acall(self.post, client, url, json=data)
+        return res.json()
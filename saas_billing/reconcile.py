@@ -0,0 +1,176 @@
+"""Bring local subscriptions back in line with their state at the gateway, e.g. after webhooks were lost.
+
+The reconcile commands turn each gateway subscription into the field values its local UserSubscription should
+have and apply the differences of a whole page with one bulk update.
+"""
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+from collections import Counter
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from subscriptions_api.models import UserSubscription
+from saas_billing.app_settings import SETTINGS
+from saas_billing.webhooks import to_db_datetime
+
+saas_billing_settings = SETTINGS['saas_billing_settings']
+
+_logger = logging.getLogger(__name__)
+
+RECONCILED_FIELDS = ['active', 'cancelled', 'due', 'quantity', 'date_billing_next', 'date_billing_end',
+                     'date_billing_last']
+
+# Billing dates closer than this to the gateway period end are not drift
+DATE_TOLERANCE = timedelta(days=1)
+
+ACTIVE_STATE = {'active': True, 'cancelled': False, 'due': False}
+DUE_STATE = {'due': True}
+CANCELLED_STATE = {'active': False, 'cancelled': True}
+
+# Local state of a stripe subscription status, statuses missing here leave the state alone
+STRIPE_STATUS_STATES = {
+    'active': ACTIVE_STATE,
+    'trialing': ACTIVE_STATE,
+    'past_due': DUE_STATE,
+    'unpaid': DUE_STATE,
+    'canceled': CANCELLED_STATE,
+    'incomplete_expired': CANCELLED_STATE,
+}
+
+# Same as the paypal webhook actions, a cancelled paypal subscription runs until it expires
+PAYPAL_STATUS_STATES = {
+    'ACTIVE': ACTIVE_STATE,
+    'SUSPENDED': CANCELLED_STATE,
+    'EXPIRED': CANCELLED_STATE,
+}
+
+
+def from_timestamp(value):
+    return to_db_datetime(datetime.fromtimestamp(value, dt_timezone.utc)) if value else None
+
+
+def get_stripe_state(data):
+    """Expected local field values of the stripe subscription data"""
+    state = dict(STRIPE_STATUS_STATES.get(data['status'], {}))
+    items = (data.get('items') or {}).get('data') or [{}]
+    quantity = data.get('quantity') or items[0].get('quantity')
+    if quantity:
+        state['quantity'] = quantity
+    if state.get('active'):
+        # Newer api versions moved the billing period to the items
+        state['date_billing_next'] = from_timestamp(data.get('current_period_end') or items[0].get('current_period_end'))
+    return state
+
+
+def get_paypal_state(data):
+    """Expected local field values of the paypal subscription details"""
+    state = dict(PAYPAL_STATUS_STATES.get(data['status'], {}))
+    if data.get('quantity'):
+        state['quantity'] = int(data['quantity'])
+    next_billing_time = (data.get('billing_info') or {}).get('next_billing_time')
+    if state.get('active') and next_billing_time:
+        state['date_billing_next'] = to_db_datetime(parse_datetime(next_billing_time))
+    return state
+
+
+def get_mismatches(subscription, state):
+    """Names of the fields of subscription that differ from state"""
+    mismatches = []
+    for field, value in state.items():
+        current = getattr(subscription, field)
+        if field == 'date_billing_next':
+            if value is not None and (current is None or abs(current - value) > DATE_TOLERANCE):
+                mismatches.append(field)
+        elif current != value:
+            mismatches.append(field)
+    return mismatches
+
+
+def apply_state(subscription, state, mismatches, date):
+    """Same as activate or deactivate of UserSubscription but leaves writing the row, deactivating the previous
+    subscriptions and activating the default subscription to the caller"""
+    was_active = subscription.active
+    for field in mismatches:
+        setattr(subscription, field, state[field])
+    if 'date_billing_next' in mismatches:
+        subscription.date_billing_end = state['date_billing_next'] + timedelta(
+            days=subscription.plan_cost.plan.grace_period)
+    if subscription.active and not was_active:
+        subscription._add_user_to_group()
+    elif was_active and not subscription.active:
+        subscription.date_billing_last = date
+        subscription.due = False
+        subscription._remove_user_from_group()
+
+
+def get_start(subscription):
+    return subscription.date_billing_start.timestamp() if subscription.date_billing_start else 0
+
+
+def deactivate_previous_subscriptions(activated, subscriptions, date):
+    """Deactivate the other active subscriptions of the users of activated, as UserSubscription.activate does with
+    NO_MULTIPLE_SUBSCRIPTION. Of several subscriptions of one user activated together the newest stays active.
+
+    Rows of the page are changed on their instance in subscriptions, by pk. Returns the deactivated subscriptions.
+    """
+    if not saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION'] or not activated:
+        return []
+    newest = {}
+    for subscription in activated:
+        current = newest.get(subscription.user_id)
+        if current is None or get_start(subscription) > get_start(current):
+            newest[subscription.user_id] = subscription
+    kept = {subscription.pk for subscription in newest.values()}
+    previous = {subscription.pk: subscription for subscription in activated if subscription.pk not in kept}
+    for subscription in UserSubscription.objects.filter(active=True, user__in=newest).exclude(
+            pk__in=kept).select_related('plan_cost__plan__group'):
+        previous.setdefault(subscription.pk, subscriptions.get(subscription.pk, subscription))
+    for subscription in previous.values():
+        subscription.active = False
+        subscription.cancelled = True
+        subscription.due = False
+        subscription.date_billing_last = date
+        subscription._remove_user_from_group()
+    # Same group as a removed one, add the user back
+    for subscription in newest.values():
+        subscription._add_user_to_group()
+    return list(previous.values())
+
+
+def reconcile_subscriptions(pairs, dry_run=False, stdout=None):
+    """Fix the local subscriptions of pairs of (subscription, expected state) with one bulk update.
+
+    Returns counts of checked and updated subscriptions and of the mismatched fields.
+    """
+    counts = Counter()
+    changed, activated, deactivated = [], [], []
+    date = timezone.now()
+    for subscription, state in pairs:
+        counts['checked'] += 1
+        mismatches = get_mismatches(subscription, state)
+        if not mismatches:
+            continue
+        counts.update('field.' + field for field in mismatches)
+        _logger.info("Subscription %s drifted from %s on %s", subscription.pk, subscription.reference, mismatches)
+        if stdout:
+            stdout.write('%s %s: %s' % (subscription.reference, subscription.pk, ', '.join(
+                '%s %s -> %s' % (field, getattr(subscription, field), state[field]) for field in mismatches)))
+        if not dry_run:
+            was_active = subscription.active
+            apply_state(subscription, state, mismatches, date)
+            if subscription.active and not was_active:
+                activated.append(subscription)
+            elif was_active and not subscription.active:
+                deactivated.append(subscription)
+            changed.append(subscription)
+    page = {subscription.pk: subscription for subscription, state in pairs}
+    previous = deactivate_previous_subscriptions(activated, page, date)
+    changed_pks = {subscription.pk for subscription in changed}
+    UserSubscription.objects.bulk_update(
+        changed + [subscription for subscription in previous if subscription.pk not in changed_pks],
+        RECONCILED_FIELDS)
+    # After the bulk update, the default subscription can be the row that was just deactivated
+    for subscription in deactivated:
+        subscription.plan_cost.activate_default_user_subscription(subscription.user)
+    counts['updated'] += len(changed)
+    counts['replaced'] += len(previous)
+    return counts
@@ -5,10 +5,8 @@ from django.dispatch import receiver
 from django.db.models.signals import post_save, pre_delete
 
 from cryptocurrency_payment.models import CryptoCurrencyPayment
-from saas_billing.provider import PayPalClient
-from saas_billing.models import StripeSubscriptionPlan, StripeSubscriptionPlanCost, PaypalSubscriptionPlanCost
-
-from saas_billing.provider import PayPalClient
+from saas_billing.models import StripeSubscriptionPlan, StripeSubscriptionPlanCost, PaypalSubscriptionPlanCost, get_paypal_client
+from saas_billing.circuit import guarded_call
 from saas_billing.app_settings import SETTINGS
 
 auth = SETTINGS['billing_auths']
@@ -39,7 +37,7 @@ def save_profile(sender, instance, **kwargs):
 def delete_stripe_subscription_plan_hook(sender, instance, using, **kwargs):
     if instance.plan_ref:
         stripe.api_key = auth['stripe']['LIVE_KEY']
-        obj = stripe.Product.modify(instance.plan_ref, active=False)
+        obj = guarded_call('stripe', 'product.modify', stripe.Product.modify, instance.plan_ref, active=False)
         if obj.active is not False:
             raise ProtectedError
 
@@ -48,7 +46,7 @@ def delete_stripe_subscription_plan_hook(sender, instance, using, **kwargs):
 def delete_stripe_plan_cost_hook(sender, instance, using, **kwargs):
     if instance.cost_ref:
         stripe.api_key = auth['stripe']['LIVE_KEY']
-        obj = stripe.Price.modify(instance.cost_ref, active=False)
+        obj = guarded_call('stripe', 'price.modify', stripe.Price.modify, instance.cost_ref, active=False)
         if obj.active is not False:
             raise ProtectedError
 
@@ -56,7 +54,5 @@ def delete_stripe_plan_cost_hook(sender, instance, using, **kwargs):
 @receiver(pre_delete, sender=PaypalSubscriptionPlanCost)
 def deactivate_paypal_plan_cost(sender, instance, using, **kwargs):
     if instance.cost_ref:
-        paypal = PayPalClient(auth['paypal']['CLIENT_ID'], auth['paypal']['CLIENT_SECRET'],
-                              token=auth['paypal']['TOKEN'],
-                              env=auth['paypal']['ENV'])
+        paypal = get_paypal_client()
         paypal.deactivate(instance.cost_ref)
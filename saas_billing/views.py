@@ -1,5 +1,4 @@
 # Create your views here.
-import stripe
 import logging
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from django.apps import apps
@@ -14,8 +13,9 @@ from subscriptions_api.serializers import UserSubscriptionSerializer
 from cryptocurrency_payment.models import CryptoCurrencyPayment
 
 from saas_billing.serializers import CryptoCurrencyPaymentSerializer, SubscriptionTransactionSerializerPayment
-from saas_billing.provider import PayPalClient
-from saas_billing.models import StripeCustomer, SubscriptionTransaction, auto_activate_subscription, PaypalSubscription
+from saas_billing.models import SubscriptionTransaction, auto_activate_subscription
+from saas_billing.webhooks import store_webhook_event
+from saas_billing import catalog
 from saas_billing.app_settings import SETTINGS
 
 auth = SETTINGS['billing_auths']
@@ -75,123 +75,23 @@ class UserSubscriptionCrypto(UserSubscriptionViewSet):
 
 
 class PaypalWebHook(APIView):
-    
-    def paypal_gateway(self, request):
-        event_type = request.data['event_type']
-        payload = {
-            'auth_algo': request.headers['PAYPAL-AUTH-ALGO'],
-            'cert_url': request.headers['PAYPAL-CERT-URL'],
-            'transmission_id': request.headers['PAYPAL-TRANSMISSION-ID'],
-            'transmission_sig': request.headers['PAYPAL-TRANSMISSION-SIG'],
-            'transmission_time': request.headers['PAYPAL-TRANSMISSION-TIME'],
-            'webhook_id': auth['paypal']['WEB_HOOK_ID'],
-            'webhook_event': request.data
-        }
 
-        paypal = PayPalClient(auth['paypal']['CLIENT_ID'], auth['paypal']['CLIENT_SECRET'],
-                              token=auth['paypal']['TOKEN'],
-                              env=auth['paypal']['ENV'])
-        req = paypal.verify_webhook(payload)
-        if req is True:
-            data = request.data["resource"]
-            subscription_id = data['id']
-            try:
-                subscription = PaypalSubscription.objects.get(subscription_ref=subscription_id).subscription
-            except PaypalSubscription.DoesNotExist:
-                _logger.error("Got webhook payload for subscription but cannot find obj ")
-                _logger.error(data)
-                return Response({})
-            if event_type == 'BILLING.SUBSCRIPTION.ACTIVATED':
-                subscription.activate(no_multiple_subscription=saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION'])
-                subscription.record_transaction(paid=True)
-                subscription.notify_activate()
-            elif event_type == 'BILLING.SUBSCRIPTION.SUSPENDED':
-                subscription.deactivate(activate_default=True)
-                subscription.notify_deactivate()
-            elif event_type == 'BILLING.SUBSCRIPTION.CANCELLED':
-                #subscription.notify_deactivate()#Dont deactivate subscription if subscription is cancelled
-                pass
-            elif event_type == 'BILLING.SUBSCRIPTION.DELETED':
-                subscription.notify_deactivate()
-                subscription.deactivate(activate_default=True)
-            elif event_type == 'BILLING.SUBSCRIPTION.EXPIRED':
-                subscription.deactivate(activate_default=True)
-                subscription.notify_expired()
-            elif event_type == 'BILLING.SUBSCRIPTION.PAYMENT.FAILED':
-                subscription.notify_payment_error()
-            elif event_type == 'BILLING.SUBSCRIPTION.RE-ACTIVATED':
-                pass
-            elif event_type == 'BILLING.SUBSCRIPTION.RENEWED':
-                pass
-            elif event_type == 'BILLING.SUBSCRIPTION.UPDATED':
-                pass
-            else:
-                pass
-            return Response({})
-
-        
-        
-class StripeWebHook(APIView):
+    def post(self, request):
+        try:
+            store_webhook_event('paypal', request)
+        except ValueError:
+            return Response(status=HTTP_400_BAD_REQUEST)
+        return Response({})
 
-    def get_local_customer(self, customer):
-        stripe_customer = StripeCustomer.objects.get(customer_id=customer)
-        return stripe_customer
 
+class StripeWebHook(APIView):
 
     def post(self, request):
-        payload = request.data
         try:
-            event = stripe.Event.construct_from(
-                payload, auth['stripe']['LIVE_KEY']
-            )
+            store_webhook_event('stripe', request)
         except ValueError:
             # Invalid payload
             return Response(status=HTTP_400_BAD_REQUEST)
-
-            # Handle the event
-        data = event.data.object
-        if 'customer.subscription' in event.type:
-            customer = data.customer
-            stripe_costomer = self.get_local_customer(customer=customer)
-            subscription = stripe_costomer.get_or_create_subscription(data)
-            subscription_status = data['status']
-
-            if subscription_status == 'active' or subscription_status == 'trialing':
-                subscription.record_transaction(paid=True)
-                subscription.activate(no_multiple_subscription=saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION'])
-            elif subscription_status == 'incomplete':
-                subscription.notify_payment_error()
-            elif subscription_status == 'trial_will_end':
-                subscription.notify_due()
-            elif subscription_status == 'incomplete_expired':
-                subscription.deactivate(activate_default=True)
-                subscription.notify_deactivate()
-            elif subscription_status == 'past_due' or subscription_status == 'unpaid':
-                subscription.notify_due()
-            elif subscription_status == 'expired':
-                subscription.deactivate(activate_default=True)
-                subscription.notify_expired()
-            elif subscription_status == 'canceled':
-                #subscription.notify_deactivate()
-                pass
-            elif event.type == 'customer.subscription.deleted':
-                subscription.deactivate(activate_default=True)
-                subscription.notify_deactivate()
-        # elif 'invoice' in event.type:
-        #     invoice = event.data.object  # contains a stripe.PaymentMethod
-        #     stripe_costomer = self.get_local_customer(customer=invoice.customer)
-        #     subscription = stripe_costomer.get_or_create_subscription(request.user, invoice)
-        #     if event.type == 'invoice.paid':
-        #         subscription.notify_payment_success()
-        #     elif event.type == 'invoice.created':
-        #         subscription.notify_new()
-        #     elif event.type == 'invoice.upcoming':
-        #         subscription.notify_due()
-        #     elif event.type == 'invoice.payment_failed':
-        #         subscription.notify_payment_error()
-        else:
-            return Response(status=HTTP_400_BAD_REQUEST)
-
         return Response({})
 
 
@@ -249,9 +149,7 @@ class PlanCostCryptoUserSubscriptionView(PlanCostViewSet):
     def init_gateway_subscription(self, request, pk=None):
         cost = self.get_object()
         gateway = self.request.data['gateway']
-        cost_model_str = SETTINGS['billing_models'][gateway]['cost']
-        Model = apps.get_model(cost_model_str)
-        external_cost = Model.objects.get(cost=cost)
+        external_cost = catalog.get_external_cost(gateway, cost)
         qty = request.data.get('quantity', 1)
         if qty <  cost.min_subscription_quantity:
             return Response({'detail': 'Quantity must not be less than {} to subscribe to this plan'.format(cost.min_subscription_quantity)},
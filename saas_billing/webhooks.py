@@ -0,0 +1,504 @@
+"""Gateway webhook handlers.
+
+Webhook views only store the request as a WebhookEvent, the events are handled here by the process_webhooks command.
+"""
+import json
+import zlib
+import base64
+import stripe
+import logging
+import requests
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from datetime import datetime, timedelta, timezone as dt_timezone
+from urllib.parse import urlparse
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from saas_billing.models import StripeCustomer, PaypalSubscription, WebhookEvent, get_paypal_client
+from saas_billing.app_settings import SETTINGS
+from saas_billing import instrumentation
+
+auth = SETTINGS['billing_auths']
+saas_billing_settings = SETTINGS['saas_billing_settings']
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+    # Paypal webhooks are verified remotely without cryptography
+    x509 = None
+
+PAYPAL_CERT_HOSTS = ('api.paypal.com', 'api-m.paypal.com', 'api.sandbox.paypal.com', 'api-m.sandbox.paypal.com')
+
+_paypal_certificates = {}
+_paypal_certificates_lock = threading.Lock()
+
+HANDLERS = {}
+COALESCED_EVENT_TYPES = set()
+
+HEADER_PREFIXES = {
+    'stripe': 'STRIPE-',
+    'paypal': 'PAYPAL-',
+}
+
+EVENT_TYPE_KEYS = {
+    'stripe': 'type',
+    'paypal': 'event_type',
+}
+
+
+class WebhookError(Exception):
+    """Webhook event that cannot be handled, e.g. failed signature verification"""
+
+
+def to_db_datetime(value):
+    if value is None or settings.USE_TZ:
+        return value
+    return timezone.make_naive(value)
+
+
+def get_event_object(gateway, payload):
+    """Gateway reference of the object an event is about and when the event happened at the gateway"""
+    try:
+        if gateway == 'stripe':
+            return (str(payload['data']['object']['id']),
+                    to_db_datetime(datetime.fromtimestamp(int(payload['created']), dt_timezone.utc)))
+        return str(payload['resource']['id']), to_db_datetime(parse_datetime(payload['create_time']))
+    except (KeyError, TypeError, ValueError):
+        return None, None
+
+
+def store_webhook_event(gateway, request):
+    """Store the raw body and gateway headers of a webhook request.
+
+    Event types without a registered handler are not stored. Deliveries are deduplicated on the gateway event id
+    with a unique index, a retried or duplicate delivery is not stored again.
+    Returns the event, None when ignored, and whether it was created. Raises ValueError if the body is not json.
+    """
+    body = request.body.decode('utf-8')
+    payload = json.loads(body)
+    if not isinstance(payload, dict):
+        raise ValueError('Webhook body is not a json object')
+    event_type = str(payload.get(EVENT_TYPE_KEYS[gateway]) or '')
+    if get_handler(gateway, event_type) is None:
+        instrumentation.increment('webhook.{}.{}.ignored'.format(gateway, event_type))
+        return None, False
+    prefix = HEADER_PREFIXES[gateway]
+    headers = {key.upper(): value for key, value in request.headers.items() if key.upper().startswith(prefix)}
+    event_id = payload.get('id') or headers.get('PAYPAL-TRANSMISSION-ID')
+    object_ref, occurred_at = get_event_object(gateway, payload)
+    event = WebhookEvent(gateway=gateway, event_id=event_id, event_type=event_type[:100], body=body,
+                         headers=json.dumps(headers), object_ref=object_ref, occurred_at=occurred_at)
+    try:
+        with transaction.atomic():
+            event.save()
+    except IntegrityError:
+        _logger.info("Ignoring duplicate %s webhook event %s", gateway, event_id)
+        instrumentation.increment('webhook.{}.{}.duplicate'.format(gateway, event_type))
+        return event, False
+    return event, True
+
+
+def register(gateway, *event_types, coalesce=False):
+    """Register the decorated function as the handler of event_types of gateway.
+
+    Handlers are called by process_webhooks with the WebhookEvent, in a savepoint. Registering a handler for an
+    event type that already has one replaces it, so projects can override or add event types from their app ready.
+    Events without a handler are acknowledged by the webhook views without being stored.
+    Set coalesce for event types carrying the full state of their object, of several such events for one object
+    only the newest is handled and events older than the last handled one are dropped.
+    """
+    def decorator(handler):
+        for event_type in event_types:
+            HANDLERS[(gateway, event_type)] = handler
+            if coalesce:
+                COALESCED_EVENT_TYPES.add((gateway, event_type))
+            else:
+                COALESCED_EVENT_TYPES.discard((gateway, event_type))
+        return handler
+    return decorator
+
+
+def get_handler(gateway, event_type):
+    return HANDLERS.get((gateway, event_type))
+
+
+def record_paid_transaction(subscription, webhook_event):
+    """Record the payment of an activation event once, returns False when webhook_event already recorded it,
+    e.g. when the event is replayed"""
+    if webhook_event is not None and webhook_event.transactions.exists():
+        return False
+    transaction = subscription.record_transaction(paid=True)
+    if webhook_event is not None:
+        transaction.webhook_event = webhook_event
+        transaction.save(update_fields=['webhook_event'])
+    return True
+
+
+def activate_stripe_subscription(subscription, webhook_event=None):
+    if record_paid_transaction(subscription, webhook_event):
+        subscription.activate(no_multiple_subscription=saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION'])
+
+
+def deactivate_subscription(subscription, webhook_event=None):
+    subscription.deactivate(activate_default=True)
+    subscription.notify_deactivate()
+
+
+def expire_subscription(subscription, webhook_event=None):
+    subscription.deactivate(activate_default=True)
+    subscription.notify_expired()
+
+
+STRIPE_SUBSCRIPTION_STATUS_ACTIONS = {
+    'active': activate_stripe_subscription,
+    'trialing': activate_stripe_subscription,
+    'incomplete': lambda subscription, webhook_event: subscription.notify_payment_error(),
+    'trial_will_end': lambda subscription, webhook_event: subscription.notify_due(),
+    'incomplete_expired': deactivate_subscription,
+    'past_due': lambda subscription, webhook_event: subscription.notify_due(),
+    'unpaid': lambda subscription, webhook_event: subscription.notify_due(),
+    'expired': expire_subscription,
+    'canceled': None,
+}
+
+
+# Every customer.subscription event carries the subscription, its status decides the action
+STRIPE_SUBSCRIPTION_EVENT_TYPES = (
+    'customer.subscription.created', 'customer.subscription.updated', 'customer.subscription.deleted',
+    'customer.subscription.trial_will_end', 'customer.subscription.paused', 'customer.subscription.resumed',
+    'customer.subscription.pending_update_applied', 'customer.subscription.pending_update_expired',
+)
+
+
+@register('stripe', *STRIPE_SUBSCRIPTION_EVENT_TYPES, coalesce=True)
+def handle_stripe_subscription(webhook_event):
+    event = stripe.Event.construct_from(webhook_event.payload, auth['stripe']['LIVE_KEY'])
+    data = event.data.object
+    stripe_customer = StripeCustomer.objects.get(customer_id=data.customer)
+    subscription = stripe_customer.get_or_create_subscription(data)
+    subscription_status = data['status']
+    if subscription_status in STRIPE_SUBSCRIPTION_STATUS_ACTIONS:
+        action = STRIPE_SUBSCRIPTION_STATUS_ACTIONS[subscription_status]
+        if action:
+            action(subscription, webhook_event)
+    elif event.type == 'customer.subscription.deleted':
+        deactivate_subscription(subscription, webhook_event)
+
+
+def get_certificate_validity(certificate):
+    if hasattr(certificate, 'not_valid_after_utc'):
+        return certificate.not_valid_before_utc, certificate.not_valid_after_utc
+    return (certificate.not_valid_before.replace(tzinfo=dt_timezone.utc),
+            certificate.not_valid_after.replace(tzinfo=dt_timezone.utc))
+
+
+def get_paypal_certificate(cert_url):
+    """Paypal signing certificate at cert_url, downloaded once per process and again after it expires.
+
+    Only https urls on paypal api hosts are accepted, so a forged cert url cannot supply its own key.
+    """
+    url = urlparse(cert_url)
+    if url.scheme != 'https' or url.hostname not in PAYPAL_CERT_HOSTS:
+        raise WebhookError('Paypal certificate url {} is not allowed'.format(cert_url))
+    now = datetime.now(dt_timezone.utc)
+    with _paypal_certificates_lock:
+        certificate = _paypal_certificates.get(cert_url)
+        if certificate is None or get_certificate_validity(certificate)[1] < now:
+            res = requests.get(cert_url, timeout=10)
+            res.raise_for_status()
+            certificate = x509.load_pem_x509_certificate(res.content)
+            _paypal_certificates[cert_url] = certificate
+    valid_from, valid_to = get_certificate_validity(certificate)
+    if not valid_from <= now <= valid_to:
+        raise WebhookError('Paypal certificate {} is not valid at {}'.format(cert_url, now))
+    return certificate
+
+
+def verify_paypal_signature(body, headers):
+    """Check the transmission signature of a paypal webhook against the paypal certificate in process.
+
+    Paypal signs transmission_id|transmission_time|webhook_id|crc32 of the raw body with SHA256withRSA.
+    """
+    certificate = get_paypal_certificate(headers['PAYPAL-CERT-URL'])
+    crc = zlib.crc32(body.encode('utf-8')) & 0xffffffff
+    message = '{}|{}|{}|{}'.format(headers['PAYPAL-TRANSMISSION-ID'], headers['PAYPAL-TRANSMISSION-TIME'],
+                                   auth['paypal']['WEB_HOOK_ID'], crc)
+    try:
+        signature = base64.b64decode(headers['PAYPAL-TRANSMISSION-SIG'])
+        certificate.public_key().verify(signature, message.encode('utf-8'), padding.PKCS1v15(), hashes.SHA256())
+    except (InvalidSignature, ValueError):
+        return False
+    return True
+
+
+def verify_paypal_event(event):
+    """Verify a paypal webhook locally, or with the paypal verify-webhook-signature api when
+    PAYPAL_WEBHOOK_VERIFICATION is remote, cryptography is not installed or the algorithm is not SHA256withRSA."""
+    headers = event.get_headers()
+    local = saas_billing_settings['PAYPAL_WEBHOOK_VERIFICATION'] == 'local' and x509 is not None
+    if local and headers.get('PAYPAL-AUTH-ALGO') == 'SHA256withRSA':
+        return verify_paypal_signature(event.body, headers)
+    data = {
+        'auth_algo': headers['PAYPAL-AUTH-ALGO'],
+        'cert_url': headers['PAYPAL-CERT-URL'],
+        'transmission_id': headers['PAYPAL-TRANSMISSION-ID'],
+        'transmission_sig': headers['PAYPAL-TRANSMISSION-SIG'],
+        'transmission_time': headers['PAYPAL-TRANSMISSION-TIME'],
+        'webhook_id': auth['paypal']['WEB_HOOK_ID'],
+        'webhook_event': event.payload
+    }
+    return get_paypal_client().verify_webhook(data)
+
+
+def get_paypal_subscription(event):
+    """Verify a paypal event and return the subscription of its resource, None when it is unknown"""
+    if verify_paypal_event(event) is not True:
+        raise WebhookError('Paypal webhook signature verification failed')
+    data = event.payload["resource"]
+    try:
+        return PaypalSubscription.objects.get(subscription_ref=data['id']).subscription
+    except PaypalSubscription.DoesNotExist:
+        _logger.error("Got webhook payload for subscription but cannot find obj ")
+        _logger.error(data)
+        return None
+
+
+def paypal_subscription_handler(action):
+    """Handler running action with the verified subscription of a paypal event"""
+    def handler(event):
+        subscription = get_paypal_subscription(event)
+        if subscription is not None:
+            action(subscription, event)
+    return handler
+
+
+def activate_paypal_subscription(subscription, webhook_event=None):
+    if record_paid_transaction(subscription, webhook_event):
+        subscription.activate(no_multiple_subscription=saas_billing_settings['NO_MULTIPLE_SUBSCRIPTION'])
+        subscription.notify_activate()
+
+
+def delete_paypal_subscription(subscription, webhook_event=None):
+    subscription.notify_deactivate()
+    subscription.deactivate(activate_default=True)
+
+
+# Event type: (action, whether the event sets the subscription state and can be coalesced)
+PAYPAL_SUBSCRIPTION_ACTIONS = {
+    'BILLING.SUBSCRIPTION.ACTIVATED': (activate_paypal_subscription, True),
+    'BILLING.SUBSCRIPTION.SUSPENDED': (deactivate_subscription, True),
+    'BILLING.SUBSCRIPTION.DELETED': (delete_paypal_subscription, True),
+    'BILLING.SUBSCRIPTION.EXPIRED': (expire_subscription, True),
+    'BILLING.SUBSCRIPTION.PAYMENT.FAILED': (lambda subscription, webhook_event: subscription.notify_payment_error(),
+                                            False),
+    # BILLING.SUBSCRIPTION.CANCELLED does not deactivate the subscription, it runs until it expires
+}
+
+for paypal_event_type, (paypal_action, paypal_coalesce) in PAYPAL_SUBSCRIPTION_ACTIONS.items():
+    register('paypal', paypal_event_type, coalesce=paypal_coalesce)(paypal_subscription_handler(paypal_action))
+
+
+def process_webhook_event(event, retry=True):
+    """Run the gateway handler of event in a savepoint and record the outcome on the event.
+
+    With retry a failed event stays pending for the next drain until WEBHOOK_MAX_ATTEMPTS is reached,
+    otherwise it is marked failed at once. Returns True when the event was handled.
+    """
+    event.attempts += 1
+    handler = get_handler(event.gateway, event.event_type)
+    name = 'webhook.{}.{}'.format(event.gateway, event.event_type)
+    try:
+        with instrumentation.timed(name), transaction.atomic():
+            if handler is not None:
+                handler(event)
+    except Exception as e:
+        _logger.exception("Failed to process %s webhook event %s", event.gateway, event.pk)
+        instrumentation.increment(name + '.failed')
+        event.error = repr(e)
+        if not retry or event.attempts >= saas_billing_settings['WEBHOOK_MAX_ATTEMPTS']:
+            event.status = WebhookEvent.STATUS_FAILED
+        event.save(update_fields=['attempts', 'error', 'status'])
+        return False
+    instrumentation.increment(name + '.processed')
+    event.status = WebhookEvent.STATUS_PROCESSED
+    event.error = ''
+    event.processed_at = timezone.now()
+    event.save(update_fields=['attempts', 'error', 'status', 'processed_at'])
+    return True
+
+
+def skip_webhook_events(events, reason):
+    for event in events:
+        event.status = WebhookEvent.STATUS_SKIPPED
+        event.error = reason
+        event.processed_at = timezone.now()
+        instrumentation.increment('webhook.{}.{}.skipped'.format(event.gateway, event.event_type))
+    WebhookEvent.objects.bulk_update(events, ['status', 'error', 'processed_at'])
+
+
+def is_coalesced(event):
+    return event.object_ref is not None and (event.gateway, event.event_type) in COALESCED_EVENT_TYPES
+
+
+def get_last_applied(events):
+    """Gateway time of the newest handled state event of each object of events, keyed by (gateway, object_ref).
+
+    The rows of events themselves are left out, so a replayed event is only compared with the other events.
+    """
+    last_applied = {}
+    for gateway in {event.gateway for event in events}:
+        object_refs = {event.object_ref for event in events if event.gateway == gateway}
+        event_types = [event_type for event_gateway, event_type in COALESCED_EVENT_TYPES if event_gateway == gateway]
+        rows = WebhookEvent.objects.filter(
+            gateway=gateway, object_ref__in=object_refs, event_type__in=event_types,
+            status=WebhookEvent.STATUS_PROCESSED, occurred_at__isnull=False,
+        ).exclude(pk__in=[event.pk for event in events]).values('object_ref').annotate(last_occurred_at=Max('occurred_at'))
+        for row in rows:
+            last_applied[(gateway, row['object_ref'])] = row['last_occurred_at']
+    return last_applied
+
+
+def order_webhook_events(events, check_stale=True):
+    """Order a batch of events by gateway time per object and coalesce state events.
+
+    Of the state events of one object only the newest is kept, with check_stale state events older than the last
+    state handled for their object are stale. Returns the events to handle and the superseded and stale events.
+    """
+    coalesced = [event for event in events if is_coalesced(event)]
+    last_applied = get_last_applied(coalesced) if coalesced and check_stale else {}
+    newest = {}
+    for event in coalesced:
+        key = (event.gateway, event.object_ref)
+        if key not in newest or get_event_order(event) > get_event_order(newest[key]):
+            newest[key] = event
+    ordered, superseded, stale = [], [], []
+    for event in sorted(events, key=get_event_order):
+        if not is_coalesced(event):
+            ordered.append(event)
+            continue
+        key = (event.gateway, event.object_ref)
+        if newest[key] is not event:
+            superseded.append(event)
+        elif key in last_applied and event.occurred_at is not None and event.occurred_at < last_applied[key]:
+            stale.append(event)
+        else:
+            ordered.append(event)
+    return ordered, superseded, stale
+
+
+def get_event_order(event):
+    return event.occurred_at or event.received_at, event.pk
+
+
+def claim_webhook_events(batch_size, last_pk=None):
+    """Lock the next batch of pending events after last_pk, must be called in a transaction.
+
+    Events received in the last WEBHOOK_COALESCE_SECONDS are left for the next drain, so a burst of events for
+    one object lands in one batch. Events locked by another process_webhooks runner are skipped on databases
+    with SKIP LOCKED.
+    """
+    queryset = WebhookEvent.objects.filter(status=WebhookEvent.STATUS_PENDING).order_by('pk')
+    if last_pk is not None:
+        queryset = queryset.filter(pk__gt=last_pk)
+    if saas_billing_settings['WEBHOOK_COALESCE_SECONDS']:
+        received_before = timezone.now() - timedelta(seconds=saas_billing_settings['WEBHOOK_COALESCE_SECONDS'])
+        queryset = queryset.filter(received_at__lte=received_before)
+    if connection.features.has_select_for_update_skip_locked:
+        queryset = queryset.select_for_update(skip_locked=True)
+    return list(queryset[:batch_size])
+
+
+def process_webhook_events(batch_size=None):
+    """Drain pending webhook events, in gateway time order per object with state events coalesced.
+
+    Returns the counts of processed, failed and skipped events.
+    """
+    batch_size = batch_size or saas_billing_settings['WEBHOOK_BATCH_SIZE']
+    counts = {'processed': 0, 'failed': 0, 'skipped': 0}
+    last_pk = None
+    while True:
+        with transaction.atomic():
+            events = claim_webhook_events(batch_size, last_pk)
+            if not events:
+                return counts
+            ordered, superseded, stale = order_webhook_events(events)
+            skip_webhook_events(superseded, 'superseded by a newer event')
+            skip_webhook_events(stale, 'older than the last handled event')
+            counts['skipped'] += len(superseded) + len(stale)
+            for event in ordered:
+                if process_webhook_event(event):
+                    counts['processed'] += 1
+                else:
+                    counts['failed'] += 1
+        last_pk = events[-1].pk
+
+
+def replay_events(events, close_connection=False):
+    """Handle events again one after another, returns the number of handled and failed events"""
+    handled = failed = 0
+    try:
+        for event in events:
+            if process_webhook_event(event, retry=False):
+                handled += 1
+            else:
+                failed += 1
+    finally:
+        if close_connection:
+            # Worker threads open their own connection
+            connection.close()
+    return handled, failed
+
+
+def replay_webhook_events(queryset, workers=1, batch_size=None, dry_run=False):
+    """Run stored events of queryset through their handlers again.
+
+    Events are streamed in pages on the primary key. Each page is ordered and coalesced like a drain, so an
+    object whose state event was superseded in the page only gets its newest state, and the events of one object
+    are handled in order by one worker. State events older than the last state handled for their object are stale
+    and skipped, so a replay never rolls an object back. With dry_run nothing is handled.
+    Returns the counts of replayed, failed, superseded and stale events and the replayed counts per gateway event
+    type.
+    """
+    batch_size = batch_size or saas_billing_settings['WEBHOOK_BATCH_SIZE']
+    counts = {'replayed': 0, 'failed': 0, 'superseded': 0, 'stale': 0, 'types': Counter()}
+    queryset = queryset.order_by('pk')
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 and not dry_run else None
+    last_pk = None
+    try:
+        while True:
+            page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            events = list(page[:batch_size])
+            if not events:
+                return counts
+            last_pk = events[-1].pk
+            ordered, superseded, stale = order_webhook_events(events)
+            counts['superseded'] += len(superseded)
+            counts['stale'] += len(stale)
+            counts['types'].update('{}.{}'.format(event.gateway, event.event_type) for event in ordered)
+            if dry_run:
+                counts['replayed'] += len(ordered)
+                continue
+            if executor is None:
+                results = [replay_events(ordered)]
+            else:
+                buckets = [[] for i in range(workers)]
+                for event in ordered:
+                    key = '{}|{}'.format(event.gateway, event.object_ref or event.pk)
+                    buckets[zlib.crc32(key.encode('utf-8')) % workers].append(event)
+                results = executor.map(partial(replay_events, close_connection=True), buckets)
+            for handled, failed in results:
+                counts['replayed'] += handled
+                counts['failed'] += failed
+    finally:
+        if executor is not None:
+            executor.shutdown()
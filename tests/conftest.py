@@ -1,3 +1,6 @@
+import pytest
+
+
 def pytest_configure():
     from django.conf import settings
 
@@ -139,3 +142,10 @@ def pytest_configure():
         django.setup()
     except AttributeError:
         pass
+
+
+@pytest.fixture(autouse=True)
+def clear_catalog():
+    # Test transactions are rolled back without signals, do not let one test see the catalog of another
+    from saas_billing import catalog
+    catalog.clear()
@@ -1,4 +1,5 @@
 import pytest
+from decimal import Decimal
 from datetime import timedelta
 from django.utils import timezone
 from django.urls import reverse
@@ -9,7 +10,7 @@ from unittest.mock import patch
 from django.contrib.auth.models import User
 from subscriptions_api.models import PlanCost, SubscriptionPlan, UserSubscription
 
-from saas_billing.models import SubscriptionTransaction
+from saas_billing.models import SubscriptionTransaction, CreditBalance
 from saas_billing.management.commands.process_subscriptions import Manager
 from cryptocurrency_payment.models import CryptoCurrencyPayment
 
@@ -82,8 +83,8 @@ class BaseTest(APITestCase):
         cost = self.create_plan_cost("Basic Plan", cost=0)
         # Create a subscription cost with 0
         subscription = cost.setup_user_subscription(self.user)
-        transaction = SubscriptionTransaction.objects.create(subscription=subscription, amount=-10,
-                                                             user=self.user, date_transaction=timezone.now())
+        SubscriptionTransaction.objects.create(subscription=subscription, amount=-10, user=self.user,
+                                               date_transaction=timezone.now())
         basic_cost = self.create_plan_cost("Basic Plan", cost=6)
         cost_url = reverse('saas_billing:plan-costs-subscribe_user_crypto', kwargs={'pk': basic_cost.pk})
 
@@ -92,8 +93,7 @@ class BaseTest(APITestCase):
         UserSubscription.objects.get(pk=r.data['subscription']).deactivate()
         self.assertEqual(r.status_code, status.HTTP_201_CREATED)
         active_transaction = SubscriptionTransaction.objects.get(pk=r.data['transaction'])
-        transaction.refresh_from_db()
-        self.assertEqual(float(transaction.amount), -4)
+        self.assertEqual(float(CreditBalance.objects.get(user=self.user).balance), 4)
         self.assertEqual(active_transaction.amount, 0)
         CryptoCurrencyPayment.objects.filter(user=self.user).update(status=CryptoCurrencyPayment.PAYMENT_PAID)
         cost_url = reverse('saas_billing:plan-costs-subscribe_user_crypto', kwargs={'pk': basic_cost.pk})
@@ -102,8 +102,7 @@ class BaseTest(APITestCase):
 
         self.assertEqual(r.status_code, status.HTTP_201_CREATED)
         active_transaction = SubscriptionTransaction.objects.get(pk=r.data['transaction'])
-        transaction.refresh_from_db()
-        self.assertEqual(float(transaction.amount), 0)
+        self.assertEqual(float(CreditBalance.objects.get(user=self.user).balance), 0)
         self.assertEqual(active_transaction.amount, 2)
 
     @patch('saas_billing.signals.save_profile')
@@ -221,5 +220,16 @@ class BaseTest(APITestCase):
         self.assertEqual(float(transaction.amount), 100)
         self.assertEqual(transaction.date_transaction, subscription.date_billing_next)
 
+    def test_negative_transaction_credited_and_used(self):
+        subscription = self.cost.setup_user_subscription(self.user)
+        SubscriptionTransaction.objects.create(subscription=subscription, amount=-10.5, user=self.user,
+                                               date_transaction=timezone.now())
+        SubscriptionTransaction.objects.create(subscription=subscription, amount=-4.5, user=self.user,
+                                               date_transaction=timezone.now())
+        self.assertEqual(CreditBalance.objects.get(user=self.user).balance, Decimal('15.00'))
+        self.assertEqual(CreditBalance.use_credit(self.user, 9.99), Decimal('0.00'))
+        self.assertEqual(CreditBalance.use_credit(self.user, 9.99), Decimal('4.98'))
+        self.assertEqual(CreditBalance.objects.get(user=self.user).balance, Decimal('0.00'))
+
     def test_user_can_subscribe_to_plan_cost(self):
         pass
@@ -0,0 +1,121 @@
+import time
+import pytest
+from io import StringIO
+from unittest.mock import patch, Mock
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
+from rest_framework.test import APITestCase
+
+from subscriptions_api.models import PlanCost, SubscriptionPlan
+
+from saas_billing.models import (StripeSubscriptionPlan, StripeSubscriptionPlanCost, PaypalSubscriptionPlan,
+                                 PaypalSubscriptionPlanCost)
+from saas_billing.management.commands.billing import RateLimiter
+
+
+@pytest.mark.django_db
+class BillingCommandTest(APITestCase):
+
+    def setUp(self):
+        self.plans = []
+        for i in range(3):
+            plan = SubscriptionPlan(plan_name='Plan %s' % i)
+            plan.save()
+            PlanCost(cost=10 + i, plan=plan).save()
+            self.plans.append(plan)
+        patches = [
+            patch('stripe.Product.create', side_effect=lambda **kwargs: Mock(id='prod_%s' % kwargs['name'])),
+            patch('stripe.Product.modify'),
+            patch('stripe.Price.create', side_effect=lambda **kwargs: Mock(id='price_%s' % kwargs['nickname'])),
+            patch('saas_billing.provider.PayPalClient.create_or_update_product',
+                  side_effect=lambda product_id=None, **kwargs: {'id': product_id or 'PROD-%s' % kwargs['name']}),
+            patch('saas_billing.provider.PayPalClient.create_or_update_product_plan',
+                  side_effect=lambda **kwargs: {'id': 'P-%s' % kwargs['name']}),
+            patch('saas_billing.provider.PayPalClient.update_plan_pricing'),
+        ]
+        self.mocks = {}
+        for p in patches:
+            self.mocks[p.attribute] = p.start()
+            self.addCleanup(p.stop)
+
+    def call_billing(self, *args):
+        out = StringIO()
+        call_command('billing', *args, '--workers', '1', '--rate', '0', stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_sync_all(self):
+        out = self.call_billing('all')
+        self.assertEqual(StripeSubscriptionPlan.objects.exclude(plan_ref=None).count(), 3)
+        self.assertEqual(StripeSubscriptionPlanCost.objects.exclude(cost_ref=None).count(), 3)
+        self.assertEqual(PaypalSubscriptionPlan.objects.exclude(plan_ref='').count(), 3)
+        self.assertEqual(PaypalSubscriptionPlanCost.objects.exclude(cost_ref=None).count(), 3)
+        self.assertIn('stripe plan created=3 updated=0 skipped=0 failed=0', out)
+        self.assertIn('paypal cost created=3 updated=0 skipped=0 failed=0', out)
+        self.assertIn('Synced gateways created=12 updated=0 skipped=0 failed=0', out)
+
+    def test_unchanged_objects_skipped(self):
+        self.call_billing('all')
+        for mock in self.mocks.values():
+            mock.reset_mock()
+        out = self.call_billing('all')
+        self.assertIn('Synced gateways created=0 updated=0 skipped=12 failed=0', out)
+        self.assertFalse(any(mock.called for mock in self.mocks.values()))
+
+    def test_changed_objects_updated(self):
+        self.call_billing('all')
+        self.plans[0].plan_name = 'Renamed'
+        self.plans[0].save()
+        cost = self.plans[1].costs.get()
+        cost.cost = 99
+        cost.save()
+        out = self.call_billing('paypal')
+        self.assertIn('paypal plan created=0 updated=1 skipped=2 failed=0', out)
+        self.assertIn('paypal cost created=0 updated=1 skipped=2 failed=0', out)
+        self.assertEqual(self.mocks['update_plan_pricing'].call_args[1]['amount'], 99)
+
+        out = self.call_billing('paypal', '--force')
+        self.assertIn('paypal plan created=0 updated=3 skipped=0 failed=0', out)
+
+    def test_changes_not_pushed_are_not_marked_synced(self):
+        free_plan = SubscriptionPlan(plan_name='Free Plan')
+        free_plan.save()
+        PlanCost(cost=0, plan=free_plan).save()
+        out = self.call_billing('stripe')
+        self.assertIn('stripe cost created=3 updated=0 skipped=1 failed=0', out)
+        self.assertIn('free plan cost', out)
+        cost = self.plans[1].costs.get()
+        cost.cost = 99
+        cost.save()
+        for mock in self.mocks.values():
+            mock.reset_mock()
+        out = self.call_billing('stripe', '--model', 'cost')
+        self.assertIn('stripe cost created=0 updated=0 skipped=4 failed=0', out)
+        self.assertIn('stripe prices cannot be changed', out)
+        self.assertFalse(self.mocks['create'].called)
+        self.assertTrue(StripeSubscriptionPlanCost.objects.get(cost=cost).needs_sync())
+
+    def test_failures_counted(self):
+        self.mocks['create'] = patch('stripe.Product.create', side_effect=[Mock(id='prod_1'), ValueError, Mock(id='prod_3')]).start()
+        self.addCleanup(patch.stopall)
+        with self.assertRaises(CommandError):
+            self.call_billing('stripe', '--model', 'plan')
+        self.assertEqual(StripeSubscriptionPlan.objects.exclude(plan_ref=None).count(), 2)
+        self.assertEqual(StripeSubscriptionPlan.objects.filter(plan_ref=None, sync_hash=None).count(), 1)
+
+
+class RateLimiterTest(SimpleTestCase):
+
+    def test_calls_spaced(self):
+        limiter = RateLimiter(50)
+        start = time.monotonic()
+        for i in range(5):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 4 / 50.0)
+
+    def test_no_limit(self):
+        limiter = RateLimiter(0)
+        start = time.monotonic()
+        for i in range(100):
+            limiter.wait()
+        self.assertLess(time.monotonic() - start, 0.05)
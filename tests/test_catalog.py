@@ -0,0 +1,81 @@
+import pytest
+from django.core.cache import cache
+from rest_framework.test import APITestCase
+
+from django.contrib.auth.models import User
+from subscriptions_api.models import PlanCost, SubscriptionPlan
+
+from saas_billing import catalog
+from saas_billing.models import (StripeSubscriptionPlan, StripeSubscriptionPlanCost, PaypalSubscriptionPlanCost,
+                                 BillingPlanCost)
+
+
+@pytest.mark.django_db
+class CatalogTest(APITestCase):
+
+    def setUp(self):
+        self.plan = SubscriptionPlan(plan_name='Pro Plan', grace_period=3)
+        self.plan.save()
+        self.cost = PlanCost(cost=10, plan=self.plan)
+        self.cost.save()
+        StripeSubscriptionPlan.objects.create(plan=self.plan, plan_ref='prod_pro')
+        self.stripe_cost = StripeSubscriptionPlanCost.objects.create(cost=self.cost, cost_ref='price_pro')
+        self.paypal_cost = PaypalSubscriptionPlanCost.objects.create(cost=self.cost, cost_ref=None)
+
+    def test_lookups_without_queries(self):
+        catalog.get_index()
+        with self.assertNumQueries(0):
+            cost = catalog.get_cost('stripe', 'price_pro')
+            self.assertEqual(cost, self.cost)
+            self.assertEqual(cost.plan.grace_period, 3)
+            external_cost = catalog.get_external_cost('stripe', self.cost)
+            self.assertEqual(external_cost, self.stripe_cost)
+            self.assertEqual(external_cost.cost_ref, 'price_pro')
+            self.assertIs(external_cost.cost, self.cost)
+            self.assertEqual(catalog.get_external_cost('paypal', self.cost.pk).cost.plan, self.plan)
+            index = catalog.get_index()
+            self.assertEqual(index.cost_refs['stripe'], {self.cost.pk: 'price_pro'})
+            self.assertEqual(index.plan_ids['stripe'], {'prod_pro': self.plan.pk})
+            self.assertEqual(index.cost_refs['paypal'], {})
+
+    def test_instances_not_shared(self):
+        catalog.get_cost('stripe', 'price_pro').cost = 99
+        self.assertEqual(catalog.get_cost('stripe', 'price_pro').cost, 10)
+
+    def test_invalidated_on_change(self):
+        catalog.get_index()
+        self.stripe_cost.cost_ref = 'price_new'
+        self.stripe_cost.save()
+        self.assertEqual(catalog.get_cost('stripe', 'price_new'), self.cost)
+        with self.assertRaises(StripeSubscriptionPlanCost.DoesNotExist):
+            catalog.get_cost('stripe', 'price_pro')
+
+        self.paypal_cost.delete()
+        with self.assertRaises(PaypalSubscriptionPlanCost.DoesNotExist):
+            BillingPlanCost.objects.get(pk=self.cost.pk).setup_subscription(None, 'paypal')
+
+    def test_other_models_ignored(self):
+        index = catalog.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.create_user('demo_user')
+        self.assertIs(catalog.get_index(), index)
+
+    def test_other_processes_invalidated(self):
+        catalog.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            version = cache.get(catalog.VERSION_KEY)
+            self.plan.save()
+        self.assertNotEqual(cache.get(catalog.VERSION_KEY), version)
+
+        index = catalog.get_index()
+        # Another process changed the catalog
+        cache.set(catalog.VERSION_KEY, 'other')
+        self.assertIsNot(catalog.get_index(), index)
+        with self.assertNumQueries(0):
+            catalog.get_index()
+
+    def test_unindexed_rows_queried(self):
+        catalog.get_index()
+        StripeSubscriptionPlanCost.objects.filter(pk=self.stripe_cost.pk).update(cost_ref='price_bulk')
+        with self.assertNumQueries(1):
+            self.assertEqual(catalog.get_cost('stripe', 'price_bulk'), self.cost)
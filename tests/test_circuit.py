@@ -0,0 +1,135 @@
+import pytest
+from unittest.mock import patch, Mock
+import requests
+import stripe
+from django.test import SimpleTestCase
+from rest_framework.test import APITestCase
+from rest_framework import status
+
+from django.contrib.auth.models import User
+from subscriptions_api.models import PlanCost, SubscriptionPlan
+
+from saas_billing import circuit, instrumentation, provider
+from saas_billing.circuit import GatewayUnavailable, get_breaker, guarded_call
+from saas_billing.models import StripeSubscriptionPlanCost
+from saas_billing.provider import PayPalClient
+
+from tests.test_paypal_client import StubAdapter
+
+CIRCUIT_SETTINGS = {'CIRCUIT_WINDOW': 4, 'CIRCUIT_MIN_CALLS': 4, 'CIRCUIT_FAILURE_RATE': 0.5,
+                    'CIRCUIT_SLOW_SECONDS': 10, 'CIRCUIT_OPEN_SECONDS': 30}
+
+
+@patch.dict(circuit.saas_billing_settings, CIRCUIT_SETTINGS)
+class CircuitBreakerTest(SimpleTestCase):
+
+    def setUp(self):
+        circuit.reset()
+        instrumentation.reset()
+
+    def fail(self, times=1):
+        func = Mock(side_effect=requests.ConnectionError)
+        for i in range(times):
+            with self.assertRaises(requests.ConnectionError):
+                guarded_call('paypal', 'create_subscription', func)
+
+    def test_opens_on_failure_rate(self):
+        guarded_call('paypal', 'create_subscription', Mock())
+        guarded_call('paypal', 'create_subscription', Mock())
+        self.fail()
+        self.assertEqual(get_breaker('paypal', 'create_subscription').state, circuit.STATE_CLOSED)
+        self.fail()
+        func = Mock()
+        with self.assertRaises(GatewayUnavailable):
+            guarded_call('paypal', 'create_subscription', func)
+        self.assertFalse(func.called)
+        stats = instrumentation.get_stats()
+        self.assertEqual(stats['states']['circuit.paypal.create_subscription'], circuit.STATE_OPEN)
+        self.assertEqual(stats['counters']['circuit.paypal.create_subscription.rejected'], 1)
+        self.assertEqual(stats['timings']['gateway.paypal.create_subscription']['count'], 4)
+
+    def test_breakers_per_operation(self):
+        self.fail(4)
+        self.assertEqual(guarded_call('paypal', 'activate', Mock(return_value=True)), True)
+
+    def test_answers_of_gateway_are_not_failures(self):
+        func = Mock(side_effect=stripe.error.InvalidRequestError('No such price', 'price'))
+        for i in range(4):
+            with self.assertRaises(stripe.error.InvalidRequestError):
+                guarded_call('stripe', 'price.create', func)
+        self.assertEqual(get_breaker('stripe', 'price.create').state, circuit.STATE_CLOSED)
+
+    @patch('saas_billing.provider.request_token', return_value={'access_token': 'token', 'expires_in': 32400})
+    def test_paypal_client_errors_are_not_failures(self, token_post):
+        provider.reset_tokens()
+        paypal = PayPalClient('client-id', 'secret')
+        adapter = StubAdapter(*[(422, {'name': 'UNPROCESSABLE_ENTITY'})] * 4 + [(503, {})] * 2)
+        paypal.s.mount('https://', adapter)
+        for i in range(4):
+            with self.assertRaises(requests.HTTPError) as e:
+                paypal.cancel_subscription('I-1')
+            self.assertEqual(e.exception.response.status_code, 422)
+        self.assertEqual(get_breaker('paypal', 'cancel_subscription').state, circuit.STATE_CLOSED)
+        for i in range(2):
+            with self.assertRaises(requests.HTTPError):
+                paypal.cancel_subscription('I-1')
+        self.assertEqual(get_breaker('paypal', 'cancel_subscription').state, circuit.STATE_OPEN)
+
+    def test_slow_calls_are_failures(self):
+        with patch('saas_billing.circuit.time.monotonic', side_effect=[0, 11] * 4 + [11]):
+            for i in range(4):
+                guarded_call('stripe', 'customer.create', Mock())
+        self.assertEqual(get_breaker('stripe', 'customer.create').state, circuit.STATE_OPEN)
+
+    def test_half_open_probe(self):
+        self.fail(4)
+        breaker = get_breaker('paypal', 'create_subscription')
+        breaker.opened_at -= 31
+        self.fail()
+        self.assertEqual(breaker.state, circuit.STATE_OPEN)
+        with self.assertRaises(GatewayUnavailable):
+            guarded_call('paypal', 'create_subscription', Mock())
+
+        breaker.opened_at -= 31
+        self.assertEqual(guarded_call('paypal', 'create_subscription', Mock(return_value='ok')), 'ok')
+        self.assertEqual(breaker.state, circuit.STATE_CLOSED)
+        self.assertEqual(instrumentation.get_stats()['states']['circuit.paypal.create_subscription'],
+                         circuit.STATE_CLOSED)
+
+    def test_only_one_probe_while_half_open(self):
+        self.fail(4)
+        breaker = get_breaker('paypal', 'create_subscription')
+        breaker.opened_at -= 31
+
+        def probe():
+            with self.assertRaises(GatewayUnavailable):
+                guarded_call('paypal', 'create_subscription', Mock())
+            return 'ok'
+        self.assertEqual(guarded_call('paypal', 'create_subscription', probe), 'ok')
+        self.assertEqual(breaker.state, circuit.STATE_CLOSED)
+
+
+@pytest.mark.django_db
+class CircuitViewTest(APITestCase):
+
+    def setUp(self):
+        circuit.reset()
+        self.user = User.objects.create_user('demo_user', email='test@gmail.com')
+        self.client.force_authenticate(self.user)
+        plan = SubscriptionPlan(plan_name='Basic Plan')
+        plan.save()
+        self.cost = PlanCost(cost=10, plan=plan)
+        self.cost.save()
+        StripeSubscriptionPlanCost.objects.create(cost=self.cost, cost_ref='price_1')
+
+    def tearDown(self):
+        circuit.reset()
+
+    def test_open_circuit_returns_503(self):
+        get_breaker('stripe', 'customer.create').set_state(circuit.STATE_OPEN)
+        with patch('stripe.Customer.create') as customer_create:
+            r = self.client.post('/billing/plan-costs/{}/init_gateway_subscription/'.format(self.cost.pk),
+                                 {'gateway': 'stripe'}, format='json')
+        self.assertEqual(r.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(r.data['detail'].code, 'gateway_unavailable')
+        self.assertFalse(customer_create.called)
@@ -0,0 +1,106 @@
+import pytest
+import stripe
+from io import StringIO
+from unittest.mock import patch, Mock
+from django.core.management import call_command
+from django.db import connection, IntegrityError
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+
+from django.contrib.auth.models import User, Group
+from subscriptions_api.models import PlanCost, SubscriptionPlan, UserSubscription
+
+from saas_billing.models import StripeCustomer, StripeSubscription, StripeSubscriptionPlanCost
+
+PERIOD_END = 1900000000
+
+
+@pytest.mark.django_db
+class ImportStripeTest(APITestCase):
+
+    def setUp(self):
+        self.group = Group.objects.create(name='pro')
+        plan = SubscriptionPlan(plan_name='Pro Plan', group=self.group)
+        plan.save()
+        self.cost = PlanCost(cost=10, plan=plan)
+        self.cost.save()
+        StripeSubscriptionPlanCost.objects.create(cost=self.cost, cost_ref='price_pro')
+        free_plan = SubscriptionPlan(plan_name='Free Plan')
+        free_plan.save()
+        self.free_cost = PlanCost(cost=0, plan=free_plan)
+        self.free_cost.save()
+        self.users = [User.objects.create_user('user_%s' % i, email='User%s@example.com' % i) for i in range(4)]
+
+    def customer(self, i):
+        return stripe.Customer.construct_from({'id': 'cus_%s' % i, 'object': 'customer',
+                                               'email': 'user%s@example.com' % i}, 'sk_test')
+
+    def subscription(self, i, status='active', price='price_pro', customer=None, created=None):
+        return stripe.Subscription.construct_from({
+            'id': 'sub_%s' % i, 'object': 'subscription', 'status': status, 'customer': customer or 'cus_%s' % i,
+            'created': created, 'start_date': PERIOD_END - 86400 * 30, 'current_period_end': PERIOD_END,
+            'items': {'object': 'list', 'data': [{'id': 'si_%s' % i, 'object': 'subscription_item', 'quantity': 2,
+                                                  'price': {'id': price, 'object': 'price'}}]}
+        }, 'sk_test')
+
+    def call_import(self, customers, subscriptions, *args):
+        out = StringIO()
+        with patch('stripe.Customer.list', return_value=Mock(auto_paging_iter=lambda: iter(customers))), \
+                patch('stripe.Subscription.list', return_value=Mock(auto_paging_iter=lambda: iter(subscriptions))):
+            call_command('import_stripe', *args, stdout=out)
+        return out.getvalue()
+
+    def test_import(self):
+        self.free_cost.setup_user_subscription(self.users[0], active=True)
+        customers = [self.customer(i) for i in range(5)]
+        subscriptions = [self.subscription(0), self.subscription(1, 'canceled'), self.subscription(2, price='price_x'),
+                         self.subscription(4)]
+        out = self.call_import(customers, subscriptions)
+        self.assertIn('Customers fetched=5 created=4 existing=0 unmatched=1', out)
+        self.assertIn('Subscriptions fetched=4 created=2 existing=0 activated=1 replaced=1 unknown_customer=1 '
+                      'unknown_price=1', out)
+        self.assertEqual(StripeCustomer.objects.get(customer_id='cus_1').user, self.users[1])
+        subscription = StripeSubscription.objects.get(subscription_ref='sub_0').subscription
+        self.assertEqual(subscription.user, self.users[0])
+        self.assertEqual(subscription.reference, 'stripe')
+        self.assertEqual(subscription.quantity, 2)
+        self.assertTrue(subscription.active)
+        self.assertIsNotNone(subscription.date_billing_next)
+        self.assertIn(self.group, self.users[0].groups.all())
+        self.assertEqual(self.users[0].subscriptions.filter(active=True).get(), subscription)
+        self.assertTrue(StripeSubscription.objects.get(subscription_ref='sub_1').subscription.cancelled)
+
+        out = self.call_import(customers, subscriptions)
+        self.assertIn('Customers fetched=5 created=0 existing=4 unmatched=1', out)
+        self.assertIn('Subscriptions fetched=4 created=0 existing=2', out)
+        self.assertEqual(UserSubscription.objects.filter(reference='stripe').count(), 2)
+
+    def test_existing_subscription_reused(self):
+        existing = self.cost.setup_user_subscription(self.users[0], active=False)
+        self.call_import([self.customer(0)], [self.subscription(0)])
+        self.assertEqual(StripeSubscription.objects.get(subscription_ref='sub_0').subscription, existing)
+        self.assertEqual(self.users[0].subscriptions.count(), 1)
+
+    def test_only_newest_active_subscription_kept(self):
+        subscriptions = [self.subscription(i, customer='cus_0', created=PERIOD_END - 86400 * i) for i in (2, 0, 1)]
+        for args in ((), ('--batch-size', '1')):
+            UserSubscription.objects.all().delete()
+            StripeSubscription.objects.all().delete()
+            out = self.call_import([self.customer(0)], subscriptions, *args)
+            self.assertIn('created=3 existing=0 activated=', out)
+            self.assertIn('replaced=2', out)
+            self.assertEqual(self.users[0].subscriptions.get(active=True).stripe_subscription.subscription_ref, 'sub_0')
+
+    def test_page_rolled_back_when_linking_fails(self):
+        with patch('saas_billing.models.StripeSubscription.objects.bulk_create', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.call_import([self.customer(0)], [self.subscription(0)])
+        self.assertFalse(UserSubscription.objects.exists())
+
+    def test_queries_per_page(self):
+        customers = [self.customer(i) for i in range(4)]
+        subscriptions = [self.subscription(i) for i in range(4)]
+        with CaptureQueriesContext(connection) as queries:
+            out = self.call_import(customers, subscriptions, '--batch-size', '2')
+        self.assertIn('Subscriptions fetched=4 created=4', out)
+        self.assertLessEqual(len(queries.captured_queries), 40)
@@ -0,0 +1,203 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+import requests
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from saas_billing import provider
+from saas_billing.provider import PayPalClient, get_access_token, get_token_key
+
+
+class StubAdapter(requests.adapters.BaseAdapter):
+    """Answer requests with the queued (status, body) tuples and keep the sent requests"""
+
+    def __init__(self, *responses):
+        super().__init__()
+        self.responses = list(responses)
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        status_code, body = self.responses.pop(0)
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(body).encode()
+        response.request = request
+        response.url = request.url
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+def token_response(access_token, expires_in=32400):
+    return {'access_token': access_token, 'expires_in': expires_in}
+
+
+class PayPalTokenTest(SimpleTestCase):
+
+    def setUp(self):
+        provider.reset_tokens()
+        cache.clear()
+
+    def create_client(self, *responses):
+        client = PayPalClient('client-id', 'secret')
+        adapter = StubAdapter(*responses)
+        client.s.mount('https://', adapter)
+        return client, adapter
+
+    @patch('saas_billing.provider.request_token', return_value=token_response('token-1'))
+    def test_token_shared_by_clients(self, token_post):
+        client, adapter = self.create_client((200, {'id': 'I-1'}), (200, {'id': 'I-2'}))
+        client.create_subscription('P-1', 'test@gmail.com')
+        other = PayPalClient('client-id', 'secret')
+        other.s.mount('https://', adapter)
+        other.create_subscription('P-1', 'test@gmail.com')
+        self.assertEqual(token_post.call_count, 1)
+        self.assertEqual([r.headers['Authorization'] for r in adapter.requests], ['Bearer token-1'] * 2)
+
+    @patch('saas_billing.provider.request_token', return_value=token_response('token-1'))
+    def test_client_creation_does_not_request_token(self, token_post):
+        PayPalClient('client-id', 'secret')
+        self.assertFalse(token_post.called)
+
+    @patch('saas_billing.provider.request_token', side_effect=[token_response('token-1'), token_response('token-2')])
+    def test_token_refreshed_before_expiry(self, token_post):
+        self.assertEqual(get_access_token('https://paypal', 'client-id', 'secret'), 'token-1')
+        with patch('saas_billing.provider.time.time', return_value=time.time() + 32400 - 200):
+            self.assertEqual(get_access_token('https://paypal', 'client-id', 'secret'), 'token-2')
+        self.assertEqual(token_post.call_count, 2)
+
+    @patch('saas_billing.provider.request_token', side_effect=[token_response('token-1'), token_response('token-2')])
+    def test_retry_once_on_401(self, token_post):
+        client, adapter = self.create_client((401, {'error': 'invalid_token'}), (200, {'id': 'I-1'}))
+        self.assertEqual(client.create_subscription('P-1', 'test@gmail.com'), {'id': 'I-1'})
+        self.assertEqual([r.headers['Authorization'] for r in adapter.requests], ['Bearer token-1', 'Bearer token-2'])
+        self.assertEqual(get_access_token(client.base_url, 'client-id', 'secret'), 'token-2')
+
+    @patch('saas_billing.provider.request_token', side_effect=[token_response('token-1'), token_response('token-2')])
+    def test_static_token_not_refreshed(self, token_post):
+        client = PayPalClient('client-id', 'secret', token='static')
+        adapter = StubAdapter((401, {'error': 'invalid_token'}))
+        client.s.mount('https://', adapter)
+        client.create_subscription('P-1', 'test@gmail.com')
+        self.assertEqual(len(adapter.requests), 1)
+        self.assertFalse(token_post.called)
+
+    def test_one_token_request_for_concurrent_threads(self):
+        def slow_token(*args, **kwargs):
+            time.sleep(0.05)
+            return token_response('token-1')
+
+        with patch('saas_billing.provider.request_token', side_effect=slow_token) as token_post:
+            tokens = []
+            threads = [threading.Thread(target=lambda: tokens.append(get_access_token('https://paypal', 'client-id', 'secret')))
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(tokens, ['token-1'] * 8)
+        self.assertEqual(token_post.call_count, 1)
+
+    @patch('saas_billing.provider.request_token', return_value=token_response('token-1'))
+    def test_token_shared_through_django_cache(self, token_post):
+        get_access_token('https://paypal', 'client-id', 'secret')
+        # Another process starts without tokens in memory
+        provider.reset_tokens()
+        self.assertEqual(get_access_token('https://paypal', 'client-id', 'secret'), 'token-1')
+        self.assertEqual(token_post.call_count, 1)
+        self.assertEqual(cache.get(get_token_key('https://paypal', 'client-id'))['access_token'], 'token-1')
+
+    @patch('saas_billing.provider.request_token', side_effect=[token_response('token-1'), token_response('token-2')])
+    def test_fresh_shared_token_replaces_stale_local_token(self, token_post):
+        get_access_token('https://paypal', 'client-id', 'secret')
+        token_key = get_token_key('https://paypal', 'client-id')
+        # The token of this process is due for refresh, another process already stored a new one
+        provider._tokens[token_key]['refresh_at'] = time.time() - 1
+        cache.set(token_key, {'access_token': 'token-other', 'refresh_at': time.time() + 3600})
+        self.assertEqual(get_access_token('https://paypal', 'client-id', 'secret'), 'token-other')
+        self.assertEqual(token_post.call_count, 1)
+        # A token rejected by paypal is not taken from the cache again
+        self.assertEqual(get_access_token('https://paypal', 'client-id', 'secret', stale_token='token-other'),
+                         'token-2')
+
+    def test_token_requested_over_shared_adapter(self):
+        adapter = StubAdapter((200, token_response('token-1')))
+        with patch('saas_billing.provider.get_http_adapter', return_value=adapter), \
+                patch('saas_billing.provider._token_session', None):
+            self.assertEqual(get_access_token('https://paypal', 'client-id', 'secret'), 'token-1')
+        self.assertEqual(adapter.requests[0].url, 'https://paypal/oauth2/token')
+
+
+class StubPayPalHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def answer(self):
+        self.server.requests.append((self.command, self.client_address[1]))
+        status_code, headers = self.server.responses.pop(0) if self.server.responses else (200, {})
+        if headers.pop('delay', None):
+            time.sleep(0.5)
+        body = b'{}'
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = answer
+
+    def log_message(self, *args):
+        pass
+
+
+class PayPalTransportTest(SimpleTestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubPayPalHandler)
+        self.server.requests = []
+        self.server.responses = []
+        # The timeout test drops its connection while the handler still answers
+        self.server.handle_error = lambda request, client_address: None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%s/v1/billing/subscriptions' % self.server.server_port
+        provider._adapter = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        provider._adapter = None
+
+    def create_client(self):
+        client = PayPalClient('client-id', 'secret', token='static')
+        client.s.mount('http://', provider.get_http_adapter())
+        return client
+
+    def test_connections_reused_across_clients(self):
+        for i in range(5):
+            self.create_client().s.get(self.url)
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len({port for method, port in self.server.requests}), 1)
+
+    def test_idempotent_request_retried_after_retry_after(self):
+        self.server.responses = [(503, {'Retry-After': '0'}), (429, {'Retry-After': '0'})]
+        res = self.create_client().s.get(self.url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_post_not_retried(self):
+        self.server.responses = [(503, {'Retry-After': '0'})]
+        with self.assertRaises(requests.HTTPError):
+            self.create_client().s.post(self.url, json={})
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_default_read_timeout(self):
+        self.server.responses = [(200, {'delay': True})]
+        with patch.dict(provider.saas_billing_settings, {'PAYPAL_READ_TIMEOUT': 0.1, 'PAYPAL_MAX_RETRIES': 0}):
+            with self.assertRaises(requests.ReadTimeout):
+                self.create_client().s.post(self.url, json={})
@@ -0,0 +1,336 @@
+import json
+import pytest
+from io import StringIO
+from datetime import timedelta
+from unittest.mock import patch
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.core.management import call_command
+from rest_framework.test import APITestCase
+
+from django.contrib.auth.models import Group, User
+from subscriptions_api.models import PlanCost, SubscriptionPlan, UserSubscription, DAY
+
+from saas_billing.models import SubscriptionLease, BillingRun, CreditBalance, SubscriptionCrypto, SubscriptionFailure
+from saas_billing.management.commands.process_subscriptions import Manager, run_manager, get_replay_dates
+
+
+@pytest.mark.django_db
+class ProcessSubscriptionsTest(APITestCase):
+
+    def setUp(self):
+        self.cost = self.create_plan_cost("Basic Plan", cost=100)
+
+    def create_plan_cost(self, name, cost=9.99):
+        plan = SubscriptionPlan(plan_name=name)
+        plan.save()
+        cost = PlanCost(cost=cost, plan=plan)
+        cost.save()
+        return cost
+
+    def create_subscriptions(self, count, days_ago):
+        subscriptions = []
+        for i in range(User.objects.count(), User.objects.count() + count):
+            user = User.objects.create_user('user_{}'.format(i), email='user{}@test.com'.format(i))
+            subscription_date = timezone.now() - timedelta(days=days_ago)
+            subscriptions.append(self.cost.setup_user_subscription(user=user, active=True,
+                                                                   subscription_date=subscription_date))
+        return subscriptions
+
+    def create_pending_subscription(self, cost, user, start_date):
+        subscription = cost.setup_user_subscription(user=user, active=False)
+        subscription.date_billing_start = start_date
+        subscription.save()
+        return subscription
+
+    def test_expired_subscriptions_processed_in_batches(self):
+        subscriptions = self.create_subscriptions(5, days_ago=31)
+        manager = Manager(batch_size=2)
+        manager.process_expired_subscriptions(timezone.now())
+        self.assertEqual(manager.stats['expired'], 5)
+        for subscription in subscriptions:
+            subscription.refresh_from_db()
+            self.assertFalse(subscription.active)
+            self.assertTrue(subscription.cancelled)
+
+    def test_expired_subscription_on_default_plan_reactivated(self):
+        subscription, = self.create_subscriptions(1, days_ago=31)
+        with patch.dict('subscriptions_api.models.SETTINGS', {'default_plan_cost_id': self.cost.pk}):
+            manager = Manager()
+            manager.process_expired_subscriptions(timezone.now())
+        self.assertEqual(manager.stats['expired'], 1)
+        subscription.refresh_from_db()
+        self.assertTrue(subscription.active)
+        self.assertGreater(subscription.date_billing_end, timezone.now())
+
+    @patch('saas_billing.models.SubscriptionTransaction.create_payment')
+    def test_due_subscriptions_processed_in_batches(self, create_payment):
+        subscriptions = self.create_subscriptions(5, days_ago=24)
+        manager = Manager(batch_size=2)
+        manager.process_one_week_due_subscriptions(timezone.now())
+        self.assertEqual(manager.stats['overdue'], 5)
+        self.assertEqual(create_payment.call_count, 5)
+        for subscription in subscriptions:
+            subscription.refresh_from_db()
+            self.assertTrue(subscription.due)
+            self.assertEqual(float(subscription.transactions.all()[0].amount), 100)
+
+    @patch('saas_billing.models.SubscriptionTransaction.create_payment')
+    def test_due_subscription_queries_per_subscription_constant(self, create_payment):
+        query_counts = []
+        for count in (2, 4, 6):
+            self.create_subscriptions(count, days_ago=24)
+            with CaptureQueriesContext(connection) as queries:
+                Manager(batch_size=10).process_one_week_due_subscriptions(timezone.now())
+            query_counts.append(len(queries.captured_queries))
+        self.assertEqual(query_counts[2] - query_counts[1], query_counts[1] - query_counts[0])
+
+    def test_process_subscriptions_command(self):
+        subscriptions = self.create_subscriptions(3, days_ago=31)
+        call_command('process_subscriptions', '--batch-size', '2')
+        self.assertFalse(UserSubscription.objects.filter(pk__in=[s.pk for s in subscriptions], active=True).exists())
+
+    def test_shards_cover_all_subscriptions_once(self):
+        subscriptions = self.create_subscriptions(7, days_ago=31)
+        processed = 0
+        for index in range(3):
+            manager = Manager(batch_size=2, shard=(index, 3))
+            manager.process_expired_subscriptions(timezone.now())
+            processed += manager.stats['expired']
+        self.assertEqual(processed, len(subscriptions))
+        self.assertFalse(UserSubscription.objects.filter(pk__in=[s.pk for s in subscriptions], active=True).exists())
+
+    def test_subscription_leased_by_other_runner_skipped(self):
+        leased, free = self.create_subscriptions(2, days_ago=31)
+        SubscriptionLease.objects.create(subscription=leased, owner='other-runner',
+                                         expires_at=timezone.now() + timedelta(minutes=10))
+        manager = Manager(batch_size=10, lock=True)
+        manager.process_expired_subscriptions(timezone.now())
+        self.assertEqual(manager.stats['expired'], 1)
+        leased.refresh_from_db()
+        free.refresh_from_db()
+        self.assertTrue(leased.active)
+        self.assertFalse(free.active)
+        self.assertEqual(list(SubscriptionLease.objects.values_list('owner', flat=True)), ['other-runner'])
+
+    def test_expired_lease_taken_over(self):
+        subscription, = self.create_subscriptions(1, days_ago=31)
+        SubscriptionLease.objects.create(subscription=subscription, owner='crashed-runner',
+                                         expires_at=timezone.now() - timedelta(minutes=1))
+        manager = Manager(batch_size=10, lock=True)
+        manager.process_expired_subscriptions(timezone.now())
+        subscription.refresh_from_db()
+        self.assertFalse(subscription.active)
+        self.assertFalse(SubscriptionLease.objects.exists())
+
+    def test_run_recorded(self):
+        self.create_subscriptions(3, days_ago=31)
+        run_manager(batch_size=2)
+        run = BillingRun.objects.get()
+        self.assertTrue(run.completed)
+        self.assertEqual(run.phase, 'new')
+        self.assertEqual(json.loads(run.counts)['expired'], 3)
+        self.assertIn('expired', json.loads(run.timings))
+
+    @patch('saas_billing.models.SubscriptionTransaction.create_payment')
+    def test_resume_continues_from_checkpoint(self, create_payment):
+        expired = self.create_subscriptions(1, days_ago=31)[0]
+        expired.due = True
+        expired.save()
+        due = sorted(self.create_subscriptions(3, days_ago=24), key=lambda subscription: subscription.pk)
+        BillingRun.objects.create(command='process_subscriptions', run_date=timezone.now(), phase='due',
+                                  last_key=str(due[0].pk), counts='{"overdue": 1}')
+        stats = run_manager(resume=True)
+        self.assertEqual(stats['overdue'], 3)
+        self.assertEqual(stats['expired'], 0)
+        expired.refresh_from_db()
+        self.assertTrue(expired.active)
+        due[0].refresh_from_db()
+        self.assertFalse(due[0].due)
+        self.assertEqual(BillingRun.objects.filter(completed=True).count(), 1)
+
+    def test_incremental_run_skips_rows_before_watermark(self):
+        old, recent = self.create_subscriptions(2, days_ago=31)
+        recent.date_billing_end = timezone.now() - timedelta(hours=1)
+        recent.save()
+        BillingRun.objects.create(command='process_subscriptions', run_date=timezone.now() - timedelta(hours=2),
+                                  completed=True)
+        stats = run_manager(incremental=True)
+        self.assertEqual(stats['expired'], 1)
+        old.refresh_from_db()
+        recent.refresh_from_db()
+        self.assertTrue(old.active)
+        self.assertFalse(recent.active)
+
+    @patch('saas_billing.models.SubscriptionTransaction.create_payment')
+    def test_incremental_run_bills_daily_plan_activated_after_watermark(self, create_payment):
+        self.cost.recurrence_unit = DAY
+        self.cost.save()
+        BillingRun.objects.create(command='process_subscriptions', run_date=timezone.now() - timedelta(hours=2),
+                                  completed=True)
+        subscription, = self.create_subscriptions(1, days_ago=0)
+        stats = run_manager(incremental=True)
+        self.assertEqual(stats['overdue'], 1)
+        subscription.refresh_from_db()
+        self.assertTrue(subscription.due)
+
+    def test_replay_date_range_in_day_order(self):
+        subscription, = self.create_subscriptions(1, days_ago=36)
+        subscription.due = True
+        subscription.save()
+        expiry_date = subscription.date_billing_end
+        dates = get_replay_dates((timezone.now() - timedelta(days=10)).date())
+        self.assertEqual(len(dates), 11)
+        stats = run_manager(dates=dates)
+        self.assertEqual(stats['expired'], 1)
+        subscription.refresh_from_db()
+        self.assertFalse(subscription.active)
+        # Deactivated on the first replayed day after it expired, not today
+        self.assertGreaterEqual(subscription.date_billing_last, expiry_date)
+        self.assertLess(subscription.date_billing_last - expiry_date, timedelta(days=1))
+        run = BillingRun.objects.get()
+        self.assertEqual(run.phase, '{}:new'.format(timezone.now().date().isoformat()))
+        self.assertEqual(len(json.loads(run.timings)), 44)
+
+    @patch('saas_billing.models.SubscriptionTransaction.create_payment')
+    def test_due_subscription_renewed_from_credit(self, create_payment):
+        subscription, = self.create_subscriptions(1, days_ago=24)
+        CreditBalance.add_credit(subscription.user, 150)
+        manager = Manager()
+        manager.process_one_week_due_subscriptions(timezone.now())
+        self.assertEqual(manager.stats['activated'], 1)
+        self.assertFalse(create_payment.called)
+        self.assertEqual(CreditBalance.objects.get(user=subscription.user).balance, 50)
+
+    @patch('saas_billing.models.SubscriptionTransaction.create_payment')
+    def test_due_payment_uses_last_crypto(self, create_payment):
+        litecoin, bitcoin = self.create_subscriptions(2, days_ago=24)
+        SubscriptionCrypto.objects.create(subscription=litecoin, crypto='LITECOIN')
+        Manager().process_one_week_due_subscriptions(timezone.now())
+        self.assertCountEqual([call.args[0] for call in create_payment.call_args_list], ['LITECOIN', 'BITCOIN'])
+
+    @patch('saas_billing.models.create_new_payment')
+    def test_create_payment_records_last_crypto(self, create_new_payment):
+        subscription, = self.create_subscriptions(1, days_ago=1)
+        transaction = subscription.record_transaction()
+        transaction.create_payment('LITECOIN')
+        transaction.create_payment('BITCOIN')
+        self.assertEqual(SubscriptionCrypto.objects.get(subscription=subscription).crypto, 'BITCOIN')
+
+    @patch('saas_billing.models.SubscriptionTransaction.create_payment')
+    def test_failed_subscription_recorded_and_sweep_continues(self, create_payment):
+        subscriptions = sorted(self.create_subscriptions(3, days_ago=24), key=lambda subscription: subscription.pk)
+        create_payment.side_effect = [None, ConnectionError('price feed down'), None]
+        manager = Manager(batch_size=10)
+        manager.process_one_week_due_subscriptions(timezone.now())
+        self.assertEqual(manager.stats['overdue'], 2)
+        self.assertEqual(manager.stats['failed'], 1)
+        failed = subscriptions[1]
+        failed.refresh_from_db()
+        self.assertFalse(failed.due)
+        self.assertFalse(failed.transactions.exists())
+        failure = SubscriptionFailure.objects.get()
+        self.assertEqual((failure.subscription_id, failure.phase), (failed.pk, 'due'))
+        self.assertIn('price feed down', failure.error)
+
+        create_payment.side_effect = None
+        manager = Manager(batch_size=10)
+        manager.process_one_week_due_subscriptions(timezone.now())
+        self.assertEqual(manager.stats['overdue'], 1)
+        failed.refresh_from_db()
+        self.assertTrue(failed.due)
+        self.assertFalse(SubscriptionFailure.objects.exists())
+
+    def test_incremental_run_retries_failures(self):
+        subscription, = self.create_subscriptions(1, days_ago=31)
+        SubscriptionFailure.objects.create(subscription=subscription, phase='expired', error='')
+        BillingRun.objects.create(command='process_subscriptions', run_date=timezone.now() - timedelta(hours=2),
+                                  completed=True)
+        stats = run_manager(incremental=True)
+        self.assertEqual(stats['expired'], 1)
+        self.assertFalse(SubscriptionFailure.objects.exists())
+
+    def test_failed_default_activation_retried(self):
+        subscription, = self.create_subscriptions(1, days_ago=31)
+        with patch.dict('subscriptions_api.models.SETTINGS', {'default_plan_cost_id': self.cost.pk}):
+            with patch('subscriptions_api.models.PlanCost.activate_default_user_subscription',
+                       side_effect=ValueError('database hiccup')):
+                stats = run_manager()
+            # The default phase of the same run retried it once
+            self.assertEqual((stats['expired'], stats['failed']), (1, 2))
+            subscription.refresh_from_db()
+            self.assertFalse(subscription.active)
+            failure = SubscriptionFailure.objects.get()
+            self.assertEqual((failure.phase, failure.attempts), ('default', 2))
+
+            stats = run_manager(incremental=True)
+        self.assertEqual((stats['expired'], stats['default']), (0, 1))
+        subscription.refresh_from_db()
+        self.assertTrue(subscription.active)
+        self.assertFalse(SubscriptionFailure.objects.exists())
+
+    def test_new_subscriptions_activated_in_batches(self):
+        group = Group.objects.create(name='basic')
+        self.cost.plan.group = group
+        self.cost.plan.save()
+        subscriptions = [self.create_pending_subscription(self.cost, User.objects.create_user('pending_{}'.format(i)),
+                                                          timezone.now() - timedelta(days=1)) for i in range(5)]
+        future = self.create_pending_subscription(self.cost, User.objects.create_user('future'),
+                                                  timezone.now() + timedelta(days=1))
+        manager = Manager(batch_size=2)
+        manager.process_new_subscriptions(timezone.now())
+        self.assertEqual(manager.stats['new'], 5)
+        for subscription in subscriptions:
+            subscription.refresh_from_db()
+            self.assertTrue(subscription.active)
+            self.assertEqual(subscription.date_billing_next.date(),
+                             self.cost.next_billing_datetime(subscription.date_billing_start).date())
+            self.assertTrue(group.user_set.filter(pk=subscription.user_id).exists())
+        future.refresh_from_db()
+        self.assertFalse(future.active)
+
+    def test_new_subscription_replaces_active_subscription(self):
+        old_subscription, = self.create_subscriptions(1, days_ago=5)
+        other_cost = self.create_plan_cost('Pro Plan', cost=200)
+        new_subscription = self.create_pending_subscription(other_cost, old_subscription.user,
+                                                            timezone.now() - timedelta(hours=1))
+        Manager().process_new_subscriptions(timezone.now())
+        old_subscription.refresh_from_db()
+        new_subscription.refresh_from_db()
+        self.assertFalse(old_subscription.active)
+        self.assertTrue(old_subscription.cancelled)
+        self.assertTrue(new_subscription.active)
+
+    def test_newest_pending_subscription_of_user_activated(self):
+        user = User.objects.create_user('pending')
+        older = self.create_pending_subscription(self.cost, user, timezone.now() - timedelta(days=2))
+        newer = self.create_pending_subscription(self.create_plan_cost('Pro Plan', cost=200), user,
+                                                 timezone.now() - timedelta(hours=1))
+        manager = Manager()
+        manager.process_new_subscriptions(timezone.now())
+        self.assertEqual(manager.stats['new'], 1)
+        self.assertEqual(user.subscriptions.get(active=True), newer)
+        older.refresh_from_db()
+        self.assertTrue(older.cancelled)
+
+    @patch('saas_billing.models.SubscriptionTransaction.create_payment')
+    def test_dry_run_projects_without_writing(self, create_payment):
+        expired = self.create_subscriptions(2, days_ago=31)
+        due = self.create_subscriptions(3, days_ago=24)
+        CreditBalance.add_credit(due[0].user, 150)
+        self.create_pending_subscription(self.cost, User.objects.create_user('pending'), timezone.now())
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('process_subscriptions', '--dry-run', stdout=out)
+        self.assertFalse([query for query in queries.captured_queries
+                          if not query['sql'].startswith(('SELECT', 'SAVEPOINT', 'RELEASE SAVEPOINT'))])
+        self.assertFalse(create_payment.called)
+        self.assertFalse(BillingRun.objects.exists())
+        self.assertEqual(UserSubscription.objects.filter(pk__in=[s.pk for s in expired], active=True).count(), 2)
+        self.assertEqual(CreditBalance.objects.get().balance, 150)
+        output = out.getvalue()
+        self.assertIn('Phase expired: candidates=2', output)
+        self.assertIn('Phase due: candidates=3', output)
+        self.assertIn('amount=200.00 credit=100.00', output)
+        self.assertIn('expired=2 activated=1 overdue=2 new=1', output)
@@ -0,0 +1,182 @@
+import pytest
+import stripe
+from io import StringIO
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest.mock import patch, Mock
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from django.contrib.auth.models import User, Group
+from subscriptions_api.models import PlanCost, SubscriptionPlan, UserSubscription
+
+from saas_billing.models import StripeSubscription, PaypalSubscription, BillingRun
+
+PERIOD_END = 1900000000
+PERIOD_END_DATE = timezone.make_naive(datetime.fromtimestamp(PERIOD_END, dt_timezone.utc))
+
+
+@pytest.mark.django_db
+class ReconcileStripeTest(APITestCase):
+
+    def setUp(self):
+        plan = SubscriptionPlan(plan_name='Basic Plan')
+        plan.save()
+        self.cost = PlanCost(cost=10, plan=plan)
+        self.cost.save()
+        self.subscriptions = []
+        for i in range(5):
+            user = User.objects.create_user('user_%s' % i)
+            subscription = self.cost.setup_user_subscription(user, active=False)
+            StripeSubscription.objects.create(subscription=subscription, subscription_ref='sub_%s' % i)
+            self.subscriptions.append(subscription)
+        self.fetched = []
+
+    def stripe_subscription(self, ref, status='active', quantity=1):
+        return stripe.Subscription.construct_from({
+            'id': ref, 'object': 'subscription', 'status': status, 'current_period_end': PERIOD_END,
+            'items': {'object': 'list', 'data': [{'id': 'si_1', 'object': 'subscription_item', 'quantity': quantity}]}
+        }, 'sk_test')
+
+    def reconcile(self, subscriptions, *args):
+        def auto_paging_iter():
+            for subscription in subscriptions:
+                self.fetched.append(subscription.id)
+                yield subscription
+
+        out = StringIO()
+        with patch('stripe.Subscription.list', return_value=Mock(auto_paging_iter=auto_paging_iter)) as list_mock:
+            call_command('reconcile_stripe', *args, stdout=out)
+        self.list_mock = list_mock
+        return out.getvalue()
+
+    def test_drift_fixed(self):
+        active = self.subscriptions[1]
+        active.activate()
+        out = self.reconcile([self.stripe_subscription('sub_0', quantity=3), self.stripe_subscription('sub_1', 'canceled'),
+                              self.stripe_subscription('sub_9')])
+        subscription = UserSubscription.objects.get(pk=self.subscriptions[0].pk)
+        self.assertTrue(subscription.active)
+        self.assertEqual(subscription.quantity, 3)
+        self.assertEqual(subscription.date_billing_next, PERIOD_END_DATE)
+        self.assertEqual(subscription.date_billing_end, PERIOD_END_DATE + timedelta(
+            days=self.cost.plan.grace_period))
+        active.refresh_from_db()
+        self.assertFalse(active.active)
+        self.assertTrue(active.cancelled)
+        self.assertIn('fetched=3 checked=2 updated=2 unknown=1', out)
+        self.assertIn('active mismatches=2', out)
+        self.assertEqual(self.list_mock.call_args[1], {'status': 'all', 'limit': 100})
+
+        out = self.reconcile([self.stripe_subscription('sub_0', quantity=3), self.stripe_subscription('sub_1', 'canceled')])
+        self.assertIn('checked=2 updated=0', out)
+
+    def test_deactivated_subscription_on_default_plan_reactivated(self):
+        active = self.subscriptions[0]
+        active.activate()
+        with patch.dict('subscriptions_api.models.SETTINGS', {'default_plan_cost_id': self.cost.pk}):
+            out = self.reconcile([self.stripe_subscription('sub_0', 'canceled')])
+        self.assertIn('updated=1', out)
+        active.refresh_from_db()
+        self.assertTrue(active.active)
+
+    def test_previous_subscription_deactivated(self):
+        group = Group.objects.create(name='free')
+        free_plan = SubscriptionPlan(plan_name='Free Plan', group=group)
+        free_plan.save()
+        free_cost = PlanCost(cost=0, plan=free_plan)
+        free_cost.save()
+        user = self.subscriptions[0].user
+        free = free_cost.setup_user_subscription(user, active=True)
+        out = self.reconcile([self.stripe_subscription('sub_0')])
+        self.assertIn('updated=1 unknown=0 replaced=1', out)
+        self.assertEqual(user.subscriptions.get(active=True), self.subscriptions[0])
+        free.refresh_from_db()
+        self.assertTrue(free.cancelled)
+        self.assertNotIn(group, user.groups.all())
+
+    def test_dry_run(self):
+        out = self.reconcile([self.stripe_subscription('sub_0')], '--dry-run', '-v', '2')
+        self.assertIn('Dry run, nothing fixed, fetched=1 checked=1 updated=0', out)
+        self.assertIn('active False -> True', out)
+        self.assertFalse(UserSubscription.objects.get(pk=self.subscriptions[0].pk).active)
+
+    def test_one_query_per_page(self):
+        subscriptions = [self.stripe_subscription('sub_%s' % i, status='incomplete') for i in range(5)]
+        with CaptureQueriesContext(connection) as queries:
+            out = self.reconcile(subscriptions, '--batch-size', '2')
+        self.assertIn('fetched=5 checked=5 updated=0', out)
+        selects = [q for q in queries.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 3)
+
+
+@pytest.mark.django_db
+class ReconcilePaypalTest(APITestCase):
+
+    def setUp(self):
+        plan = SubscriptionPlan(plan_name='Basic Plan')
+        plan.save()
+        self.cost = PlanCost(cost=10, plan=plan)
+        self.cost.save()
+        self.subscriptions = []
+        for i in range(5):
+            user = User.objects.create_user('user_%s' % i)
+            subscription = self.cost.setup_user_subscription(user, active=False)
+            PaypalSubscription.objects.create(subscription=subscription, subscription_ref='I-%s' % i)
+            self.subscriptions.append(subscription)
+        self.details = {}
+
+    def get_subscription(self, subscription_ref):
+        details = self.details.get(subscription_ref)
+        if isinstance(details, Exception):
+            raise details
+        return details
+
+    def reconcile(self, *args):
+        out = StringIO()
+        with patch('saas_billing.provider.PayPalClient.get_subscription', side_effect=self.get_subscription) as mock:
+            call_command('reconcile_paypal', '--workers', '1', *args, stdout=out, stderr=StringIO())
+        self.get_mock = mock
+        return out.getvalue()
+
+    def test_drift_fixed(self):
+        active = self.subscriptions[1]
+        active.activate()
+        self.details = {
+            'I-0': {'id': 'I-0', 'status': 'ACTIVE', 'quantity': '2',
+                    'billing_info': {'next_billing_time': '2030-03-17T10:00:00Z'}},
+            'I-1': {'id': 'I-1', 'status': 'SUSPENDED'},
+            'I-2': {'id': 'I-2', 'status': 'APPROVAL_PENDING'},
+            'I-3': ValueError('boom'),
+        }
+        out = self.reconcile()
+        subscription = UserSubscription.objects.get(pk=self.subscriptions[0].pk)
+        self.assertTrue(subscription.active)
+        self.assertEqual(subscription.quantity, 2)
+        self.assertEqual(subscription.date_billing_next, timezone.make_naive(
+            datetime(2030, 3, 17, 10, tzinfo=dt_timezone.utc)))
+        active.refresh_from_db()
+        self.assertFalse(active.active)
+        self.assertTrue(active.cancelled)
+        self.assertIn('fetched=5 checked=3 updated=2 unknown=1 failed=1', out)
+        run = BillingRun.objects.get(command='reconcile_paypal')
+        self.assertTrue(run.completed)
+
+    def test_resume(self):
+        self.details = {'I-%s' % i: {'status': 'ACTIVE'} for i in range(5)}
+        run = BillingRun.start('reconcile_paypal', timezone.now())
+        run.checkpoint('reconcile', PaypalSubscription.objects.order_by('pk')[2].pk, {'fetched': 3, 'checked': 3})
+        out = self.reconcile('--resume', '--batch-size', '1')
+        self.assertIn('Resuming after', out)
+        self.assertEqual(self.get_mock.call_count, 2)
+        self.assertIn('fetched=5 checked=5 updated=2', out)
+        self.assertEqual(UserSubscription.objects.filter(active=True).count(), 2)
+
+    def test_dry_run(self):
+        self.details = {'I-0': {'status': 'ACTIVE'}}
+        out = self.reconcile('--dry-run', '-v', '2')
+        self.assertIn('Dry run, nothing fixed, fetched=5 checked=1 updated=0 unknown=4', out)
+        self.assertIn('active False -> True', out)
+        self.assertFalse(BillingRun.objects.exists())
@@ -0,0 +1,354 @@
+import json
+import base64
+import zlib
+import pytest
+import unittest
+from io import StringIO
+from datetime import datetime, timedelta
+from unittest.mock import patch, Mock
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from rest_framework import status
+
+from django.contrib.auth.models import User
+from subscriptions_api.models import PlanCost, SubscriptionPlan
+
+from saas_billing.models import StripeCustomer, StripeSubscription, PaypalSubscription, WebhookEvent
+from saas_billing import instrumentation, webhooks
+from saas_billing.webhooks import WebhookError, process_webhook_events, register, verify_paypal_event
+
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa, padding
+except ImportError:
+    x509 = None
+
+PAYPAL_HEADERS = {
+    'HTTP_PAYPAL_AUTH_ALGO': 'SHA256withRSA',
+    'HTTP_PAYPAL_CERT_URL': 'https://api.sandbox.paypal.com/v1/notifications/certs/CERT-360caa42',
+    'HTTP_PAYPAL_TRANSMISSION_ID': '69cd13f0-d67a-11e5-baa3-778b53f4ae55',
+    'HTTP_PAYPAL_TRANSMISSION_SIG': 'signature',
+    'HTTP_PAYPAL_TRANSMISSION_TIME': '2016-02-18T20:01:35Z',
+}
+
+
+@pytest.mark.django_db
+class WebhookTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('demo_user')
+        plan = SubscriptionPlan(plan_name='Basic Plan')
+        plan.save()
+        self.cost = PlanCost(cost=10, plan=plan)
+        self.cost.save()
+        self.subscription = self.cost.setup_user_subscription(self.user, active=False)
+        instrumentation.reset()
+
+    def stripe_event(self, status='active', event_type='customer.subscription.updated', event_id='evt_1',
+                     created=1600000000):
+        return {'id': event_id, 'object': 'event', 'type': event_type, 'created': created,
+                'data': {'object': {'id': 'sub_1', 'object': 'subscription', 'customer': 'cus_1', 'status': status}}}
+
+    def paypal_event(self, event_type='BILLING.SUBSCRIPTION.ACTIVATED', event_id='WH-1',
+                     create_time='2020-09-13T12:26:40Z'):
+        return {'id': event_id, 'event_type': event_type, 'create_time': create_time, 'resource': {'id': 'I-1'}}
+
+    def create_stripe_subscription(self):
+        StripeCustomer.objects.create(user=self.user, customer_id='cus_1')
+        StripeSubscription.objects.create(subscription=self.subscription, subscription_ref='sub_1')
+
+    def post_stripe(self, payload):
+        return self.client.post('/billing/stripe/webhook/', data=json.dumps(payload), content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE='t=1,v1=abc')
+
+    def post_paypal(self, payload):
+        return self.client.post('/billing/paypal/webhook/', data=json.dumps(payload), content_type='application/json',
+                                **PAYPAL_HEADERS)
+
+    def test_stripe_webhook_stored_not_processed(self):
+        handler = Mock()
+        with patch.dict(webhooks.HANDLERS, {('stripe', 'customer.subscription.updated'): handler}):
+            r = self.post_stripe(self.stripe_event())
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertFalse(handler.called)
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.gateway, event.event_type, event.status),
+                         ('stripe', 'customer.subscription.updated', WebhookEvent.STATUS_PENDING))
+        self.assertEqual(event.payload, self.stripe_event())
+        self.assertEqual(event.get_headers(), {'STRIPE-SIGNATURE': 't=1,v1=abc'})
+
+    def test_unknown_event_type_acked_without_storing(self):
+        with CaptureQueriesContext(connection) as queries:
+            r = self.post_stripe(self.stripe_event(event_type='invoice.created'))
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries.captured_queries), 0)
+        self.assertEqual(instrumentation.get_stats()['counters']['webhook.stripe.invoice.created.ignored'], 1)
+
+    def test_registered_handler_called_with_timing(self):
+        handler = Mock()
+        with patch.dict(webhooks.HANDLERS):
+            register('stripe', 'invoice.paid')(handler)
+            self.post_stripe(self.stripe_event(event_type='invoice.paid'))
+            self.assertEqual(process_webhook_events(), {'processed': 1, 'failed': 0, 'skipped': 0})
+        handler.assert_called_once_with(WebhookEvent.objects.get())
+        stats = instrumentation.get_stats()
+        self.assertEqual(stats['counters']['webhook.stripe.invoice.paid.processed'], 1)
+        self.assertEqual(stats['timings']['webhook.stripe.invoice.paid']['count'], 1)
+
+    def test_invalid_webhook_body_rejected(self):
+        r = self.client.post('/billing/stripe/webhook/', data='not json', content_type='application/json')
+        self.assertEqual(r.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_paypal_webhook_stored(self):
+        r = self.post_paypal(self.paypal_event())
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.event_type, 'BILLING.SUBSCRIPTION.ACTIVATED')
+        self.assertEqual(event.get_headers()['PAYPAL-TRANSMISSION-ID'], '69cd13f0-d67a-11e5-baa3-778b53f4ae55')
+
+    def test_stripe_event_processed(self):
+        self.create_stripe_subscription()
+        self.post_stripe(self.stripe_event())
+        call_command('process_webhooks')
+        self.subscription.refresh_from_db()
+        self.assertTrue(self.subscription.active)
+        self.assertEqual(self.subscription.transactions.count(), 1)
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.status, WebhookEvent.STATUS_PROCESSED)
+        self.assertIsNotNone(event.processed_at)
+
+    def test_stripe_paused_and_resumed_events_processed(self):
+        self.create_stripe_subscription()
+        self.post_stripe(self.stripe_event(status='paused', event_type='customer.subscription.paused'))
+        self.post_stripe(self.stripe_event(event_type='customer.subscription.resumed', event_id='evt_2',
+                                           created=1600000100))
+        self.assertEqual(WebhookEvent.objects.count(), 2)
+        call_command('process_webhooks')
+        self.subscription.refresh_from_db()
+        self.assertTrue(self.subscription.active)
+
+    @patch('saas_billing.webhooks.verify_paypal_event', return_value=True)
+    def test_paypal_event_processed(self, verify_paypal_event):
+        PaypalSubscription.objects.create(subscription=self.subscription, subscription_ref='I-1')
+        self.post_paypal(self.paypal_event())
+        self.assertEqual(process_webhook_events(), {'processed': 1, 'failed': 0, 'skipped': 0})
+        event, = verify_paypal_event.call_args[0]
+        self.assertEqual(event.get_headers()['PAYPAL-AUTH-ALGO'], 'SHA256withRSA')
+        self.subscription.refresh_from_db()
+        self.assertTrue(self.subscription.active)
+
+    @patch('saas_billing.webhooks.verify_paypal_event', return_value=False)
+    def test_unverified_paypal_event_retried_then_failed(self, verify_paypal_event):
+        PaypalSubscription.objects.create(subscription=self.subscription, subscription_ref='I-1')
+        self.post_paypal(self.paypal_event())
+        for i in range(4):
+            self.assertEqual(process_webhook_events(), {'processed': 0, 'failed': 1, 'skipped': 0})
+            self.assertEqual(WebhookEvent.objects.get().status, WebhookEvent.STATUS_PENDING)
+        process_webhook_events()
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), (WebhookEvent.STATUS_FAILED, 5))
+        self.assertIn('verification failed', event.error)
+        self.assertEqual(process_webhook_events(), {'processed': 0, 'failed': 0, 'skipped': 0})
+        self.subscription.refresh_from_db()
+        self.assertFalse(self.subscription.active)
+
+    def test_duplicate_delivery_stored_once(self):
+        self.create_stripe_subscription()
+        for i in range(3):
+            r = self.post_stripe(self.stripe_event())
+            self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(WebhookEvent.objects.get().event_id, 'evt_1')
+        process_webhook_events()
+        r = self.post_stripe(self.stripe_event())
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(process_webhook_events(), {'processed': 0, 'failed': 0, 'skipped': 0})
+        self.assertEqual(self.subscription.transactions.count(), 1)
+
+    def test_same_event_id_from_other_gateway_stored(self):
+        self.post_stripe(dict(self.stripe_event(), id='WH-1'))
+        self.post_paypal(self.paypal_event())
+        self.assertEqual(WebhookEvent.objects.filter(event_id='WH-1').count(), 2)
+
+    def test_burst_coalesced_to_newest_state(self):
+        self.create_stripe_subscription()
+        self.post_stripe(self.stripe_event('active', event_id='evt_3', created=1600000300))
+        self.post_stripe(self.stripe_event('active', event_id='evt_1', created=1600000100))
+        self.post_stripe(self.stripe_event('incomplete_expired', event_id='evt_2', created=1600000200))
+        self.assertEqual(process_webhook_events(), {'processed': 1, 'failed': 0, 'skipped': 2})
+        self.assertEqual(WebhookEvent.objects.get(status=WebhookEvent.STATUS_PROCESSED).event_id, 'evt_3')
+        self.subscription.refresh_from_db()
+        self.assertTrue(self.subscription.active)
+        self.assertEqual(self.subscription.transactions.count(), 1)
+
+    def test_stale_event_dropped(self):
+        self.create_stripe_subscription()
+        self.post_stripe(self.stripe_event('active', event_id='evt_2', created=1600000200))
+        process_webhook_events()
+        self.post_stripe(self.stripe_event('incomplete_expired', event_id='evt_1', created=1600000100))
+        self.assertEqual(process_webhook_events(), {'processed': 0, 'failed': 0, 'skipped': 1})
+        self.assertEqual(WebhookEvent.objects.get(event_id='evt_1').error, 'older than the last handled event')
+        self.subscription.refresh_from_db()
+        self.assertTrue(self.subscription.active)
+
+    def test_events_handled_in_gateway_time_order(self):
+        handled = []
+        handlers = {('paypal', event_type): lambda event: handled.append(event.event_id)
+                    for event_type in ('BILLING.SUBSCRIPTION.ACTIVATED', 'BILLING.SUBSCRIPTION.PAYMENT.FAILED')}
+        with patch.dict(webhooks.HANDLERS, handlers):
+            self.post_paypal(self.paypal_event('BILLING.SUBSCRIPTION.PAYMENT.FAILED', 'WH-2', '2020-09-13T12:30:00Z'))
+            self.post_paypal(self.paypal_event('BILLING.SUBSCRIPTION.ACTIVATED', 'WH-1', '2020-09-13T12:26:40Z'))
+            self.post_paypal(self.paypal_event('BILLING.SUBSCRIPTION.PAYMENT.FAILED', 'WH-3', '2020-09-13T12:40:00Z'))
+            process_webhook_events()
+        self.assertEqual(handled, ['WH-1', 'WH-2', 'WH-3'])
+
+    @patch.dict(webhooks.saas_billing_settings, {'WEBHOOK_COALESCE_SECONDS': 60})
+    def test_recent_events_left_for_next_drain(self):
+        self.create_stripe_subscription()
+        self.post_stripe(self.stripe_event())
+        self.assertEqual(process_webhook_events(), {'processed': 0, 'failed': 0, 'skipped': 0})
+        WebhookEvent.objects.update(received_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(process_webhook_events(), {'processed': 1, 'failed': 0, 'skipped': 0})
+
+    def create_replay_events(self):
+        for event_id, created, event_type in (('evt_1', 1600000100, 'customer.subscription.updated'),
+                                              ('evt_2', 1600000200, 'customer.subscription.updated'),
+                                              ('evt_3', 1600000050, 'customer.subscription.trial_will_end')):
+            self.post_stripe(self.stripe_event(event_id=event_id, created=created, event_type=event_type))
+        self.post_paypal(self.paypal_event('BILLING.SUBSCRIPTION.PAYMENT.FAILED'))
+        WebhookEvent.objects.update(status=WebhookEvent.STATUS_PROCESSED, attempts=1)
+
+    def test_replay_filtered_events(self):
+        self.create_replay_events()
+        handler = Mock()
+        out = StringIO()
+        with patch.dict(webhooks.HANDLERS, {('stripe', 'customer.subscription.updated'): handler}):
+            call_command('replay_webhooks', '--since', timezone.now().date().isoformat(), '--gateway', 'stripe',
+                         '--type', 'customer.subscription.updated', stdout=out)
+        # evt_1 is superseded by evt_2 of the same subscription
+        self.assertEqual([call[0][0].event_id for call in handler.call_args_list], ['evt_2'])
+        self.assertIn('stripe.customer.subscription.updated count=1', out.getvalue())
+        self.assertIn('replayed=1 failed=0 superseded=1', out.getvalue())
+        self.assertEqual(WebhookEvent.objects.get(event_id='evt_2').attempts, 2)
+
+    def test_replay_dry_run(self):
+        self.create_replay_events()
+        handler = Mock()
+        out = StringIO()
+        with patch.dict(webhooks.HANDLERS, {key: handler for key in webhooks.HANDLERS}):
+            call_command('replay_webhooks', '--since', timezone.now().date().isoformat(), '--dry-run', stdout=out)
+        self.assertFalse(handler.called)
+        self.assertIn('paypal.BILLING.SUBSCRIPTION.PAYMENT.FAILED count=1', out.getvalue())
+        self.assertIn('Dry run, nothing handled, replayed=2 failed=0 superseded=2', out.getvalue())
+
+    def test_replay_stale_event_skipped(self):
+        self.create_stripe_subscription()
+        self.post_stripe(self.stripe_event('active', event_id='evt_1', created=1600000100))
+        process_webhook_events()
+        self.post_stripe(self.stripe_event('incomplete_expired', event_id='evt_2', created=1600000200))
+        process_webhook_events()
+        counts = webhooks.replay_webhook_events(WebhookEvent.objects.filter(event_id='evt_1'))
+        self.assertEqual((counts['replayed'], counts['stale']), (0, 1))
+        self.subscription.refresh_from_db()
+        self.assertFalse(self.subscription.active)
+        self.assertEqual(self.subscription.transactions.count(), 1)
+
+    def test_replay_processed_activation_not_recorded_again(self):
+        self.create_stripe_subscription()
+        self.post_stripe(self.stripe_event('active'))
+        process_webhook_events()
+        transaction = self.subscription.transactions.get()
+        self.assertEqual(transaction.webhook_event, WebhookEvent.objects.get(event_id='evt_1'))
+        counts = webhooks.replay_webhook_events(WebhookEvent.objects.all())
+        self.assertEqual((counts['replayed'], counts['stale']), (1, 0))
+        self.assertEqual(self.subscription.transactions.get(), transaction)
+        self.subscription.refresh_from_db()
+        self.assertTrue(self.subscription.active)
+
+    def test_replay_failure_not_retried(self):
+        self.create_replay_events()
+        handler = Mock(side_effect=ValueError('still broken'))
+        with patch.dict(webhooks.HANDLERS, {('paypal', 'BILLING.SUBSCRIPTION.PAYMENT.FAILED'): handler}):
+            counts = webhooks.replay_webhook_events(WebhookEvent.objects.filter(gateway='paypal'))
+        self.assertEqual((counts['replayed'], counts['failed']), (0, 1))
+        self.assertEqual(WebhookEvent.objects.get(gateway='paypal').status, WebhookEvent.STATUS_FAILED)
+
+    def test_replay_range_excludes_later_events(self):
+        self.create_replay_events()
+        out = StringIO()
+        call_command('replay_webhooks', '--since', '2020-01-01', '--until', '2020-01-02', '--dry-run', stdout=out)
+        self.assertIn('replayed=0', out.getvalue())
+
+
+@pytest.mark.django_db
+@unittest.skipIf(x509 is None, 'cryptography is not installed')
+class PaypalSignatureTest(APITestCase):
+    cert_url = PAYPAL_HEADERS['HTTP_PAYPAL_CERT_URL']
+
+    def setUp(self):
+        webhooks._paypal_certificates.clear()
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def create_certificate(self, days=30):
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'messageverificationcerts.paypal.com')])
+        now = datetime.utcnow()
+        certificate = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+            self.key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+            now - timedelta(days=1)).not_valid_after(now + timedelta(days=days)).sign(self.key, hashes.SHA256())
+        return Mock(content=certificate.public_bytes(serialization.Encoding.PEM), status_code=200)
+
+    def create_event(self, body='{"id": "WH-1", "event_type": "BILLING.SUBSCRIPTION.ACTIVATED"}',
+                     cert_url=cert_url, signed_body=None):
+        headers = {key[5:].replace('_', '-'): value for key, value in PAYPAL_HEADERS.items()}
+        headers['PAYPAL-CERT-URL'] = cert_url
+        crc = zlib.crc32((signed_body or body).encode('utf-8')) & 0xffffffff
+        message = '{}|{}|{}|{}'.format(headers['PAYPAL-TRANSMISSION-ID'], headers['PAYPAL-TRANSMISSION-TIME'], '', crc)
+        signature = self.key.sign(message.encode('utf-8'), padding.PKCS1v15(), hashes.SHA256())
+        headers['PAYPAL-TRANSMISSION-SIG'] = base64.b64encode(signature).decode()
+        return WebhookEvent(gateway='paypal', body=body, headers=json.dumps(headers))
+
+    @patch('saas_billing.webhooks.get_paypal_client')
+    @patch('saas_billing.webhooks.requests.get')
+    def test_signature_verified_locally_with_cached_certificate(self, get, get_paypal_client):
+        get.return_value = self.create_certificate()
+        self.assertTrue(verify_paypal_event(self.create_event()))
+        self.assertTrue(verify_paypal_event(self.create_event()))
+        get.assert_called_once_with(self.cert_url, timeout=10)
+        self.assertFalse(get_paypal_client.called)
+
+    @patch('saas_billing.webhooks.requests.get')
+    def test_tampered_body_rejected(self, get):
+        get.return_value = self.create_certificate()
+        event = self.create_event(body='{"id": "WH-1", "event_type": "BILLING.SUBSCRIPTION.EXPIRED"}',
+                                  signed_body='{"id": "WH-1", "event_type": "BILLING.SUBSCRIPTION.ACTIVATED"}')
+        self.assertFalse(verify_paypal_event(event))
+
+    @patch('saas_billing.webhooks.requests.get')
+    def test_certificate_host_not_allowed(self, get):
+        with self.assertRaises(WebhookError):
+            verify_paypal_event(self.create_event(cert_url='https://paypal.example.com/certs/CERT-1'))
+        self.assertFalse(get.called)
+
+    @patch('saas_billing.webhooks.requests.get')
+    def test_expired_certificate_downloaded_again(self, get):
+        get.return_value = self.create_certificate(days=-0.5)
+        with self.assertRaises(WebhookError):
+            verify_paypal_event(self.create_event())
+        get.return_value = self.create_certificate()
+        self.assertTrue(verify_paypal_event(self.create_event()))
+        self.assertEqual(get.call_count, 2)
+
+    @patch('saas_billing.webhooks.get_paypal_client')
+    @patch('saas_billing.webhooks.requests.get')
+    def test_remote_verification_mode(self, get, get_paypal_client):
+        get_paypal_client.return_value.verify_webhook.return_value = True
+        with patch.dict(webhooks.saas_billing_settings, {'PAYPAL_WEBHOOK_VERIFICATION': 'remote'}):
+            self.assertTrue(verify_paypal_event(self.create_event()))
+        data, = get_paypal_client.return_value.verify_webhook.call_args[0]
+        self.assertEqual(data['cert_url'], self.cert_url)
+        self.assertFalse(get.called)
@@ -4,4 +4,6 @@ app_name = 'saas_billing'
 
 urlpatterns = [
     path('', include('saas_billing.urls')),
+    path('', include('saas_billing.webhook_urls')),
+    path('async/', include('saas_billing.async_urls')),
 ]